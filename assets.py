@@ -0,0 +1,137 @@
+
+# 文件名：字体和logo缓存
+# 同一批照片尺寸基本一样，字体解析和logo缩放只需要做一次，进程内所有图片共用；连拍时整条水印也可以共用
+
+from collections import OrderedDict
+from threading import Lock
+import os
+
+from PIL import Image, ImageFont
+
+import fonts
+from instrument import stage
+
+# logo 所在文件夹（按本文件的位置找，不依赖当前工作目录）
+LOGO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "watermark")
+
+
+class AssetCache:
+    """
+    按最近使用顺序淘汰（LRU）的缓存，总占用超过 max_bytes 就把最久没用的删掉
+    字体的键是 (逻辑名或字体路径, 字号)，logo 的键是 (logo文件名, 缩放后的高度, 模式)，
+    画好的水印条（layout.py）的键是 (版式, 照片尺寸, 黑底, logo, 各行文字)
+    """
+
+    def __init__(self, max_bytes=128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()  # 键 -> (值, 占用字节)
+        self._lock = Lock()
+
+    def _get(self, key, loader):
+        """
+        :param key: 缓存的键
+        :param loader: 没命中时调用，返回 (值, 占用字节)
+        """
+        value = self.lookup(key)
+        if value is None:
+            value, size = loader()
+            self.store(key, value, size)
+        return value
+
+    def lookup(self, key):
+        """
+        :return: 缓存的值，没有就返回None
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+        return None
+
+    def store(self, key, value, size):
+        """
+        :param size: 这个值占用的字节数
+        """
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = (value, size)
+                self.bytes += size
+                self._evict()
+
+    def _evict(self):
+        # 至少留下刚放进去的那一个，不然单个超大logo会反复加载
+        while self.bytes > self.max_bytes and len(self._items) > 1:
+            _, (_, size) = self._items.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def font(self, name, size):
+        """
+        :param name: fonts.LOGICAL 里的逻辑名，或者字体文件路径
+        :param size: 字号（像素）
+        :return: 解析好的 FreeTypeFont
+        """
+        def load():
+            with stage("font"):
+                path, index = fonts.resolve(name)
+                if path is None:  # 系统里一个字体都没有
+                    return ImageFont.load_default(size), 0
+                font = ImageFont.truetype(path, size=size, index=index)
+            # FreeType 会把整个字体文件读进内存，按文件大小估算占用
+            return font, os.path.getsize(path)
+
+        return self._get(("font", name, size), load)
+
+    def logo(self, name, height, mode="RGBA"):
+        """
+        :param name: watermark 文件夹下的logo文件名
+        :param height: 缩放后的高度，宽度按比例
+        :param mode: 转换成的颜色模式
+        :return: (缩放好的logo, 透明通道蒙版或None)
+        """
+        def load():
+            with stage("logo_resize"), Image.open(os.path.join(LOGO_DIR, name)) as img:
+                if img.mode != mode:
+                    img = img.convert(mode)
+                img = img.resize((int(img.width * height / img.height), height))
+            # 有透明通道就用它做蒙版，没有透明通道的logo直接贴
+            mask = img.getchannel("A") if "A" in img.getbands() else None
+            size = img.width * img.height * (len(img.getbands()) + (1 if mask else 0))
+            return (img, mask), size
+
+        return self._get(("logo", name, height, mode), load)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._items), "bytes": self.bytes}
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+
+# 进程内共用的缓存，上限可以用环境变量 WATERMARK_CACHE_MB 调整
+cache = AssetCache(int(os.environ.get("WATERMARK_CACHE_MB", 128)) * 1024 * 1024)
+
+
+def get_font(name, size):
+    return cache.font(name, size)
+
+
+def get_logo(name, height, mode="RGBA"):
+    return cache.logo(name, height, mode)
+
+
+def logo_names():
+    """
+    :return: watermark 文件夹里能用的logo文件名
+    """
+    return sorted(name for name in os.listdir(LOGO_DIR) if os.path.isfile(os.path.join(LOGO_DIR, name)))
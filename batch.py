@@ -0,0 +1,433 @@
+
+# 文件名：批量处理（多进程）
+# 三个脚本（hasselblad.py / 1.py / new.py）共用的文件夹批处理入口
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from contextvars import ContextVar
+from io import BytesIO
+import argparse
+import inspect
+import os
+import time
+import traceback
+
+import catalog
+import cluster
+from encoder import PROFILES, THREADS_ENV, extension, file_format
+import exif_reader
+import instrument
+import pipeline
+from preview import PREVIEW_SUFFIX, proof_sheet
+import raw_preview
+from raw_preview import NoPreviewError
+import scheduler
+from stream import MemoryBudgetError
+import watch
+
+
+# 流水线模式（pipeline.py）下正在处理的这张图：{"source": 预读好的原图字节, "outputs": [(保存路径, 编码好的字节)]}
+current_job = ContextVar("current_job", default=None)
+
+
+class IncompleteExifError(Exception):
+    """照片里读取不到水印需要的拍摄参数（快门、光圈、ISO、焦距等）"""
+
+
+def output_dir(folder_path, preview=None):
+    """
+    :param folder_path: 图片所在文件夹
+    :param preview: 是不是预览模式
+    :return: 结果文件夹
+    """
+    return folder_path + (PREVIEW_SUFFIX if preview else "加水印")
+
+
+def output_path(jpg_file, is_img=False, preview=None, extension=".jpg"):
+    """
+    :param jpg_file: [文件夹, 文件名]
+    :param is_img: 单张图片就保存在原图旁边
+    :param preview: 是不是预览模式
+    :param extension: 输出文件的扩展名（encoder.extension）
+    :return: 加好水印的图片保存路径
+    """
+    # RAW文件输出的也是jpg（或者编码设置对应的格式）
+    name = os.path.splitext(jpg_file[1])[0]
+    if is_img:  # 如果是单张图片
+        suffix = PREVIEW_SUFFIX if preview else "加水印"
+        return os.path.join(jpg_file[0], f'{name}-{suffix}{extension}')
+    return os.path.join(output_dir(jpg_file[0], preview), name + extension)
+
+
+def open_source(path):
+    """
+    :param path: 原图路径
+    :return: 给 Image.open 用：流水线已经预读好这张图（RAW是已经取出来的预览）的话返回内存里的文件对象；
+             RAW文件返回带着EXIF的内嵌JPEG预览；否则原样返回路径
+    """
+    job = current_job.get()
+    if job is not None and job["source"] is not None:
+        return BytesIO(job["source"])
+    if raw_preview.is_raw(path):
+        return BytesIO(raw_preview.preview_jpeg(path))
+    return path
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    先写到同一个文件夹里的临时文件，写完再改名成 path，中途崩溃也不会留下写了一半的图片
+    流水线模式下先编码到内存里，写完这个 with 交给后台写盘
+    :param path: 最终的保存路径
+    :return: 要实际写入的临时路径（流水线模式下是 BytesIO）
+    """
+    job = current_job.get()
+    if job is not None:
+        buffer = BytesIO()
+        yield buffer
+        job["outputs"].append((path, buffer.getvalue()))
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def is_source(file_name, raw=False):
+    """
+    :param raw: True 就处理RAW文件（用内嵌的JPEG预览），不处理jpg，免得 RAW+JPEG 的两张输出到同一个文件
+    """
+    return raw_preview.is_raw(file_name) if raw else file_name.endswith('.jpg')
+
+
+def list_jpgs(folder_path, raw=False):
+    """
+    列出文件夹下面要加水印的jpg文件
+    :param folder_path: 文件夹路径
+    :param raw: True 就列出RAW文件
+    :return: 排好序的文件名列表
+    """
+    return sorted(f for f in os.listdir(folder_path) if is_source(f, raw))
+
+
+def prescan(folder_path, files, required_tags):
+    """
+    只读文件头检查EXIF，把缺参数的照片提前挑出来，不解码像素
+    :param required_tags: 版式必须有的标签，格式同 exif_reader.DEFAULT_TAGS
+    :return: (可以处理的文件名列表, {跳过的文件名: 原因}, {缺参数的文件名})
+    """
+    ok, skipped, incomplete = [], {}, set()
+    for file_name in files:
+        path = os.path.join(folder_path, file_name)
+        try:
+            header = raw_preview.read_header(path) if raw_preview.is_raw(path) else exif_reader.read_header(path)
+        except (OSError, ValueError, NoPreviewError) as e:
+            skipped[file_name] = str(e)
+            continue
+        missing = exif_reader.missing_tags(exif_reader.load(header.exif, required_tags), required_tags)
+        if missing:
+            skipped[file_name] = file_name + "获取的参数不全（缺少 " + ", ".join(missing) + "）"
+            incomplete.add(file_name)
+        else:
+            ok.append(file_name)
+    return ok, skipped, incomplete
+
+
+def _process_one(func, folder_path, file_name, kwargs, profile=False):
+    """
+    在子进程里处理一张图片，所有异常都在这里接住，不会让整批任务中断
+    :param profile: True 就记录这张图每个阶段的耗时
+    :return: (文件名, 错误信息或None, 耗时秒, 分阶段计时记录或None, 这个进程的峰值内存MB)
+    """
+    start = time.perf_counter()
+    if profile:
+        instrument.begin(file_name)
+    try:
+        func([folder_path, file_name], **kwargs)
+        error = None
+    except (IncompleteExifError, MemoryBudgetError, NoPreviewError) as e:
+        error = str(e)
+    except Exception:
+        error = traceback.format_exc(limit=3).strip()
+    record = instrument.end() if profile else None
+    return file_name, error, time.perf_counter() - start, record, instrument.peak_rss_mb()
+
+
+class BatchResult:
+    """一次批处理的汇总"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = []
+        self.failed = {}
+        self.skipped = {}
+        self.incomplete = set()  # 跳过的照片里缺拍摄参数的：文件不变就永远处理不了，不用重试
+        self.elapsed = 0.0
+        self.profile = instrument.Report()
+        self.peak_rss_mb = None  # 各个进程峰值内存里最大的
+        self.memory = None  # 按内存预算调度时的 scheduler.Utilization
+
+    @property
+    def images_per_sec(self):
+        return len(self.done) / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        text = (f"完成 {len(self.done)}/{self.total} 张，跳过 {len(self.skipped)} 张，失败 {len(self.failed)} 张，"
+                f"用时 {self.elapsed:.1f}s，{self.images_per_sec:.2f} 张/秒")
+        if self.peak_rss_mb is not None:
+            text += f"，单进程峰值内存 {self.peak_rss_mb:.0f}MB"
+        if self.memory is not None:
+            text += "\n" + self.memory.summary()
+        for name, error in {**self.skipped, **self.failed}.items():
+            text += f"\n  {name}: {error}"
+        return text
+
+
+def run_batch(func, folder_path, files=None, workers=None, ordered=True, quiet=False, required_tags=None,
+              profile=False, prefetch=None, raw=False, catalog=None, memory=None, template=None, **kwargs):
+    """
+    多进程批量加水印
+    :param func: 各脚本里的 add_watermark
+    :param folder_path: 图片所在文件夹，结果写到 folder_path + "加水印"
+    :param files: 要处理的文件名列表，默认是文件夹下全部jpg（raw=True 时是全部RAW文件）
+    :param workers: 进程数，默认等于CPU核数；1 表示在当前进程里串行处理；流水线模式下是线程数
+    :param ordered: True 按文件名顺序输出进度，False 谁先完成先输出谁
+    :param quiet: True 就不逐张打印进度
+    :param required_tags: 版式必须有的EXIF标签，给了就先只读文件头预检，缺参数的直接跳过
+    :param profile: True 就记录每张图每个阶段的耗时，汇总在 BatchResult.profile
+    :param prefetch: 给了就在当前进程里用流水线处理（pipeline.py），预读后面 prefetch 张原图；流式处理时不用
+    :param raw: True 就处理RAW文件，用里面内嵌的全尺寸JPEG预览
+    :param catalog: catalog.Catalog，给了就直接在目录里查缺不缺参数，不再读文件头
+    :param memory: 整批的内存预算（MB），给了就按每张图估算的内存调度（scheduler.py），谁先完成先输出谁
+    :param template: 各脚本的 TEMPLATE，按内存调度时用它估算画布大小
+    :param kwargs: 原样传给 func 的参数（black、logo等）
+    :return: BatchResult
+    """
+    if files is None:
+        files = list_jpgs(folder_path, raw)
+    result = BatchResult(len(files))
+
+    start = time.perf_counter()
+    if required_tags:
+        if catalog is not None:
+            files, result.skipped, result.incomplete = catalog.prescan(folder_path, files, required_tags)
+        else:
+            files, result.skipped, result.incomplete = prescan(folder_path, files, required_tags)
+        if not quiet:
+            for error in result.skipped.values():
+                print(error)
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(files)) or 1
+    if prefetch and not kwargs.get("stream"):
+        # 流水线只有写完的顺序，ordered 不起作用
+        pipeline.run_pipeline(func, folder_path, files, kwargs, threads=workers, prefetch=prefetch, profile=profile,
+                              on_done=lambda outcome: _collect([outcome], result, quiet))
+    elif memory:
+        workers = scheduler.pool_size(workers, memory, len(files))
+        jobs = scheduler.plan_jobs(func, folder_path, files, memory, workers, template, kwargs)
+        result.memory = scheduler.run_scheduled(func, folder_path, jobs, workers, memory, profile,
+                                                on_done=lambda outcome: _collect([outcome], result, quiet))
+    elif workers == 1:
+        outcomes = (_process_one(func, folder_path, f, kwargs, profile) for f in files)
+        _collect(outcomes, result, quiet)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_process_one, func, folder_path, f, kwargs, profile) for f in files]
+            if ordered:
+                outcomes = (future.result() for future in futures)
+            else:
+                outcomes = (future.result() for future in as_completed(futures))
+            _collect(outcomes, result, quiet)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _collect(outcomes, result, quiet):
+    for file_name, error, seconds, record, peak_rss_mb in outcomes:
+        result.profile.add(record)
+        if peak_rss_mb is not None:
+            result.peak_rss_mb = max(result.peak_rss_mb or 0, peak_rss_mb)
+        if error is None:
+            result.done.append(file_name)
+        else:
+            result.failed[file_name] = error
+        if not quiet:
+            status = "ok" if error is None else "失败"
+            print(f"[{len(result.done) + len(result.failed) + len(result.skipped)}/{result.total}] {file_name} {status} {seconds:.2f}s")
+
+
+def build_parser(func=None):
+    """
+    :param func: 各脚本里的 add_watermark，只有它支持的选项才会出现在命令行里
+    """
+    accepted = inspect.signature(func).parameters if func else {}
+    parser = argparse.ArgumentParser(description="读取照片EXIF，批量生成哈苏风格水印")
+    parser.add_argument("path", nargs="?", help="jpg图片或文件夹路径，不填就运行后再输入")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="进程数，默认等于CPU核数")
+    parser.add_argument("--unordered", action="store_true", help="谁先完成先输出谁，不按文件名顺序")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不逐张打印进度，只打印汇总")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="记录每张图每个阶段的耗时并打印汇总；PATH以.prof结尾导出pstats格式，否则导出JSON lines")
+    parser.add_argument("--watch", type=float, nargs="?", const=2.0, metavar="SECONDS",
+                        help="一直监视文件夹，新来的或改过的照片写完后自动加水印（SECONDS是轮询间隔，默认2秒）")
+    parser.add_argument("--incremental", action="store_true",
+                        help="按清单只处理新的或改过的照片，扫一遍就退出")
+    parser.add_argument("--cluster", action="store_true",
+                        help="多机模式：几台机器挂同一个共享文件夹都这样运行，靠结果文件夹里的租约文件分活，-j 是本机开几个节点")
+    parser.add_argument("--lease", type=float, default=60.0, metavar="SECONDS",
+                        help="多机模式下租约多久没有心跳算节点挂了、收回重做（默认60秒）")
+    parser.add_argument("--shard", metavar="I/N",
+                        help="多机模式下这台机器先做第I份（共N份，按文件名哈希分），做完再帮别人做")
+    parser.add_argument("--raw", action="store_true",
+                        help="处理文件夹里的RAW（DNG、NEF、ARW、3FR……），直接用内嵌的全尺寸JPEG预览，不解马赛克")
+    parser.add_argument("--where", action="append", metavar="EXPR",
+                        help="只处理满足条件的照片，比如 \"model~X1D, date>=2023-05-01, iso<=800\"（见 catalog.py），"
+                             "条件在文件夹的EXIF目录里查，不用打开照片；可以写多次，全部都要满足")
+    parser.add_argument("--memory", type=int, metavar="MB",
+                        help="整批的内存预算：先读文件头估算每张图要多少内存，大小照片混着调度、总数不超过MB，"
+                             "单张就超预算的照片自动流式处理；结束时报告利用率")
+    parser.add_argument("--encode-threads", type=int, metavar="N",
+                        help="800万像素以上的画布切成横条用N个线程同时编码，拼成一个带重启标记的基线JPEG（0是CPU核数）；"
+                             "解码出来和单线程编码完全一样，适合照片少、核多的时候")
+    parser.add_argument("--pipeline", type=int, nargs="?", const=4, metavar="N",
+                        help="单进程流水线：后台预读后面N张（默认4）、多线程解码编码、后台写盘，-j 是线程数")
+    if "lossless" in accepted:
+        parser.add_argument("--lossless", action="store_true",
+                            help="不重新编码原照片，只在底部无损追加水印条（做不到的照片自动整张编码）")
+    if "preview" in accepted:
+        parser.add_argument("--preview", type=int, metavar="MAXPX",
+                            help="快速预览：按长边MAXPX缩小解码排版，结果放到 文件夹加水印预览，并拼一张样张")
+    if "encoder" in accepted:
+        parser.add_argument("--encoder", choices=sorted(PROFILES), metavar="NAME",
+                            help="编码设置：" + "、".join(sorted(PROFILES)) + "，默认 default（Pillow默认质量）")
+    if "renditions" in accepted:
+        parser.add_argument("--renditions", type=int, nargs="+", metavar="MAXPX",
+                            help="另外再出几种尺寸（长边像素），比如 --renditions 2048 480，保存成 文件名-2048px.jpg；"
+                                 "原照片只解码一次，每种尺寸的水印按自己的大小排版")
+    if "stream" in accepted:
+        parser.add_argument("--stream", type=int, metavar="MB",
+                            help="流式处理超大照片：按条解码、编码、写盘，每个进程的内存不超过MB，超出的照片报错跳过")
+    return parser
+
+
+def layout_options(args):
+    """
+    :return: 命令行里给了的、要原样传给 add_watermark 的参数
+    """
+    options = {}
+    if getattr(args, "lossless", False):
+        options["lossless"] = True
+    if getattr(args, "preview", None):
+        options["preview"] = args.preview
+    if getattr(args, "stream", None):
+        options["stream"] = args.stream
+    if getattr(args, "encoder", None):
+        options["encoder"] = args.encoder
+    if getattr(args, "renditions", None):
+        options["renditions"] = tuple(args.renditions)
+    return options
+
+
+def main(func, argv=None, required_tags=None, template=None):
+    """
+    三个脚本共用的命令行入口
+    :param func: 各脚本里的 add_watermark
+    :param required_tags: 各脚本的 REQUIRED_TAGS，文件夹模式用它预检
+    :param template: 各脚本的 TEMPLATE，--memory 用它估算内存
+    :param argv: 命令行参数，默认读 sys.argv
+    """
+    parser = build_parser(func)
+    args = parser.parse_args(argv)
+    options = layout_options(args)
+    if options.get("stream") and file_format(options.get("encoder")) != "JPEG":
+        parser.error("--stream 只能输出JPEG，不能和 --encoder " + options["encoder"] + " 一起用")
+    if options.get("renditions") and (options.get("stream") or options.get("preview")):
+        parser.error("--renditions 不能和 --stream、--preview 一起用")
+    if any(size < 1 for size in options.get("renditions", ())):
+        parser.error("--renditions 的尺寸要大于0")
+    if (args.watch or args.incremental) and (args.profile or args.pipeline):
+        parser.error("--watch、--incremental 不能和 --profile、--pipeline 一起用")
+    if args.cluster and (args.watch or args.incremental or args.where or args.profile or args.pipeline
+                         or options.get("stream")):
+        parser.error("--cluster 不能和 --watch、--incremental、--where、--profile、--pipeline、--stream 一起用")
+    if args.memory is not None:
+        if args.watch or args.incremental or args.cluster or args.pipeline:
+            parser.error("--memory 不能和 --watch、--incremental、--cluster、--pipeline 一起用")
+        if args.memory < 1:
+            parser.error("--memory 要大于0")
+    if args.encode_threads is not None:
+        if args.encode_threads < 0:
+            parser.error("--encode-threads 不能小于0")
+        os.environ[THREADS_ENV] = str(args.encode_threads)  # 工作进程从环境变量读
+    shard = None
+    if args.shard:
+        try:
+            shard = cluster.parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.where:
+        if args.watch or args.incremental:
+            parser.error("--where 不能和 --watch、--incremental 一起用")
+        try:
+            catalog.parse_where(args.where)
+        except ValueError as e:
+            parser.error(str(e))
+    folder_path = args.path or input('请输入jpg图片或文件夹路径')
+    # 是否是文件夹
+    if os.path.isdir(folder_path):
+        if args.watch or args.incremental:
+            watch.watch_folder(func, folder_path, interval=args.watch or 0, once=args.incremental,
+                               workers=args.workers, required_tags=required_tags, quiet=args.quiet, raw=args.raw,
+                               **options)
+            return
+        # 要新建文件夹？
+        out_dir = output_dir(folder_path, options.get("preview"))
+        os.makedirs(out_dir, exist_ok=True)
+        if args.cluster:
+            result = cluster.run_cluster(func, folder_path, workers=args.workers, lease=args.lease, shard=shard,
+                                         raw=args.raw, quiet=args.quiet, **options)
+            print("本机" + result.summary())
+            return
+        files, selection = None, None
+        if args.where:
+            selection = catalog.Catalog(catalog.catalog_path(folder_path))
+            changed, _ = selection.refresh(folder_path, args.raw)
+            files = selection.select(args.where, args.raw)
+            if not args.quiet:
+                print(f"EXIF目录重读 {changed} 张，满足条件 {len(files)} 张")
+        try:
+            result = run_batch(func, folder_path, files=files, workers=args.workers, ordered=not args.unordered,
+                               quiet=args.quiet, required_tags=required_tags, profile=bool(args.profile),
+                               prefetch=args.pipeline, raw=args.raw, catalog=selection, memory=args.memory,
+                               template=template, **options)
+        finally:
+            if selection is not None:
+                selection.close()
+        print(result.summary())
+        if args.profile:
+            print(result.profile.summary())
+            result.profile.write(args.profile)
+        if options.get("preview"):
+            sheet = proof_sheet([output_path([folder_path, f], preview=True, extension=extension(options.get("encoder")))
+                                 for f in sorted(result.done)],
+                                os.path.join(out_dir, "样张.jpg"))
+            if sheet:
+                print("样张：" + sheet)
+    # 是否是单个文件
+    elif os.path.isfile(folder_path) and (is_source(folder_path) or is_source(folder_path, raw=True)):
+        if args.profile:
+            instrument.begin(os.path.basename(folder_path))
+        try:
+            func([os.path.dirname(folder_path), os.path.basename(folder_path)], is_img=True, **options)
+        except (IncompleteExifError, MemoryBudgetError, NoPreviewError) as e:
+            print(e)
+        if args.profile:
+            report = instrument.Report()
+            report.add(instrument.end())
+            print(report.summary())
+            report.write(args.profile)
+    else:
+        print('路径有误')
@@ -0,0 +1,269 @@
+
+# 文件名：性能测试
+# 离线生成带EXIF的合成JPEG（各种方向、有没有GPS、缺参数，12~100MP），跑三种版式，输出JSON方便不同提交之间对比
+# 用法：python benchmark.py --sizes 12 24 --output bench.json
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import argparse
+import inspect
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageFilter
+import PIL
+import piexif
+
+from batch import IncompleteExifError, list_jpgs, output_path
+from encoder import PROFILES, extension
+import instrument
+from instrument import peak_rss_mb, percentiles
+from layout import LAYOUTS, load_layout
+
+# 百万像素 -> 宽高（都是常见机身的实际尺寸）
+SIZES = {12: (4000, 3000), 24: (6000, 4000), 50: (8640, 5760), 100: (11648, 8736)}
+# 生成的测试图按这个目录缓存，参数一样就不重新生成
+DATA_DIR = os.path.join(tempfile.gettempdir(), "hasselblad_watermark_bench")
+
+
+def make_exif(rng, orientation, gps=True, complete=True):
+    """
+    :param rng: random.Random，保证每次生成的一样
+    :param orientation: EXIF方向 1~8
+    :param gps: 要不要GPS
+    :param complete: False 就去掉快门、光圈、ISO、焦距，模拟读不到参数的照片
+    :return: piexif.dump 后的字节
+    """
+    exif = {
+        "0th": {piexif.ImageIFD.Make: b"Hasselblad", piexif.ImageIFD.Model: b"X2D 100C",
+                piexif.ImageIFD.Orientation: orientation,
+                piexif.ImageIFD.DateTime: f"2024:05:{rng.randint(1, 28):02d} 1{rng.randint(0, 9)}:30:00".encode()},
+        "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2024:05:01 10:30:00"},
+        "GPS": {},
+    }
+    if complete:
+        exif["Exif"].update({
+            piexif.ExifIFD.ExposureTime: (1, rng.choice((60, 125, 250, 500, 1000))),
+            piexif.ExifIFD.FNumber: (rng.choice((18, 28, 40, 56, 80)), 10),
+            piexif.ExifIFD.ISOSpeedRatings: rng.choice((64, 100, 200, 400, 800)),
+            piexif.ExifIFD.FocalLength: (rng.choice((240, 350, 500, 900)), 10),
+        })
+    if gps:
+        exif["GPS"] = {
+            piexif.GPSIFD.GPSLatitudeRef: b"N",
+            piexif.GPSIFD.GPSLatitude: ((rng.randint(0, 89), 1), (rng.randint(0, 59), 1), (rng.randint(0, 5999), 100)),
+            piexif.GPSIFD.GPSLongitudeRef: b"E",
+            piexif.GPSIFD.GPSLongitude: ((rng.randint(0, 179), 1), (rng.randint(0, 59), 1), (rng.randint(0, 5999), 100)),
+        }
+    return piexif.dump(exif)
+
+
+def make_photo(size, seed):
+    """
+    生成有纹理的合成照片：小尺寸噪声放大再叠渐变，压缩率接近真实照片
+    """
+    small = (max(size[0] // 8, 1), max(size[1] // 8, 1))
+    bands = [Image.effect_noise(small, 40 + 10 * i).point(lambda v, s=seed + i: (v + s * 37) % 256)
+             for i in range(3)]
+    photo = Image.merge("RGB", bands).filter(ImageFilter.GaussianBlur(1))
+    photo = photo.resize(size, Image.Resampling.BICUBIC)
+    gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+    return Image.blend(photo, gradient, 0.35)
+
+
+def make_dng(path, photo, exif):
+    """
+    生成DNG结构的RAW：IFD0是全尺寸JPEG预览（和真的DNG一样预览里不带EXIF，EXIF在TIFF的IFD里），
+    IFD1是一张小缩略图，没有真正的传感器数据（只测内嵌预览）
+    :param photo: 预览的像素
+    :param exif: make_exif 的返回值
+    """
+    preview, thumbnail = BytesIO(), BytesIO()
+    photo.save(preview, "JPEG", quality=92)
+    small = photo.copy()
+    small.thumbnail((256, 256))
+    small.save(thumbnail, "JPEG", quality=80)
+    data = piexif.load(exif)
+    data["0th"].update({
+        piexif.ImageIFD.NewSubfileType: 1, piexif.ImageIFD.ImageWidth: photo.width,
+        piexif.ImageIFD.ImageLength: photo.height, piexif.ImageIFD.BitsPerSample: (8, 8, 8),
+        piexif.ImageIFD.Compression: 7, piexif.ImageIFD.PhotometricInterpretation: 6,
+        piexif.ImageIFD.SamplesPerPixel: 3, piexif.ImageIFD.RowsPerStrip: photo.height,
+        piexif.ImageIFD.StripByteCounts: preview.tell(), piexif.ImageIFD.DNGVersion: (1, 4, 0, 0),
+        piexif.ImageIFD.UniqueCameraModel: data["0th"][piexif.ImageIFD.Model],
+    })
+    data["1st"] = {piexif.ImageIFD.Compression: 6}
+    data["thumbnail"] = thumbnail.getvalue()
+    # 预览接在TIFF结构后面：先按偏移0打包一次量出长度，偏移是定长的，再打包一次长度不变
+    data["0th"][piexif.ImageIFD.StripOffsets] = 0
+    data["0th"][piexif.ImageIFD.StripOffsets] = len(piexif.dump(data)) - 6
+    tiff = piexif.dump(data)[6:]
+    with open(path, "wb") as f:
+        f.write(tiff)
+        f.write(preview.getvalue())
+
+
+def make_dataset(megapixels, count, seed=0, data_dir=DATA_DIR, raw=False):
+    """
+    生成一组测试图：方向1~8轮流、一半带GPS，每8张里有1张缺参数
+    :param raw: True 就生成DNG结构的RAW（见 make_dng）
+    :return: 测试图所在文件夹
+    """
+    folder = os.path.join(data_dir, f"{megapixels}mp_{count}_{seed}" + ("_dng" if raw else ""))
+    if os.path.isdir(folder) and len(os.listdir(folder)) == count:
+        return folder
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed * 1000 + megapixels)
+    photo = make_photo(SIZES[megapixels], seed)
+    for i in range(count):
+        orientation = i % 8 + 1
+        exif = make_exif(rng, orientation, gps=i % 2 == 0, complete=i % 8 != 7)
+        name = os.path.join(folder, f"{megapixels}mp_{i:03d}_o{orientation}")
+        if raw:
+            make_dng(name + ".dng", photo, exif)
+        else:
+            photo.save(name + ".jpg", "JPEG", quality=92, exif=exif)
+    return folder
+
+
+def run_case(layout, folder, repeat, options, raw=False):
+    """
+    在单独的子进程里跑一个版式，峰值内存才是这个版式自己的
+    :param raw: 文件夹里是RAW文件
+    """
+    module = load_layout(layout)
+    # 版式不支持的参数（比如 new.py 没有 lossless）就不传
+    accepted = inspect.signature(module.add_watermark).parameters
+    options = {k: v for k, v in options.items() if k in accepted}
+    files = list_jpgs(folder, raw)
+    os.makedirs(folder + "加水印", exist_ok=True)
+    latencies, rejects, failures, sizes, encodes = [], [], {}, [], []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for name in files:
+            # 只为了拿到编码这一步的耗时，其他阶段的计时开销很小
+            instrument.begin(name)
+            t = time.perf_counter()
+            try:
+                module.add_watermark([folder, name], **options)
+            except IncompleteExifError:
+                rejects.append(time.perf_counter() - t)
+                continue
+            except Exception as e:
+                failures[name] = f"{type(e).__name__}: {e}"
+                continue
+            finally:
+                stages = instrument.end()["stages"]
+            latencies.append(time.perf_counter() - t)
+            # 无损追加模式下"编码"是 lossless 这一步
+            encodes.append(sum(stages[s]["seconds"] for s in ("encode", "lossless") if s in stages))
+            sizes.append(os.path.getsize(output_path([folder, name], preview=options.get("preview"),
+                                                     extension=extension(options.get("encoder")))))
+    elapsed = time.perf_counter() - start
+    return {
+        "images": len(latencies),
+        "rejected": len(rejects),
+        "failures": failures,
+        "latency_ms": percentiles(latencies),
+        "encode_ms": percentiles(encodes),
+        "reject_ms": percentiles(rejects),
+        "throughput_ips": len(latencies) / elapsed if elapsed else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "output_bytes": {"mean": sum(sizes) / len(sizes), "total": sum(sizes)} if sizes else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(layouts, sizes, count=8, repeat=1, seed=0, data_dir=DATA_DIR, encoders=("default",), raw=False,
+                  **options):
+    """
+    :param layouts: 版式名列表，见 LAYOUTS
+    :param sizes: 百万像素列表，见 SIZES
+    :param encoders: 编码设置名列表，见 encoder.PROFILES，每种都跑一遍
+    :param raw: True 就用DNG结构的RAW测试内嵌预览的读取
+    :param count: 每种尺寸生成几张
+    :param repeat: 每张跑几遍
+    :param options: 原样传给 add_watermark 的参数（lossless、preview等）
+    :return: 可以直接 json.dump 的结果
+    """
+    report = {
+        "meta": {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "pillow": PIL.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                 "count": count, "repeat": repeat, "seed": seed, "encoders": list(encoders), "raw": raw,
+                 "options": options},
+        "results": [],
+    }
+    for megapixels in sizes:
+        folder = make_dataset(megapixels, count, seed, data_dir, raw)
+        for layout in layouts:
+            for name in encoders:
+                # 每个用例一个全新的子进程，缓存和峰值内存互不影响
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(run_case, layout, folder, repeat, {**options, "encoder": name},
+                                             raw).result()
+                report["results"].append({"layout": layout, "megapixels": megapixels, "encoder": name, **result})
+    return report
+
+
+def format_report(report):
+    lines = [f"{'版式':<12}{'编码':<10}{'MP':>5}{'张数':>6}{'p50ms':>10}{'p99ms':>10}{'编码p50ms':>12}{'张/秒':>9}"
+             f"{'峰值MB':>10}{'平均KB':>10}"]
+    for r in report["results"]:
+        latency = r["latency_ms"] or {}
+        encode = r["encode_ms"] or {}
+        size = r["output_bytes"] or {}
+        lines.append(f"{r['layout']:<12}{r['encoder']:<10}{r['megapixels']:>5}{r['images']:>6}{latency.get('p50', 0):>10.1f}"
+                     f"{latency.get('p99', 0):>10.1f}{encode.get('p50', 0):>12.1f}{r['throughput_ips']:>9.2f}"
+                     f"{r['peak_rss_mb'] or 0:>10.0f}{size.get('mean', 0) / 1024:>10.0f}")
+        for name, error in r["failures"].items():
+            lines.append(f"  失败 {name}: {error}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="水印性能测试，结果输出为JSON")
+    parser.add_argument("--layouts", nargs="+", choices=sorted(LAYOUTS), default=sorted(LAYOUTS))
+    parser.add_argument("--sizes", nargs="+", type=int, choices=sorted(SIZES), default=[12, 24])
+    parser.add_argument("--count", type=int, default=8, help="每种尺寸生成几张，默认8（方向1~8各一张，其中一张缺参数）")
+    parser.add_argument("--repeat", type=int, default=1, help="每张跑几遍")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=DATA_DIR, help="测试图缓存目录")
+    parser.add_argument("--lossless", action="store_true", help="bottom-band版式用无损追加模式")
+    parser.add_argument("--preview", type=int, metavar="MAXPX", help="预览模式")
+    parser.add_argument("--encoders", nargs="+", choices=sorted(PROFILES), default=["default"],
+                        help="要比较的编码设置，每种都跑一遍，输出编码耗时和文件大小")
+    parser.add_argument("--raw", action="store_true", help="测试图生成DNG结构的RAW，测内嵌预览的读取")
+    parser.add_argument("-o", "--output", help="JSON结果保存路径，不填就打印到标准输出")
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.lossless:
+        options["lossless"] = True
+    if args.preview:
+        options["preview"] = args.preview
+    report = run_benchmark(args.layouts, args.sizes, args.count, args.repeat, args.seed, args.data_dir, args.encoders,
+                           args.raw, **options)
+    print(format_report(report), file=sys.stderr)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
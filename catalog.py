@@ -0,0 +1,316 @@
+
+# 文件名：EXIF目录
+# 每次批处理都要把每张照片打开、解析一遍EXIF才知道机型、时间、参数；只想重做某个机型、某几天的照片时也得全扫一遍
+# 这里把每张照片的拍摄参数记在一个SQLite数据库里，按大小和修改时间判断要不要重读；
+# 批处理加 --where 就直接在库里挑出要处理的照片、检查缺不缺参数，不用再打开照片
+# 用法：python catalog.py 文件夹 --where "model~X1D, date>=2023-05-01"
+
+import argparse
+import os
+import re
+import sqlite3
+
+import piexif
+
+import batch
+import exif_reader
+import raw_preview
+from raw_preview import NoPreviewError
+
+# 数据库放在结果文件夹里，和 watch.py 的清单放在一起
+CATALOG_NAME = ".watermark-catalog.sqlite"
+
+# 要读的标签，格式同 exif_reader.DEFAULT_TAGS
+CATALOG_TAGS = {
+    "0th": (piexif.ImageIFD.Orientation, piexif.ImageIFD.Model, piexif.ImageIFD.DateTime),
+    "Exif": (piexif.ExifIFD.ExposureTime, piexif.ExifIFD.FNumber,
+             piexif.ExifIFD.ISOSpeedRatings, piexif.ExifIFD.FocalLength),
+    "GPS": (piexif.GPSIFD.GPSLatitudeRef, piexif.GPSIFD.GPSLatitude,
+            piexif.GPSIFD.GPSLongitudeRef, piexif.GPSIFD.GPSLongitude),
+}
+# (分组, 标签) -> 记在哪一列，列是 NULL 就说明照片里没有这个标签
+TAG_COLUMNS = {
+    ("0th", piexif.ImageIFD.Orientation): "orientation",
+    ("0th", piexif.ImageIFD.Model): "model",
+    ("0th", piexif.ImageIFD.DateTime): "datetime",
+    ("Exif", piexif.ExifIFD.ExposureTime): "exposure",
+    ("Exif", piexif.ExifIFD.FNumber): "fnumber",
+    ("Exif", piexif.ExifIFD.ISOSpeedRatings): "iso",
+    ("Exif", piexif.ExifIFD.FocalLength): "focal",
+    ("GPS", piexif.GPSIFD.GPSLatitude): "lat",
+    ("GPS", piexif.GPSIFD.GPSLongitude): "lon",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    orientation INTEGER,
+    model TEXT,
+    datetime TEXT,
+    date TEXT,
+    exposure REAL,
+    fnumber REAL,
+    iso INTEGER,
+    focal REAL,
+    lat REAL,
+    lon REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS files_model ON files (model);
+CREATE INDEX IF NOT EXISTS files_date ON files (date);
+"""
+_COLUMNS = ("name", "size", "mtime", "width", "height", "orientation", "model", "datetime", "date",
+            "exposure", "fnumber", "iso", "focal", "lat", "lon", "error")
+# 一个事务写多少行，中途被打断的话已经写进去的下次不用重读
+_CHUNK = 1000
+
+
+def _number(value):
+    """:return: 快门可以写 1/250"""
+    if "/" in value:
+        numerator, denominator = value.split("/", 1)
+        return float(numerator) / float(denominator)
+    return float(value)
+
+
+def _date(value):
+    """:return: 2023-05-01，也认EXIF的 2023:05:01"""
+    return value.replace(":", "-")
+
+
+def _datetime(value):
+    """:return: 2023-05-01 12:00:00"""
+    date, _, time = value.partition(" ")
+    return (date.replace(":", "-") + " " + time).strip()
+
+
+# --where 里能用的字段 -> (列, 值怎么转换)
+FIELDS = {
+    "name": ("name", str),
+    "model": ("model", str),
+    "date": ("date", _date),
+    "time": ("datetime", _datetime),
+    "exposure": ("exposure", _number),
+    "shutter": ("exposure", _number),
+    "fnumber": ("fnumber", _number),
+    "aperture": ("fnumber", _number),
+    "iso": ("iso", int),
+    "focal": ("focal", _number),
+    "width": ("width", int),
+    "height": ("height", int),
+    "orientation": ("orientation", int),
+    "lat": ("lat", _number),
+    "lon": ("lon", _number),
+}
+# "~" 是包含（不分大小写），其他和SQL一样
+_CONDITION = re.compile(r"^\s*(\w+)\s*(>=|<=|!=|=|<|>|~)\s*(.*?)\s*$")
+
+
+def parse_where(expressions):
+    """
+    把筛选条件翻译成SQL，只用参数绑定，不会把用户写的东西直接拼进SQL
+    :param expressions: 条件字符串列表，每个里面可以用逗号隔开多个条件，全部都要满足，
+                        比如 ["model~X1D, date>=2023-05-01", "iso<=800"]
+    :return: (WHERE 后面的SQL, 参数列表)
+    """
+    clauses, params = [], []
+    for expression in expressions:
+        for condition in expression.split(","):
+            if not condition.strip():
+                continue
+            match = _CONDITION.match(condition)
+            if not match or match.group(1).lower() not in FIELDS:
+                raise ValueError(f"看不懂的条件 {condition.strip()}，字段只有 " + "、".join(FIELDS))
+            field, op, value = match.groups()
+            column, convert = FIELDS[field.lower()]
+            try:
+                value = convert(value)
+            except (ValueError, ZeroDivisionError):
+                raise ValueError(f"条件 {condition.strip()} 的值不对")
+            if op == "~":
+                clauses.append(f"{column} LIKE ? ESCAPE '\\'")
+                params.append("%" + re.sub(r"([%_\\])", r"\\\1", str(value)) + "%")
+            else:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+    return " AND ".join(clauses) or "1", params
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return value.strip("\x00 ") or None
+
+
+def _ratio(value):
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], int):
+        return value[0] / value[1] if value[1] else None
+    return None
+
+
+def _first(value):
+    return value[0] if isinstance(value, tuple) else value
+
+
+def _degrees(value, ref):
+    """:return: 度分秒换成带符号的度数，南纬、西经是负的"""
+    if not isinstance(value, tuple) or len(value) != 3:
+        return None
+    parts = [_ratio(v) for v in value]
+    if None in parts:
+        return None
+    degrees = parts[0] + parts[1] / 60 + parts[2] / 3600
+    return -degrees if _text(ref or b"") in ("S", "W") else degrees
+
+
+def read_row(folder_path, name, stat):
+    """
+    只读文件头（RAW读内嵌预览的文件头），取出要记的拍摄参数
+    :return: 按 _COLUMNS 顺序的一行
+    """
+    path = os.path.join(folder_path, name)
+    try:
+        header = raw_preview.read_header(path) if raw_preview.is_raw(path) else exif_reader.read_header(path)
+    except (OSError, ValueError, NoPreviewError) as e:
+        return (name, stat.st_size, stat.st_mtime_ns) + (None,) * 12 + (str(e),)
+    data = exif_reader.load(header.exif, CATALOG_TAGS)
+    zeroth, exif, gps = data["0th"], data["Exif"], data["GPS"]
+    datetime = _text(zeroth.get(piexif.ImageIFD.DateTime, b""))
+    if datetime:
+        datetime = _datetime(datetime)
+    return (name, stat.st_size, stat.st_mtime_ns, header.width, header.height,
+            _first(zeroth.get(piexif.ImageIFD.Orientation)),
+            _text(zeroth.get(piexif.ImageIFD.Model, b"")),
+            datetime, datetime[:10] if datetime else None,
+            _ratio(exif.get(piexif.ExifIFD.ExposureTime)),
+            _ratio(exif.get(piexif.ExifIFD.FNumber)),
+            _first(exif.get(piexif.ExifIFD.ISOSpeedRatings)),
+            _ratio(exif.get(piexif.ExifIFD.FocalLength)),
+            _degrees(gps.get(piexif.GPSIFD.GPSLatitude), gps.get(piexif.GPSIFD.GPSLatitudeRef)),
+            _degrees(gps.get(piexif.GPSIFD.GPSLongitude), gps.get(piexif.GPSIFD.GPSLongitudeRef)),
+            None)
+
+
+def catalog_path(folder_path):
+    """
+    :return: 这个文件夹的目录数据库路径
+    """
+    return os.path.join(batch.output_dir(folder_path), CATALOG_NAME)
+
+
+class Catalog:
+    """
+    一个文件夹里照片的拍摄参数：每张照片一行，大小或修改时间变了才重读
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        # 只有批处理的主进程在写，WAL 让 catalog.py 同时查询也不会被锁住
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def refresh(self, folder_path, raw=False):
+        """
+        扫一遍文件夹：新的和大小、修改时间变了的照片重读文件头，不在了的删掉，其他的只 stat 不打开
+        :param raw: True 就记RAW文件，同 batch.list_jpgs
+        :return: (重读了几张, 删掉了几张)
+        """
+        known = {name: (size, mtime) for name, size, mtime in self.db.execute("SELECT name, size, mtime FROM files")}
+        changed, seen = [], set()
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if not batch.is_source(entry.name, raw) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                seen.add(entry.name)
+                if known.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                    changed.append((entry.name, stat))
+        insert = f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * len(_COLUMNS))})"
+        for i in range(0, len(changed), _CHUNK):
+            rows = [read_row(folder_path, name, stat) for name, stat in changed[i:i + _CHUNK]]
+            with self.db:
+                self.db.executemany(insert, rows)
+        # jpg 和 RAW 记在同一个库里，只删这次扫的那一种
+        gone = [(name,) for name in known if name not in seen and batch.is_source(name, raw)]
+        with self.db:
+            self.db.executemany("DELETE FROM files WHERE name = ?", gone)
+        return len(changed), len(gone)
+
+    def select(self, expressions=(), raw=False):
+        """
+        :param expressions: 筛选条件，见 parse_where
+        :param raw: True 就只挑RAW文件
+        :return: 满足条件的文件名，排好序；读不了文件头的照片不算
+        """
+        where, params = parse_where(expressions)
+        rows = self.db.execute(f"SELECT name FROM files WHERE error IS NULL AND {where} ORDER BY name", params)
+        return [name for name, in rows if batch.is_source(name, raw)]
+
+    def prescan(self, folder_path, files, required_tags):
+        """
+        和 batch.prescan 一样把缺参数的照片挑出来，但是直接查库，不打开照片
+        要求的标签不全在库里的话就退回 batch.prescan
+        :return: (可以处理的文件名列表, {跳过的文件名: 原因}, {缺参数的文件名})
+        """
+        required = [(ifd, tag) for ifd, tags in required_tags.items() for tag in tags]
+        if any(key not in TAG_COLUMNS for key in required):
+            return batch.prescan(folder_path, files, required_tags)
+        columns = [TAG_COLUMNS[key] for key in required]
+        wanted = set(files)
+        rows = {row[0]: row[1:] for row in self.db.execute(f"SELECT name, error, {', '.join(columns)} FROM files")
+                if row[0] in wanted}
+        ok, skipped, incomplete = [], {}, set()
+        for file_name in files:
+            row = rows.get(file_name)
+            if row is None:
+                skipped[file_name] = file_name + " 不在目录里"
+            elif row[0] is not None:
+                skipped[file_name] = row[0]
+            else:
+                missing = [piexif.TAGS[ifd][tag]["name"] for (ifd, tag), value in zip(required, row[1:]) if value is None]
+                if missing:
+                    skipped[file_name] = file_name + "获取的参数不全（缺少 " + ", ".join(missing) + "）"
+                    incomplete.add(file_name)
+                else:
+                    ok.append(file_name)
+        return ok, skipped, incomplete
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="更新文件夹的EXIF目录，列出满足条件的照片")
+    parser.add_argument("path", help="文件夹路径")
+    parser.add_argument("--where", action="append", default=[], metavar="EXPR",
+                        help="筛选条件，比如 \"model~X1D, date>=2023-05-01, iso<=800\"；字段：" + "、".join(FIELDS))
+    parser.add_argument("--raw", action="store_true", help="记RAW文件而不是jpg")
+    args = parser.parse_args(argv)
+    try:
+        parse_where(args.where)
+    except ValueError as e:
+        parser.error(str(e))
+    with Catalog(catalog_path(args.path)) as catalog:
+        changed, gone = catalog.refresh(args.path, args.raw)
+        files = catalog.select(args.where, args.raw)
+    for name in files:
+        print(name)
+    print(f"重读 {changed} 张，删掉 {gone} 张，满足条件 {len(files)} 张")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+
+# 文件名：多机批处理
+# 活动现场好几台机器挂着同一个共享存储，一起处理同一个文件夹：只靠文件系统协调，不需要别的服务
+# 每张照片在 结果文件夹/.leases 里有一个租约文件，谁用 O_EXCL 建出来谁处理；处理时定期改租约的修改时间当心跳，
+# 机器挂了心跳就停了，别的机器看到租约一段时间没变就收回来重做；结果先编码到内存里，确认租约还是自己的才写盘，
+# 写完留一个完成标记再删租约，所以每张照片只输出一次、不会输出一半
+# 用法：每台机器上都运行 python hasselblad.py 共享文件夹 --cluster [-j 进程数]
+
+import contextvars
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import batch
+import pipeline
+from watch import layout_settings
+
+# 租约和完成标记放在结果文件夹下面
+LEASE_DIR = ".leases"
+# 没有能领的照片时（都被别人领走了）隔多久再看一遍（秒）
+POLL_INTERVAL = 1.0
+
+
+def node_name():
+    """
+    :return: 这个进程在队列里的名字：主机名:进程号
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def parse_shard(text):
+    """
+    :param text: "I/N"，比如 "0/3"
+    :return: (I, N)
+    """
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError("--shard 的格式是 I/N，比如 0/3")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("--shard 要满足 0 <= I < N")
+    return index, count
+
+
+def work_order(files, node, shard=None):
+    """
+    每个节点按自己的顺序领照片，几台机器不会挤在同一张上
+    :param shard: (I, N)：先处理自己那一份（文件名哈希后除以N余I的），做完了再帮别人做
+    :return: 排好顺序的文件名
+    """
+    def digest(name, salt=""):
+        return hashlib.blake2b((salt + name).encode("utf-8"), digest_size=8).digest()
+
+    if shard is None:
+        return sorted(files, key=lambda name: digest(name, node))
+    index, count = shard
+    return sorted(files, key=lambda name: (int.from_bytes(digest(name), "big") % count != index, digest(name, node)))
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # 不在了，或者别人刚建出来还没写完
+
+
+def lease_token(path):
+    """
+    :return: 租约里的令牌，读不到就是None
+    """
+    lease = _read_json(path)
+    return lease.get("token") if isinstance(lease, dict) else None
+
+
+def claim(path, node):
+    """
+    领一张照片：租约文件只有一个进程能建出来（O_EXCL），网络文件系统上也一样
+    :return: 领到了就返回令牌，已经有人领了返回None
+    """
+    token = uuid.uuid4().hex
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"node": node, "token": token, "claimed": time.time()}, f)
+    return token
+
+
+def reclaim(path):
+    """
+    收回一个过期的租约：先改名（只有一个节点能改成功），改完发现是别人刚领的新租约就放回去
+    """
+    token = lease_token(path)
+    stale = f"{path}.{uuid.uuid4().hex}.stale"
+    try:
+        os.rename(path, stale)
+    except OSError:
+        return
+    if lease_token(stale) != token:
+        try:
+            os.link(stale, path)
+        except OSError:
+            pass  # 放不回去，原来的主人下次心跳发现租约没了会自己放弃
+    os.remove(stale)
+
+
+def release(path, token):
+    """
+    删掉自己的租约：先改成只有自己知道的名字再看令牌，是别人刚收回去领的新租约就放回去，不会删掉别人的
+    """
+    private = f"{path}.{token}.release"
+    try:
+        os.rename(path, private)
+    except OSError:
+        return  # 已经被别人收回了
+    if lease_token(private) != token:
+        try:
+            os.link(private, path)
+        except OSError:
+            pass
+    os.remove(private)
+
+
+class ExpiryWatch:
+    """
+    判断租约过期不看各台机器的时钟：在本机看着一个租约，它的修改时间和大小 ttl 秒都没变，就说明主人没有心跳了
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._seen = {}  # 租约路径 -> ((修改时间, 大小), 本机第一次看到这个状态的时间)
+
+    def expired(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        signature = (stat.st_mtime_ns, stat.st_size)
+        now = time.monotonic()
+        seen = self._seen.get(path)
+        if seen is None or seen[0] != signature:
+            self._seen[path] = (signature, now)
+            return False
+        return now - seen[1] >= self.ttl
+
+
+class Heartbeat(threading.Thread):
+    """
+    处理照片时在后台定期改租约的修改时间；发现租约没了或者换了主人就记下来，处理完不提交结果
+    """
+
+    def __init__(self, path, token, interval):
+        super().__init__(daemon=True)
+        self.path = path
+        self.token = token
+        self.interval = interval
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            if lease_token(self.path) != self.token:
+                self.lost = True
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                self.lost = True
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _done_path(lease_dir, file_name):
+    return os.path.join(lease_dir, file_name + ".done")
+
+
+def is_done(lease_dir, file_name, stat, settings):
+    """
+    :return: 这张照片（同样的大小、修改时间）已经用同样的水印设置处理过了
+    """
+    done = _read_json(_done_path(lease_dir, file_name))
+    return (isinstance(done, dict) and done.get("size") == stat.st_size and done.get("mtime") == stat.st_mtime_ns
+            and done.get("settings") == settings)
+
+
+def _mark_done(lease_dir, file_name, stat, settings, node, error):
+    with batch.atomic_write(_done_path(lease_dir, file_name)) as tmp:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"size": stat.st_size, "mtime": stat.st_mtime_ns, "settings": settings, "node": node,
+                       "error": error}, f, ensure_ascii=False)
+
+
+def _render(func, folder_path, file_name, options):
+    """
+    :return: (batch._process_one 格式的结果, [(保存路径, 编码好的字节)])，结果都在内存里，确认租约还在才写盘
+    """
+    return contextvars.copy_context().run(pipeline._render, func, folder_path, file_name, None, options, False)
+
+
+def drain(func, folder_path, lease=60.0, shard=None, raw=False, quiet=False, node=None, options=None):
+    """
+    一个节点：不停地领照片、处理、提交，直到文件夹里所有照片都处理完
+    :param func: 各脚本里的 add_watermark
+    :param folder_path: 共享的图片文件夹
+    :param lease: 租约多久没有心跳算过期（秒）；网络文件系统有属性缓存，要比缓存时间长
+    :param shard: (I, N)，见 work_order
+    :param raw: True 就处理RAW文件
+    :param node: 节点名，默认 node_name()
+    :param options: 原样传给 func 的参数
+    :return: 这个节点处理的照片，batch._process_one 格式的结果列表
+    """
+    options = options or {}
+    if options.get("stream"):
+        raise ValueError("多机模式不支持流式处理：流式处理直接写盘，没法等确认租约以后再提交")
+    node = node or node_name()
+    lease_dir = os.path.join(batch.output_dir(folder_path, options.get("preview")), LEASE_DIR)
+    os.makedirs(lease_dir, exist_ok=True)
+    settings = layout_settings(func, options)
+    watch = ExpiryWatch(lease)
+    outcomes, finished = [], {}  # finished：确认处理过的 文件名 -> (大小, 修改时间)，不用每一遍都读完成标记
+    while True:
+        waiting = progress = False
+        for file_name in work_order(batch.list_jpgs(folder_path, raw), node, shard):
+            try:
+                stat = os.stat(os.path.join(folder_path, file_name))
+            except OSError:
+                continue
+            if finished.get(file_name) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            if is_done(lease_dir, file_name, stat, settings):
+                finished[file_name] = (stat.st_size, stat.st_mtime_ns)
+                continue
+            lease_path = os.path.join(lease_dir, file_name + ".lease")
+            token = claim(lease_path, node)
+            if token is None and watch.expired(lease_path):
+                reclaim(lease_path)
+                token = claim(lease_path, node)
+            if token is None:
+                waiting = True  # 别人正在处理
+                continue
+            # 领到以后再看一次：可能刚被别人做完、删了租约
+            if is_done(lease_dir, file_name, stat, settings):
+                release(lease_path, token)
+                finished[file_name] = (stat.st_size, stat.st_mtime_ns)
+                continue
+            progress = True
+            # 心跳一直持续到提交完，写盘慢也不会让租约过期
+            heartbeat = Heartbeat(lease_path, token, lease / 4)
+            heartbeat.start()
+            try:
+                outcome, outputs = _render(func, folder_path, file_name, options)
+                held = not heartbeat.lost and lease_token(lease_path) == token
+                if held:
+                    try:
+                        for path, data in outputs:
+                            pipeline._write(path, data)
+                        # 写盘的时候也可能被收回，标记完成之前再确认一次
+                        held = lease_token(lease_path) == token
+                        if held:
+                            _mark_done(lease_dir, file_name, stat, settings, node, outcome[1])
+                            finished[file_name] = (stat.st_size, stat.st_mtime_ns)
+                    except OSError as e:
+                        outcome = (outcome[0], str(e)) + outcome[2:]
+            finally:
+                heartbeat.stop()
+            if held:
+                release(lease_path, token)
+            else:
+                # 租约被收回了（比如这台机器卡住太久），别人会重做，这里的结果不要了；别人也挂了的话还要收回来
+                outcome = (outcome[0], "租约被别的节点收回，结果作废") + outcome[2:]
+                waiting = True
+            outcomes.append(outcome)
+            _report(node, outcome, quiet)
+        if not waiting:
+            return outcomes
+        if not progress:
+            time.sleep(POLL_INTERVAL)
+
+
+def _report(node, outcome, quiet):
+    if not quiet:
+        status = "ok" if outcome[1] is None else "失败"
+        print(f"[{node}] {outcome[0]} {status} {outcome[2]:.2f}s", flush=True)
+
+
+def run_cluster(func, folder_path, workers=None, lease=60.0, shard=None, raw=False, quiet=False, **options):
+    """
+    在这台机器上开 workers 个节点一起处理共享文件夹，其他机器上同样运行就行，谁先领到谁做
+    :param workers: 本机开几个节点（进程），默认等于CPU核数
+    :param options: 原样传给 func 的参数
+    :return: 本机处理的照片的 batch.BatchResult
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    if workers == 1:
+        outcomes = drain(func, folder_path, lease, shard, raw, quiet, options=options)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(drain, func, folder_path, lease, shard, raw, quiet, options=options)
+                       for _ in range(workers)]
+            outcomes = [outcome for future in futures for outcome in future.result()]
+    result = batch.BatchResult(len(outcomes))
+    batch._collect(outcomes, result, quiet=True)
+    result.elapsed = time.perf_counter() - start
+    return result
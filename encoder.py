@@ -0,0 +1,158 @@
+
+# 文件名：编码设置
+# 成品怎么编码：给客户看的样片要快、交付要画质，有时还要和原图一样的量化表，或者直接出WebP/PNG
+# 三个脚本都按名字选一套设置，默认的 "default" 和以前一样是 Pillow 的默认值
+# 一亿像素的画布编码一次要一两秒，libjpeg 只用一个核：设了 WATERMARK_ENCODE_THREADS 就把大画布切成横条
+# 多线程同时编码，再按重启标记（RST）拼成一个基线JPEG（见 save_striped）
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import os
+
+from PIL import Image, JpegImagePlugin
+
+from instrument import stage
+from orientation import TO_DISPLAY
+from stream import StripWriter, encode_strip
+
+# 设置名 -> (格式, 传给 Image.save 的参数)；"match" 表示量化表和色度采样照抄原图
+PROFILES = {
+    # Pillow 默认：质量75、4:2:0、基线
+    "default": ("JPEG", {}),
+    # 给客户挑片的样片：质量低一些，编码快、文件小
+    "draft": ("JPEG", {"quality": 60}),
+    # 和原图一样的量化表、色度采样，画质和文件大小都跟着原图走
+    "match": ("JPEG", {"match": True}),
+    # 交付：高质量、不压色度、优化哈夫曼表、渐进式
+    "delivery": ("JPEG", {"quality": 95, "subsampling": 0, "optimize": True, "progressive": True}),
+    "webp": ("WEBP", {"quality": 90, "method": 4}),
+    # PNG 本来就是无损的，压缩级别只换速度和大小，默认的6比1慢好几倍、文件只小一点
+    "png": ("PNG", {"compress_level": 1}),
+}
+# 格式 -> 文件扩展名
+EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+_ORIENTATION = 0x0112
+# 画布到这么多像素才分条并行编码，小图分条省下的时间还不够开线程和拼接的
+PARALLEL_MIN_PIXELS = 8 * 1000 * 1000
+# 每条的高度对齐到16行：4:2:0 的MCU高16行，4:4:4、4:2:2 是8行，色度下采样都不会跨条
+_STRIPE_ROWS = 16
+# 分条编码的线程数从这个环境变量读，批处理的工作进程、服务的渲染线程都能看到
+THREADS_ENV = "WATERMARK_ENCODE_THREADS"
+
+
+def file_format(name=None):
+    """
+    :param name: 设置名，None 就是 "default"
+    :return: Pillow 的格式名
+    """
+    return PROFILES[name or "default"][0]
+
+
+def extension(name=None):
+    """
+    :return: 这套设置输出文件的扩展名
+    """
+    return EXTENSIONS[file_format(name)]
+
+
+def save_options(name=None, source=None):
+    """
+    :param name: 设置名
+    :param source: Image.open 打开的原照片，"match" 从它读量化表和采样方式
+    :return: 传给 Image.save 的参数（不含格式和EXIF）
+    """
+    options = dict(PROFILES[name or "default"][1])
+    if options.pop("match", False) and getattr(source, "format", None) == "JPEG":
+        qtables = list(source.quantization.values())
+        # 灰度照片只有一张亮度表，彩色画布的色度也用它
+        options["qtables"] = qtables if len(qtables) > 1 else qtables * 2
+        subsampling = JpegImagePlugin.get_sampling(source)
+        if subsampling != -1:
+            options["subsampling"] = subsampling
+    return options
+
+
+def stream_options(name=None, source=None):
+    """
+    :return: 分条编码（stream.StripWriter）用的参数：每条的哈夫曼表必须一样，所以不能优化哈夫曼表、不能渐进
+    """
+    if file_format(name) != "JPEG":
+        raise ValueError("流式处理只能输出JPEG")
+    options = save_options(name, source)
+    options.pop("optimize", None)
+    options.pop("progressive", None)
+    return options
+
+
+def encode_threads():
+    """
+    :return: 单张JPEG用几个线程分条编码：环境变量 WATERMARK_ENCODE_THREADS，0 表示CPU核数，默认1不分条
+    """
+    threads = int(os.environ.get(THREADS_ENV, 1))
+    return threads if threads > 0 else os.cpu_count() or 1
+
+
+def can_stripe(size, fmt, options):
+    """
+    :param size: 画布宽高
+    :return: 这张画布能不能分条编码：只有基线JPEG，各条的哈夫曼表要一样，所以不能优化哈夫曼表、不能渐进
+    """
+    return (fmt == "JPEG" and size[0] * size[1] >= PARALLEL_MIN_PIXELS
+            and not options.get("optimize") and not options.get("progressive"))
+
+
+def save_striped(canvas, out_path, options=None, threads=2):
+    """
+    把画布切成横条，多线程同时编码，再拼成一个基线JPEG
+    条的边界对齐MCU，每个块的系数都和整张编码一样，只是每行MCU后面多了重启标记，解码出来的像素完全一样
+    :param canvas: 存储方向的成品画布
+    :param out_path: 保存路径，或者以二进制写打开的文件对象
+    :param options: 传给 Image.save 的参数，EXIF写进第一条的文件头
+    :param threads: 几个线程
+    """
+    options = dict(options or {})
+    exif = options.pop("exif", None)
+    # 条数是线程数的2倍，哪条编码慢一点也不会让别的线程干等
+    rows = -(-canvas.height // (threads * 2))
+    rows = -(-rows // _STRIPE_ROWS) * _STRIPE_ROWS
+
+    def encode(top):
+        strip = canvas.crop((0, top, canvas.width, min(canvas.height, top + rows)))
+        return encode_strip(strip, options, exif if top == 0 else None)
+
+    output = nullcontext(out_path) if hasattr(out_path, "write") else open(out_path, "wb")
+    with ThreadPoolExecutor(max_workers=threads) as executor, output as f:
+        writer = StripWriter(f, canvas.size, exif, options)
+        for encoded in executor.map(encode, range(0, canvas.height, rows)):
+            writer.append(encoded)
+        writer.close()
+
+
+def save_canvas(canvas, out_path, exif=None, name=None, source=None, orientation=None):
+    """
+    按编码设置保存成品
+    :param canvas: 存储方向的成品画布
+    :param out_path: 保存路径
+    :param exif: 原照片的EXIF
+    :param name: 设置名
+    :param source: 原照片，"match" 要用
+    :param orientation: EXIF方向；WebP、PNG 的方向标记很多软件不认，直接转成显示方向、标记改成1
+    """
+    fmt = file_format(name)
+    options = save_options(name, source)
+    if fmt != "JPEG" and TO_DISPLAY.get(orientation) is not None:
+        with stage("orientation", pixels=canvas.width * canvas.height):
+            canvas = canvas.transpose(TO_DISPLAY[orientation])
+        if exif:
+            upright = Image.Exif()
+            upright.load(exif)
+            upright[_ORIENTATION] = 1
+            exif = upright.tobytes()
+    if exif:
+        options["exif"] = exif
+    threads = encode_threads()
+    with stage("encode", pixels=canvas.width * canvas.height, path=out_path):
+        if threads > 1 and can_stripe(canvas.size, fmt, options):
+            save_striped(canvas, out_path, options, threads)
+        else:
+            canvas.save(out_path, fmt, **options)
@@ -0,0 +1,173 @@
+
+# 文件名：轻量EXIF读取
+# 只读JPEG文件头（到SOS为止），从APP1段里挑出水印要用的几个标签，不解码像素、也不解析缩略图和MakerNote
+
+import struct
+
+import piexif
+
+# 三种版式一共会用到的标签，按 piexif 的分组（"0th"、"Exif"、"GPS"）
+DEFAULT_TAGS = {
+    "0th": (piexif.ImageIFD.Orientation, piexif.ImageIFD.Model, piexif.ImageIFD.DateTime),
+    "Exif": (piexif.ExifIFD.ExposureTime, piexif.ExifIFD.FNumber,
+             piexif.ExifIFD.ISOSpeedRatings, piexif.ExifIFD.FocalLength),
+    "GPS": (piexif.GPSIFD.GPSLatitude, piexif.GPSIFD.GPSLongitude),
+}
+
+# TIFF 数据类型 -> 每个值占的字节数
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+# 读到这些段就说明后面是像素数据了
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_SOS = 0xDA
+
+
+class JpegHeader:
+    """JPEG文件头里读到的信息"""
+
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.components = None
+        self.sampling = None  # 每个分量的 (水平, 垂直) 采样系数
+        self.exif = None  # APP1里原样的EXIF字节，和 Image.info["exif"] 一样以 b"Exif\0\0" 开头
+
+    @property
+    def pixels(self):
+        return (self.width or 0) * (self.height or 0)
+
+
+def read_header(path):
+    """
+    只读文件头，不解码像素
+    :param path: jpg文件路径
+    :return: JpegHeader
+    """
+    header = JpegHeader()
+    with open(path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            raise ValueError(path + " 不是JPEG文件")
+        while True:
+            byte = f.read(1)
+            if not byte:
+                break
+            if byte != b"\xff":
+                continue
+            marker = f.read(1)
+            while marker == b"\xff":  # 段之间允许填充0xFF
+                marker = f.read(1)
+            if not marker:
+                break
+            marker = marker[0]
+            if marker == 0xD8 or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                continue  # 没有长度字段的标记
+            length = struct.unpack(">H", _read_exact(f, 2, path))[0]
+            if length < 2:
+                raise ValueError(path + " JPEG段长度不对")
+            if marker == _SOS:
+                break
+            if marker == 0xE1 and header.exif is None:
+                segment = _read_exact(f, length - 2, path)
+                if segment.startswith(b"Exif\x00\x00"):
+                    header.exif = segment
+                continue
+            if marker in _SOF_MARKERS:
+                segment = _read_exact(f, length - 2, path)
+                if len(segment) < 6:
+                    raise ValueError(path + " SOF段不完整")
+                header.height, header.width, header.components = struct.unpack(">HHB", segment[1:6])
+                if len(segment) < 6 + header.components * 3:
+                    raise ValueError(path + " SOF段不完整")
+                header.sampling = [(segment[7 + i * 3] >> 4, segment[7 + i * 3] & 0x0F)
+                                   for i in range(header.components)]
+                continue
+            f.seek(length - 2, 1)
+    return header
+
+
+def _read_exact(f, size, path):
+    """
+    :return: 正好 size 个字节；文件在段中间断掉了（拷卡拷了一半）就报 ValueError，由调用方当作失败跳过
+    """
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError(path + " 文件不完整")
+    return data
+
+
+def load(exif_bytes, tags=None):
+    """
+    解析EXIF，只取需要的标签，返回值的格式和 piexif.load 一样
+    :param exif_bytes: Image.info["exif"] 或者 JpegHeader.exif，也可以是整个TIFF/RAW文件（bytes 或 mmap），可以是None
+    :param tags: 需要的标签，格式同 DEFAULT_TAGS，默认 DEFAULT_TAGS
+    :return: {"0th": {...}, "Exif": {...}, "GPS": {...}}
+    """
+    tags = DEFAULT_TAGS if tags is None else tags
+    data = {"0th": {}, "Exif": {}, "GPS": {}}
+    if not exif_bytes:
+        return data
+    tiff = exif_bytes[6:] if exif_bytes[:6] == b"Exif\x00\x00" else exif_bytes
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return data
+    try:
+        ifd0 = struct.unpack(endian + "I", tiff[4:8])[0]
+        wanted = set(tags.get("0th", ())) | {piexif.ImageIFD.ExifTag, piexif.ImageIFD.GPSTag}
+        zeroth = _read_ifd(tiff, ifd0, endian, wanted)
+        exif_pointer = zeroth.pop(piexif.ImageIFD.ExifTag, None)
+        gps_pointer = zeroth.pop(piexif.ImageIFD.GPSTag, None)
+        data["0th"] = zeroth
+        if exif_pointer and tags.get("Exif"):
+            data["Exif"] = _read_ifd(tiff, exif_pointer, endian, set(tags["Exif"]))
+        if gps_pointer and tags.get("GPS"):
+            data["GPS"] = _read_ifd(tiff, gps_pointer, endian, set(tags["GPS"]))
+    except (struct.error, IndexError):
+        pass  # EXIF损坏就当作读到多少算多少，缺的标签由调用方判断
+    return data
+
+
+def _read_ifd(tiff, offset, endian, wanted):
+    result = {}
+    count = struct.unpack(endian + "H", tiff[offset:offset + 2])[0]
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tag, value_type, value_count = struct.unpack(endian + "HHI", tiff[entry:entry + 8])
+        if tag not in wanted or value_type not in _TYPE_SIZES:
+            continue
+        size = _TYPE_SIZES[value_type] * value_count
+        if size <= 4:
+            raw = tiff[entry + 8:entry + 8 + size]
+        else:
+            pointer = struct.unpack(endian + "I", tiff[entry + 8:entry + 12])[0]
+            raw = tiff[pointer:pointer + size]
+        if len(raw) < size:
+            continue
+        result[tag] = _decode(raw, value_type, value_count, endian)
+    return result
+
+
+def _decode(raw, value_type, count, endian):
+    if value_type == 2:  # ASCII，和 piexif 一样去掉末尾的\0
+        return raw[:-1] if raw.endswith(b"\x00") else raw
+    if value_type in (1, 7):
+        return raw
+    if value_type in (5, 10):
+        fmt = endian + ("I" if value_type == 5 else "i") * (2 * count)
+        numbers = struct.unpack(fmt, raw)
+        values = tuple((numbers[i], numbers[i + 1]) for i in range(0, len(numbers), 2))
+    else:
+        fmt = endian + {3: "H", 4: "I", 9: "i"}[value_type] * count
+        values = struct.unpack(fmt, raw)
+    return values[0] if count == 1 else values
+
+
+def missing_tags(data, required):
+    """
+    :param data: load() 的返回值
+    :param required: 版式必须有的标签，格式同 DEFAULT_TAGS
+    :return: 缺少的标签名列表，不缺就是空列表
+    """
+    return [piexif.TAGS[ifd][tag]["name"]
+            for ifd, ifd_tags in required.items() for tag in ifd_tags if tag not in data[ifd]]
@@ -0,0 +1,358 @@
+
+# 文件名：字体查找
+# 版式里只写逻辑名（sans、sans-bold、sans-light、bolton），按系统里装了的字体找到具体文件，Windows、macOS、Linux 都能用
+# 第一次用时扫一遍字体文件夹，只读每个字体文件头里的名字表、字重和字符表，记下家族、样式、字重、有没有中文，
+# 存成一个JSON；以后启动只读这个JSON、stat 一下记过的文件夹，文件夹的修改时间变了才重扫那一个文件夹
+# 用法：python fonts.py            看每个逻辑名用的是哪个字体
+#       python fonts.py --list     列出所有字体
+#       python fonts.py --rebuild  重新扫描
+
+import argparse
+import json
+import os
+import struct
+import sys
+from threading import Lock
+
+# 项目自带的字体文件夹（按本文件的位置找），放进去的字体最先找到，比如 F37 Bolton
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+FONT_EXTENSIONS = (".ttf", ".ttc", ".otf", ".otc")
+INDEX_VERSION = 1
+
+# 中文字体常见的家族名，按优先顺序：微软雅黑、苹方、思源黑体、文泉驿……
+CJK_FAMILIES = ("Microsoft YaHei", "微软雅黑", "PingFang SC", "Noto Sans CJK SC", "Noto Sans SC", "Source Han Sans SC",
+                "Source Han Sans CN", "Hiragino Sans GB", "WenQuanYi Zen Hei", "WenQuanYi Micro Hei",
+                "Droid Sans Fallback", "SimHei", "黑体")
+LATIN_FAMILIES = ("Helvetica Neue", "Helvetica", "Arial", "Segoe UI", "Roboto", "DejaVu Sans", "Liberation Sans")
+
+# 逻辑名 -> (优先的家族名, 字重, 要不要能显示中文)；家族都找不到就按字重在能用的字体里挑
+# 要中文的先在能显示中文的字体里挑，一个都没有再用常见的无衬线字体
+LOGICAL = {
+    "sans": (CJK_FAMILIES + LATIN_FAMILIES, 400, True),
+    "sans-bold": (CJK_FAMILIES + LATIN_FAMILIES, 700, True),
+    "sans-light": (CJK_FAMILIES + LATIN_FAMILIES, 300, True),
+    "bolton": (("F37 Bolton",) + LATIN_FAMILIES, 400, False),
+}
+# 用这几个字检查字体能不能显示中文（字符表里都有才算）
+CJK_SAMPLE = "中文水印宇宙"
+# 旧版本模板里写的Windows字体文件 -> 逻辑名
+LEGACY_FILES = {"msyh.ttc": "sans", "msyhbd.ttc": "sans-bold", "msyhl.ttc": "sans-light",
+                "f37bolton-regular.woff2.ttf": "bolton"}
+
+_NAME_FAMILY, _NAME_STYLE, _NAME_TYPO_FAMILY, _NAME_TYPO_STYLE = 1, 2, 16, 17
+
+
+def font_dirs():
+    """
+    :return: 要扫描的字体文件夹，按优先顺序；环境变量 WATERMARK_FONT_DIRS 可以加文件夹（用 os.pathsep 隔开）
+    """
+    dirs = [FONT_DIR]
+    dirs += [d for d in os.environ.get("WATERMARK_FONT_DIRS", "").split(os.pathsep) if d]
+    home = os.path.expanduser("~")
+    if sys.platform == "win32":
+        dirs.append(os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts"))
+        if os.environ.get("LOCALAPPDATA"):
+            dirs.append(os.path.join(os.environ["LOCALAPPDATA"], "Microsoft", "Windows", "Fonts"))
+    elif sys.platform == "darwin":
+        dirs += [os.path.join(home, "Library", "Fonts"), "/Library/Fonts", "/System/Library/Fonts",
+                 "/System/Library/Fonts/Supplemental"]
+    else:
+        data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(home, ".local", "share")
+        dirs += [os.path.join(data_home, "fonts"), os.path.join(home, ".fonts"),
+                 "/usr/local/share/fonts", "/usr/share/fonts"]
+    return dirs
+
+
+def index_path():
+    """
+    :return: 字体索引的保存路径，环境变量 WATERMARK_FONT_INDEX 可以指定
+    """
+    if os.environ.get("WATERMARK_FONT_INDEX"):
+        return os.environ["WATERMARK_FONT_INDEX"]
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "hasselblad_watermark", "font-index.json")
+
+
+def _tables(f, offset):
+    """:return: {表名: (偏移, 长度)}"""
+    f.seek(offset)
+    _, count = struct.unpack(">IH", f.read(6))
+    f.seek(offset + 12)
+    directory = f.read(16 * count)
+    return {directory[i:i + 4].decode("latin-1"): struct.unpack_from(">II", directory, i + 8)
+            for i in range(0, len(directory) - 15, 16)}
+
+
+def _read(f, table):
+    f.seek(table[0])
+    return f.read(table[1])
+
+
+def _names(data):
+    """
+    :return: {名字ID: [各个语言的名字]}，英文的排在最前面
+    """
+    names = {}
+    _, count, strings = struct.unpack_from(">HHH", data, 0)
+    for i in range(count):
+        platform, encoding, language, name_id, length, offset = struct.unpack_from(">6H", data, 6 + i * 12)
+        if name_id not in (_NAME_FAMILY, _NAME_STYLE, _NAME_TYPO_FAMILY, _NAME_TYPO_STYLE):
+            continue
+        raw = data[strings + offset:strings + offset + length]
+        if platform in (0, 3):
+            text = raw.decode("utf-16-be", "replace")
+        elif platform == 1 and encoding == 0:
+            text = raw.decode("latin-1")
+        else:
+            continue
+        english = (platform == 3 and language == 0x409) or (platform == 1 and language == 0)
+        values = names.setdefault(name_id, [])
+        if text in values:
+            continue
+        if english:
+            values.insert(0, text)
+        else:
+            values.append(text)
+    return names
+
+
+def _covers(data, text):
+    """
+    :param data: cmap 表
+    :return: text 里的字是不是都在字符表里（只看 Unicode 的格式4和格式12子表）
+    """
+    _, count = struct.unpack_from(">HH", data, 0)
+    codes = {ord(c) for c in text}
+    for i in range(count):
+        platform, encoding, offset = struct.unpack_from(">HHI", data, 4 + i * 8)
+        if (platform, encoding) not in ((3, 1), (3, 10), (0, 3), (0, 4), (0, 6)):
+            continue
+        fmt = struct.unpack_from(">H", data, offset)[0]
+        if fmt == 4:
+            segments = struct.unpack_from(">H", data, offset + 6)[0] // 2
+            ends = struct.unpack_from(f">{segments}H", data, offset + 14)
+            starts = struct.unpack_from(f">{segments}H", data, offset + 16 + segments * 2)
+            ranges = zip(starts, ends)
+        elif fmt == 12:
+            groups = struct.unpack_from(">I", data, offset + 12)[0]
+            ranges = (struct.unpack_from(">II", data, offset + 16 + j * 12) for j in range(groups))
+        else:
+            continue
+        missing = set(codes)
+        for start, end in ranges:
+            missing = {c for c in missing if not start <= c <= end}
+            if not missing:
+                return True
+    return False
+
+
+def read_faces(path):
+    """
+    只读字体文件头里的几张表，不让 FreeType 加载整个字体
+    :return: [{"path", "index", "family", "families", "style", "weight", "italic", "cjk"}]，.ttc 里每个字体一项
+    """
+    faces = []
+    with open(path, "rb") as f:
+        head = f.read(12)
+        if head[:4] == b"ttcf":
+            count = struct.unpack(">I", head[8:12])[0]
+            offsets = struct.unpack(f">{count}I", f.read(4 * count))
+        else:
+            offsets = (0,)
+        for index, offset in enumerate(offsets):
+            tables = _tables(f, offset)
+            if "name" not in tables:
+                continue
+            names = _names(_read(f, tables["name"]))
+            families = names.get(_NAME_TYPO_FAMILY, []) + names.get(_NAME_FAMILY, [])
+            if not families:
+                continue
+            style = (names.get(_NAME_TYPO_STYLE) or names.get(_NAME_STYLE) or ["Regular"])[0]
+            weight, italic = 400, "italic" in style.lower() or "oblique" in style.lower()
+            if "OS/2" in tables:
+                os2 = _read(f, tables["OS/2"])
+                weight = struct.unpack_from(">H", os2, 4)[0] or 400
+                if len(os2) >= 64:
+                    italic = italic or bool(struct.unpack_from(">H", os2, 62)[0] & 1)
+            cjk = "cmap" in tables and _covers(_read(f, tables["cmap"]), CJK_SAMPLE)
+            faces.append({"path": path, "index": index, "family": families[0], "families": sorted(set(families)),
+                          "style": style, "weight": weight, "italic": italic, "cjk": cjk})
+    return faces
+
+
+def _scan_dir(path, mtime):
+    """:return: 一个文件夹的记录 {"mtime", "subdirs", "fonts"}"""
+    subdirs, fonts = [], []
+    with os.scandir(path) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name.lower().endswith(FONT_EXTENSIONS):
+                try:
+                    fonts += read_faces(entry.path)
+                except (OSError, struct.error, ValueError):
+                    pass  # 损坏的或者不认识的字体文件跳过
+    return {"mtime": mtime, "subdirs": subdirs, "fonts": fonts}
+
+
+def refresh(dirs, old=None):
+    """
+    按文件夹的修改时间更新索引：没变的文件夹直接用记过的，变了的（加了、删了、改名了文件）重扫这一个文件夹
+    :param dirs: font_dirs()
+    :param old: 以前的 {"文件夹": 记录}
+    :return: (新的 {"文件夹": 记录}, 有没有变)
+    """
+    old = old or {}
+    result, changed = {}, False
+    pending = list(reversed(dirs))
+    while pending:
+        path = pending.pop()
+        if path in result:
+            continue
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        entry = old.get(path)
+        if entry is None or entry["mtime"] != mtime:
+            try:
+                entry = _scan_dir(path, mtime)
+            except OSError:
+                continue
+            changed = True
+        result[path] = entry
+        pending.extend(reversed(entry["subdirs"]))
+    return result, changed or set(old) != set(result)
+
+
+class FontIndex:
+    """
+    装了的字体，按文件夹记录；逻辑名、旧的字体路径都在这里换成 (字体文件, .ttc里的序号)
+    """
+
+    def __init__(self, path=None, dirs=None):
+        self.path = path or index_path()
+        self.dirs = dirs or font_dirs()
+        self.entries = {}
+        self._resolved = {}
+
+    def load(self, rebuild=False):
+        """
+        读保存的索引，按文件夹修改时间核对，有变化就写回去
+        :param rebuild: True 就不管保存的索引，全部重扫
+        """
+        old = {}
+        if not rebuild:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    saved = json.load(f)
+                if saved.get("version") == INDEX_VERSION:
+                    old = saved["dirs"]
+            except (OSError, ValueError, KeyError):
+                pass
+        self.entries, changed = refresh(self.dirs, old)
+        if changed or rebuild:
+            self.save()
+        self._resolved = {}
+        return self
+
+    def save(self):
+        # 几个进程可能同时第一次建索引，各写各的临时文件再改名
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": INDEX_VERSION, "dirs": self.entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # 保存不了（比如只读的家目录）下次再扫就是了
+
+    @property
+    def fonts(self):
+        """:return: 所有字体，按 font_dirs() 的优先顺序"""
+        return [font for entry in self.entries.values() for font in entry["fonts"]]
+
+    def resolve(self, name):
+        """
+        :param name: LOGICAL 里的逻辑名，或者字体文件路径
+        :return: (字体文件路径, .ttc里的序号)；一个字体都没有就返回 (None, 0)，用 Pillow 自带的字体
+        """
+        if name not in self._resolved:
+            self._resolved[name] = self._resolve(name)
+        return self._resolved[name]
+
+    def _resolve(self, name):
+        if name not in LOGICAL:
+            if os.path.isfile(name):
+                return name, 0
+            # 别的系统上写死的路径：先按文件名在装了的字体里找，再按旧文件名对应的逻辑名找
+            base = os.path.basename(name.replace("\\", "/")).lower()
+            for font in self.fonts:
+                if os.path.basename(font["path"]).lower() == base:
+                    return font["path"], font["index"]
+            name = LEGACY_FILES.get(base, "sans")
+        families, weight, cjk = LOGICAL[name]
+        fonts = self.fonts
+        wanted = [family.lower() for family in families]
+
+        def rank(font):
+            names = [family.lower() for family in font["families"]]
+            # "Microsoft YaHei Light" 这种把字重写在家族名里的也算 "Microsoft YaHei"
+            family_rank = min((i for i, w in enumerate(wanted) for n in names if n == w or n.startswith(w + " ")),
+                              default=len(wanted))
+            # 先看中文，再看家族，再看字重差多少，再看是不是斜体；都一样就按扫描顺序，结果每次都一样
+            return (cjk and not font["cjk"], family_rank, abs(font["weight"] - weight), font["italic"])
+
+        if not fonts:
+            return None, 0
+        best = min(fonts, key=rank)
+        return best["path"], best["index"]
+
+
+_index = None
+_lock = Lock()
+
+
+def get_index():
+    """
+    :return: 进程内共用的 FontIndex，第一次用时才读
+    """
+    global _index
+    with _lock:
+        if _index is None:
+            _index = FontIndex().load()
+        return _index
+
+
+def resolve(name):
+    """
+    :param name: 逻辑名或者字体文件路径
+    :return: (字体文件路径, .ttc里的序号)，找不到字体是 (None, 0)
+    """
+    return get_index().resolve(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="字体索引：看逻辑名对应哪个字体、重新扫描")
+    parser.add_argument("--list", action="store_true", help="列出所有字体")
+    parser.add_argument("--rebuild", action="store_true", help="不管保存的索引，全部重新扫描")
+    args = parser.parse_args(argv)
+    index = FontIndex().load(args.rebuild)
+    fonts = index.fonts
+    print(f"索引 {index.path}：{len(index.entries)} 个文件夹，{len(fonts)} 个字体")
+    if args.list:
+        for font in fonts:
+            print(f"  {font['family']} {font['style']}（字重{font['weight']}{'，中文' if font['cjk'] else ''}）"
+                  f"  {font['path']}#{font['index']}")
+    for name in LOGICAL:
+        path, number = index.resolve(name)
+        print(f"{name}: {path}#{number}" if path else f"{name}: 没有字体，用 Pillow 自带的")
+
+
+if __name__ == '__main__':
+    main()
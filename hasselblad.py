@@ -1,103 +1,66 @@
 
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from PIL import Image
 import piexif
 import os
 
-
-def add_watermark(jpg_file, camera_name=None, black=False, is_img=False, logo='hasselblad.png'):
+from batch import IncompleteExifError, atomic_write, main, open_source, output_path
+from encoder import extension, file_format, save_canvas, stream_options
+from exif_reader import load as load_exif
+from instrument import stage
+from jpeg_append import save_appended
+from layout import MSYH_BOLD, BottomFrame, Dot, Logo, Template, Text, compile_layout
+from orientation import OrientedCanvas, display_size
+from preview import draft_image
+from rendition import save_renditions
+from stream import StripReader, open_image, save_streamed
+
+# 这个版式必须有的EXIF标签，批处理时先只读文件头检查
+REQUIRED_TAGS = {
+    "Exif": (piexif.ExifIFD.ExposureTime, piexif.ExifIFD.FNumber,
+             piexif.ExifIFD.ISOSpeedRatings, piexif.ExifIFD.FocalLength),
+}
+# 要读的标签 = 必须有的 + 方向
+READ_TAGS = {**REQUIRED_TAGS, "0th": (piexif.ImageIFD.Orientation, piexif.ImageIFD.Model)}
+
+# 版式：照片下面加高12%，左边机型，右边拍摄参数，参数前面是logo和橙点
+TEMPLATE = Template("hasselblad", BottomFrame(1.12), [
+    # 机型
+    # Text("{model}", size=2.6, x=0.5, y=5, font=MSYH_BOLD),
+    Text("Shot on OnePlus 7 Pro", size=2.6, x=0.5, y=5, font=MSYH_BOLD),
+    # 拍摄参数
+    Text("{focal_length}  {aperture}  {shutter_speed}  {iso}", size=1.6, x=9.5, y=7, font=MSYH_BOLD, fill=(79, 79, 79)),
+    # 橙点：往左挪3.25个半径（减去0.75个橙点直径的距离）
+    Dot(radius=0.010, dx=-3.25, y=0.97, dy=-1.7, color=(248, 140, 67)),
+    # logo
+    Logo(height=0.039, dx=-0.1, y=0.952),
+])
+
+
+def add_watermark(jpg_file, camera_name=None, black=False, is_img=False, logo='hasselblad.png', lossless=False, preview=None, stream=None, encoder=None, renditions=None):
     """
     添加水印
     :param logo: 默认相机的logo
     :param camera_name: 手机名称
     :param black: 如果想水印背景是黑色 就填true  默认false
     :param is_img: 如果是单张图片就填True，默认False
+    :param lossless: True 就不重新编码原照片，只在底部无损追加水印条（方向不对、格式不支持时自动退回整张编码）
+    :param preview: 快速预览，填预览图长边的像素数，照片按 1/2、1/4、1/8 直接缩小解码，默认None
+    :param stream: 流式处理的内存上限（MB）：照片按条解码、拼接、编码、写盘，不建整张画布，用来处理几亿像素的全景图，默认None
+    :param encoder: 编码设置名（见 encoder.PROFILES）：draft 样片、match 照抄原图量化表、delivery 交付、webp、png，默认None和以前一样
+    :param renditions: 另外再出哪几种尺寸（长边像素），比如 (2048, 480)，保存成 文件名-2048px.jpg；原照片只解码一次，默认None
     :param jpg_file: 每张图片的路径
     :return: 无（图片直接到本地）
     """
-    background_color = (255, 255, 255) if not black else (0, 0, 0)
-    fill_color = (0, 0, 0) if not black else (255, 255, 255)
-
-    # 读取图片和EXIF信息
+    # 读取图片和EXIF信息（Image.open只读文件头，到下面真正用到像素时才解码）
     image_path = os.path.join(jpg_file[0], jpg_file[1])
-    image = Image.open(image_path)
+    # RAW文件打开的是内嵌的全尺寸JPEG预览
+    source = open_source(image_path)
+    image = open_image(source) if stream else Image.open(source)
     exif_data = image.info.get("exif")
-    data = piexif.load(exif_data)
-
-    # 根据方向信息旋转图片
-    orientation = data["0th"].get(piexif.ImageIFD.Orientation)
-    if orientation is not None and orientation != 1:
-        print(orientation)
-        image = ImageOps.exif_transpose(image)
-    # 获取图片尺寸
-    width, height = image.size
-    # 计算新图片高度 长度+22%
-    new_height = int(height * 1.12)  # 还原竖屏
-    # 创建新的白色背景画布
-    canvas = Image.new("RGB", (width, new_height), background_color)
-    # 将原始图片粘贴到新画布上
-    canvas.paste(image, (0, 0))
-    # 获取新画布的宽高
-    canvas_width, canvas_height = canvas.size
-
-    # 添加文字
-    def add_text(text, size, x, y, font=r"C:\Windows\Fonts\msyh.ttc", fill=fill_color, old_x=False):
-        """
-        :param text: 要添加的文字
-        :param size: 文字大小：按图片高的比例1很小，10和图片水印一样大
-        :param x: 文字在水印的位置，0在最左边 10在最右边
-        :param y: 文字在水印的位置，0在最上面 10在最下面
-        :param fill: 文字颜色 可接收参数格式：(255, 0, 0)# 红色、'#0000FF80'# 半透明蓝色、'black'、# 黑色、(128, 128, 128) # 中灰色
-        :param old_x: 如果是True 表示传入的值是上次返回的，可以直接用的
-        :param font:字体文件路径:
-                    默认微软雅黑细体C:\Windows\Fonts\msyhl.ttc，
-                    微软雅黑常规：C:\Windows\Fonts\msyh.ttc
-                    机型和拍摄参数用微软雅黑粗体
-                    黑体C:\Windows\Fonts\simhei.ttf是小米默认的但是间距很宽
-        :return:x的值
-        """
-        draw = ImageDraw.Draw(canvas)
-        text = text
-        size = int(new_height * 0.01 * size)
-        font = ImageFont.truetype(font, size=size)
-        _, _, text_width, text_height = draw.textbbox((x, y), text, font=font)
-        if not old_x:
-            x = (width - text_width) * 0.1 * x
-        y = height + ((new_height - height) - text_height) * 0.1 * y
-        draw.text((x, y), text, fill=fill, font=font)
-        return x
-
-    def add_dot(x):
-        """
-        :param x: 已经计算好的要贴在目标图片的x轴的坐标
-        :return:
-        """
-        draw = ImageDraw.Draw(canvas)
-        # 设置圆的颜色和半径
-        dot_color = (248, 140, 67)
-        dot_radius = int(canvas_height * 0.010)
-        # 计算圆的左上角和右下角坐标
-        left = int(x - dot_radius * 6 - dot_radius + dot_radius * 3.75)  # 减去0.75个橙点直径的距离
-        top = int(canvas_height * 0.97 - dot_radius * 1.7)
-        right = left + dot_radius * 2
-        bottom = top + dot_radius * 2
-        # 绘制圆形
-        draw.ellipse((left, top, right, bottom), fill=dot_color)
-
-    def add_logo(x):
-        b_img = Image.open(r"watermark/" + logo)
-
-        # 计算b_img缩放后的高度 和 调整b_img大小
-        new_b_height = int(canvas_height * 0.039)
-        b_img = b_img.resize((int(b_img.width * new_b_height / b_img.height), new_b_height))
-
-        # 粘贴b_img到a_img右下角
-        # location = (int(x), int(canvas_height * 0.974 - b_img.size[1]))
-        location = (int(x - b_img.size[0] * 0.1), int(canvas_height * 0.952 - b_img.size[1]))
-        try:
-            canvas.paste(im=b_img, box=location, mask=b_img)  # 参数“mask”来确保透明通道被正确应用,没有该参数透明就会变成黑色
-        except ValueError:
-            canvas.paste(im=b_img, box=location)  # 有些水印没有透明通道
+    with stage("exif", nbytes=len(exif_data or b"")):
+        data = load_exif(exif_data, READ_TAGS)
 
+    # 先检查参数全不全，不全就不用解码像素了
     try:
         # 获取快门速度or曝光时间 [s]
         shutter_speed_value = data["Exif"][piexif.ExifIFD.ExposureTime]
@@ -111,63 +74,48 @@ def add_watermark(jpg_file, camera_name=None, black=False, is_img=False, logo='h
 
         focal_length_value = data["Exif"][piexif.ExifIFD.FocalLength]
         focal_length = f"{round(float(focal_length_value[0]) / float(focal_length_value[1]), 1)}mm"
+        fields = {"focal_length": focal_length, "aperture": aperture, "shutter_speed": shutter_speed, "iso": iso}
+    except KeyError as e:
+        image.close()
+        raise IncompleteExifError(jpg_file[1] + "获取的参数不全") from e
 
+    # 预览模式：在DCT域直接缩小解码，后面的排版都按比例算，和原图效果一致
+    if preview:
+        image = draft_image(image, preview)
 
-        # 机型
-        # x_value = add_text(data["0th"][piexif.ImageIFD.Model].decode('utf-8') if camera_name is None else camera_name,
-        #                    size=2.6, x=0.5, y=5, font=r"C:\Windows\Fonts\msyhbd.ttc")
-        x_value = add_text("Shot on OnePlus 7 Pro",size=2.6, x=0.5, y=5, font=r"C:\Windows\Fonts\msyhbd.ttc")
-        # 拍摄参数
-        x_value = add_text(f"{focal_length}  {aperture}  {shutter_speed}  {iso}", size=1.6, x=9.5, y=7,
-                           font=r"C:\Windows\Fonts\msyhbd.ttc",fill=(79,79,79))
-        # 橙点
-        add_dot(x_value)
-        # logo
-        add_logo(x_value)
-
-    except KeyError:
-        print(jpg_file[1] + "获取的参数不全")
-        return
-
-    # 如果方向标记非1，则调整图像
-    if orientation != 1:
-        # 根据方向标记旋转或翻转图像
-        if orientation == 2:
-            canvas = canvas.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 3:
-            # 上下翻转
-            canvas = canvas.rotate(180)
-        elif orientation == 4:
-            canvas = canvas.transpose(Image.FLIP_TOP_BOTTOM)
-        elif orientation == 5:
-            canvas = canvas.rotate(-90).transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 6:
-            # 旋转
-            canvas = canvas.transpose(Image.ROTATE_90)
-        elif orientation == 7:
-            canvas = canvas.rotate(90).transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 8:
-            canvas = canvas.rotate(90)
-
-    # 保存图片（保留EXIF信息）
-    if is_img:  # 如果是单张图片
-        canvas.save(os.path.join(jpg_file[0], jpg_file[1].replace('.jpg', '-加水印.jpg')), "JPEG", exif=exif_data)
-    else:
-        canvas.save(os.path.join(jpg_file[0] + "加水印", jpg_file[1]), "JPEG", exif=exif_data)
+    # 方向信息：不旋转照片本身，排版都按显示方向算
+    orientation = data["0th"].get(piexif.ImageIFD.Orientation)
+    # 获取图片尺寸（显示方向）
+    width, height = display_size(image.size, orientation)
+    # 按这个尺寸编译好的版式，同尺寸的照片共用
+    plan = compile_layout(TEMPLATE, (width, height), black, logo)
+    # 新画布：原始图片在上面，水印都画在照片下面那一条 band 上
+    # 流式处理：照片按条读，不整张解码
+    reader = StripReader(image, stream) if stream and not preview else None
+    oriented = OrientedCanvas(image, orientation, plan.canvas_size, plan.offset, plan.background_color, reader)
+    # 画水印；连拍时尺寸和参数都一样，直接用缓存里画好的水印条
+    plan.render(oriented, fields)
+
+    # 保存路径：先写临时文件，写完再改名
+    with atomic_write(output_path(jpg_file, is_img, preview, extension(encoder))) as out_path:
+        # 无损模式：原照片不解码也不重新编码，只把水印条接在后面；做不到就走下面的整张编码
+        if lossless and not preview and file_format(encoder) == "JPEG" and save_appended(image, *oriented.stored_band(), out_path):
+            pass
+        # 流式处理：一条条拼好、编码、写盘，不建整张画布
+        elif reader is not None:
+            save_streamed(oriented, reader, out_path, exif_data, stream_options(encoder, image))
+        else:
+            # 照片按存储方向贴上，水印条转回存储方向贴到对应的边，EXIF方向标记保持不变
+            canvas = oriented.finish()
+
+            # 保存图片（保留EXIF信息），按编码设置选质量、格式
+            save_canvas(canvas, out_path, exif_data, encoder, image, orientation)
+
+    # 多尺寸输出：同一次解码一级级缩小，每个尺寸按自己的大小排版；预览、流式处理时不出
+    # 放在原尺寸存完以后：无损模式要先读原图的字节，解码以后文件就关了
+    if renditions and not preview and reader is None:
+        save_renditions(TEMPLATE, image, orientation, fields, renditions, jpg_file, is_img, black, logo, exif_data, encoder)
 
 
 if __name__ == '__main__':
-    folder_path = input('请输入jpg图片或文件夹路径')
-    # 是否是文件夹
-    if os.path.isdir(folder_path):
-        # 要新建文件夹？
-        if not os.path.isdir(folder_path + "加水印"):
-            os.mkdir(folder_path + "加水印")
-        # 拿到文件夹下面的jpg文件直接调用方法
-        [add_watermark([folder_path, f]) for f in os.listdir(folder_path) if f.endswith('.jpg')]
-    # 是否是单个文件
-    elif os.path.isfile(folder_path) and folder_path.endswith('.jpg'):
-        add_watermark([os.path.dirname(folder_path), os.path.basename(folder_path)],
-                      is_img=True)
-    else:
-        print('路径有误')
\ No newline at end of file
+    main(add_watermark, required_tags=REQUIRED_TAGS, template=TEMPLATE)
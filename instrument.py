@@ -0,0 +1,228 @@
+
+# 文件名：分阶段计时
+# 默认关闭：stage() 只返回一个什么都不做的对象；打开后记录每张图每个阶段的耗时、处理的像素和字节，
+# 批处理结束后汇总成直方图，可以导出成JSON lines或者 cProfile/pstats 能读的格式
+
+from collections import defaultdict
+from contextvars import ContextVar
+import json
+import marshal
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+# 当前这张图的记录，None 表示没有打开计时；流水线模式下几张图在不同线程里同时处理，各记各的
+_current = ContextVar("instrument_current", default=None)
+# 正在计时的阶段：阶段里面还套着别的阶段（比如排版时要加载字体、缩放logo），里面那层的时间只算给里面的阶段
+_open_stage = ContextVar("instrument_stage", default=None)
+
+# 直方图的桶（毫秒）
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf"))
+
+
+class _Noop:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _Noop()
+
+
+class _Stage:
+    __slots__ = ("name", "pixels", "nbytes", "path", "start", "nested", "token")
+
+    def __init__(self, name, pixels, nbytes, path):
+        self.name = name
+        self.pixels = pixels
+        self.nbytes = nbytes
+        self.path = path
+        self.nested = 0.0  # 套在里面的阶段用的时间
+
+    def __enter__(self):
+        self.token = _open_stage.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        _open_stage.reset(self.token)
+        parent = _open_stage.get()
+        if parent is not None:
+            parent.nested += seconds
+        if self.path is not None:
+            self.nbytes += _output_size(self.path)
+        # 只记自己的时间，各阶段加起来不会超过整张图的时间
+        add(self.name, seconds - self.nested, self.pixels, self.nbytes)
+        return False
+
+
+def _output_size(path):
+    """
+    :param path: 输出文件路径，流水线模式下也可能是内存里的 BytesIO
+    """
+    if hasattr(path, "getbuffer"):
+        with path.getbuffer() as view:
+            return view.nbytes
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def stage(name, pixels=0, nbytes=0, path=None):
+    """
+    with stage("encode", pixels=w * h, path=out_path): ...
+    :param name: 阶段名
+    :param pixels: 这个阶段处理的像素数
+    :param nbytes: 这个阶段处理的字节数
+    :param path: 结束时把这个文件的大小也算进字节数（比如编码输出）
+    """
+    if _current.get() is None:
+        return _NOOP
+    return _Stage(name, pixels, nbytes, path)
+
+
+def add(name, seconds, pixels=0, nbytes=0):
+    current = _current.get()
+    if current is None:
+        return
+    item = current["stages"].setdefault(name, {"seconds": 0.0, "calls": 0, "pixels": 0, "bytes": 0})
+    item["seconds"] += seconds
+    item["calls"] += 1
+    item["pixels"] += pixels
+    item["bytes"] += nbytes
+
+
+def begin(file_name):
+    """开始记录一张图"""
+    _current.set({"file": file_name, "stages": {}, "start": time.perf_counter()})
+
+
+def end():
+    """
+    :return: 这张图的记录 {"file", "seconds", "stages": {阶段名: {"seconds", "calls", "pixels", "bytes"}}}
+    """
+    record = _current.get()
+    _current.set(None)
+    if record is not None:
+        record["seconds"] = time.perf_counter() - record.pop("start")
+    return record
+
+
+def peak_rss_mb():
+    """
+    :return: 这个进程到目前为止的峰值内存（MB），不支持的系统返回None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    """
+    :return: 这个进程现在占用的内存（MB）；读不到就用峰值代替，都读不到返回None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def percentiles(values):
+    """
+    :return: 毫秒为单位的 p50/p90/p99/平均/最小/最大
+    """
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] * 1000
+
+    return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "mean": sum(values) / len(values) * 1000,
+            "min": values[0] * 1000, "max": values[-1] * 1000}
+
+
+class Report:
+    """一批图片的计时汇总"""
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        if record is not None:
+            self.records.append(record)
+
+    def stages(self):
+        """
+        :return: {阶段名: 每张图在这个阶段的耗时列表（秒）}
+        """
+        result = defaultdict(list)
+        for record in self.records:
+            for name, item in record["stages"].items():
+                result[name].append(item["seconds"])
+        return result
+
+    def histogram(self, values):
+        counts = [0] * len(BUCKETS_MS)
+        for value in values:
+            ms = value * 1000
+            counts[next(i for i, limit in enumerate(BUCKETS_MS) if ms <= limit)] += 1
+        return counts
+
+    def summary(self):
+        if not self.records:
+            return "没有计时记录"
+        total = sum(r["seconds"] for r in self.records)
+        lines = [f"{'阶段':<16}{'总计s':>9}{'占比':>7}{'p50ms':>9}{'p99ms':>9}  直方图(ms<=" +
+                 "/".join(str(b) for b in BUCKETS_MS[:-1]) + "/+)"]
+        stages = self.stages()
+        for name, values in sorted(stages.items(), key=lambda kv: -sum(kv[1])):
+            values = sorted(values)
+            p50 = values[len(values) // 2] * 1000
+            p99 = values[min(len(values) - 1, int(len(values) * 0.99))] * 1000
+            lines.append(f"{name:<16}{sum(values):>9.2f}{sum(values) / total:>7.0%}{p50:>9.1f}{p99:>9.1f}  " +
+                         " ".join(str(c) for c in self.histogram(values)))
+        lines.append(f"{'(每张合计)':<14}{total:>9.2f}")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """
+        按扩展名导出：.prof/.pstats 是 pstats.Stats 能直接读的格式，其他都写成JSON lines
+        """
+        if path.endswith((".prof", ".pstats")):
+            self.write_pstats(path)
+        else:
+            self.write_jsonl(path)
+
+    def write_jsonl(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for record in self.records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write_pstats(self, path):
+        """
+        每个阶段当成一个函数：("watermark", 0, 阶段名)，每张图当作它的调用者，可以用 snakeviz 之类的工具看
+        """
+        stats = {}
+        for record in self.records:
+            caller = ("watermark", 0, record["file"])
+            for name, item in record["stages"].items():
+                key = ("watermark", 0, name)
+                cc, nc, tt, ct, callers = stats.get(key, (0, 0, 0.0, 0.0, {}))
+                calls = item["calls"]
+                callers[caller] = (calls, calls, item["seconds"], item["seconds"])
+                stats[key] = (cc + calls, nc + calls, tt + item["seconds"], ct + item["seconds"], callers)
+            own = record["seconds"] - sum(item["seconds"] for item in record["stages"].values())
+            stats[caller] = (1, 1, max(own, 0.0), record["seconds"], {})
+        with open(path, "wb") as f:
+            marshal.dump(stats, f)
@@ -0,0 +1,209 @@
+
+# 文件名：无损追加水印条
+# 原照片的DCT系数一个字节都不动：只把水印条按原图的量化表、采样方式单独编码，用重启标记（RST）接在原图扫描数据后面
+# 注意不动的是系数，不是解码后的像素：色度下采样（4:2:0等）的照片解码时放大色度会参考下一行，最后一行MCU会受水印条影响
+# 做不到的情况（渐进式、哈夫曼表不一样、水印不在底边、高度不是MCU整数倍……）返回False，由调用方整张重新编码
+
+from io import BytesIO
+import re
+import struct
+
+from PIL import JpegImagePlugin
+
+from instrument import stage
+
+_SOF_BASELINE = (0xC0, 0xC1)
+_DHT, _SOS, _DQT, _DRI, _APP2 = 0xC4, 0xDA, 0xDB, 0xDD, 0xE2
+# 扫描数据里除了 FF00（填充）和 RST 以外的第一个标记就是扫描结束的位置
+_SCAN_END = re.compile(rb"\xff[^\x00\xd0-\xd7]")
+_RST = re.compile(rb"\xff[\xd0-\xd7]")
+
+
+class JpegSegments:
+    """拆开的JPEG：扫描之前的各个段、帧信息、表，和扫描数据的位置"""
+
+    def __init__(self, data, header_only=False):
+        """
+        :param data: JPEG文件的内容
+        :param header_only: True 只解析到SOS为止，data 可以只是文件开头的一段
+        """
+        self.data = data
+        self.segments = []  # (标记, 段开始, 段结束)
+        self.sof_marker = None
+        self.components = []  # SOF里每个分量的 (id, 采样系数, 量化表号)
+        self.scan_tables = []  # SOS里每个分量的 (id, 哈夫曼表号)
+        self.qtables = {}
+        self.htables = {}
+        self.restart_interval = 0
+        self.width = self.height = 0
+        if data[:2] != b"\xff\xd8":
+            raise ValueError("不是JPEG文件")
+        pos = 2
+        while True:
+            if data[pos] != 0xFF:
+                raise ValueError("JPEG段不完整")
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+            end = pos + 2 + length
+            self.segments.append((marker, pos, end))
+            self._read_segment(marker, data[pos + 4:end])
+            pos = end
+            if marker == _SOS:
+                break
+        self.scan_start = pos
+        if header_only:
+            return
+        match = _SCAN_END.search(data, pos)
+        if match is None:
+            raise ValueError("找不到扫描数据的结尾")
+        self.scan_end = match.start()
+        self.end_marker = data[self.scan_end + 1]
+
+    def _read_segment(self, marker, payload):
+        if 0xC0 <= marker <= 0xCF and marker not in (_DHT, 0xC8, 0xCC):
+            self.sof_marker = marker
+            self.height, self.width, count = struct.unpack(">HHB", payload[1:6])
+            self.components = [tuple(payload[6 + i * 3:9 + i * 3]) for i in range(count)]
+        elif marker == _DQT:
+            i = 0
+            while i < len(payload):
+                precision, table = payload[i] >> 4, payload[i] & 0x0F
+                size = 128 if precision else 64
+                self.qtables[table] = payload[i + 1:i + 1 + size]
+                i += 1 + size
+        elif marker == _DHT:
+            i = 0
+            while i < len(payload):
+                total = 17 + sum(payload[i + 1:i + 17])
+                self.htables[payload[i]] = payload[i + 1:i + total]
+                i += total
+        elif marker == _DRI:
+            self.restart_interval = struct.unpack(">H", payload[:2])[0]
+        elif marker == _SOS:
+            count = payload[0]
+            self.scan_tables = [tuple(payload[1 + i * 2:3 + i * 2]) for i in range(count)]
+            self.spectral = tuple(payload[1 + count * 2:4 + count * 2])
+
+    @property
+    def mcu_size(self):
+        if len(self.components) == 1:
+            return 8, 8
+        h = max(c[1] >> 4 for c in self.components)
+        v = max(c[1] & 0x0F for c in self.components)
+        return 8 * h, 8 * v
+
+    def mcu_count(self, height=None):
+        mcu_w, mcu_h = self.mcu_size
+        height = self.height if height is None else height
+        return -(-self.width // mcu_w) * -(-height // mcu_h)
+
+    def used_htables(self):
+        """:return: 扫描里每个分量实际用到的 (DC表内容, AC表内容)"""
+        return [(self.htables.get(t >> 4), self.htables.get(0x10 | (t & 0x0F))) for _, t in self.scan_tables]
+
+    def used_qtables(self):
+        return [(c[1], self.qtables.get(c[2])) for c in self.components]
+
+
+def renumber_rst(scan, shift):
+    """
+    :param scan: 扫描数据
+    :param shift: 所有重启标记的序号加上这个数（可以是负数）
+    :return: 重新编号后的扫描数据
+    """
+    return _RST.sub(lambda m: bytes((0xFF, 0xD0 + (m.group()[1] - 0xD0 + shift) % 8)), scan)
+
+
+def save_appended(image, band, position, out_path):
+    """
+    把水印条无损接到原照片底部
+    :param image: Image.open 打开的原照片（不需要解码像素）
+    :param band: 存储方向的水印条
+    :param position: 水印条在存储方向画布上的左上角
+    :param out_path: 保存路径
+    :return: True 表示已经保存；False 表示这张照片做不到，需要整张重新编码
+    """
+    with stage("lossless", pixels=band.width * band.height, path=out_path):
+        return _append(image, band, position, out_path)
+
+
+def _append(image, band, position, out_path):
+    if image.format != "JPEG" or band.width != image.width or tuple(position) != (0, image.height):
+        return False
+    subsampling = JpegImagePlugin.get_sampling(image)
+    if subsampling == -1 and image.layers != 1:
+        return False
+    try:
+        source = JpegSegments(_read_source(image))
+    except (ValueError, IndexError, struct.error):
+        return False  # Pillow 能打开但这里拆不开的（段之间有填充、没有EOI……），整张重新编码
+    if source.sof_marker not in _SOF_BASELINE or source.end_marker != 0xD9 or source.spectral != (0, 63, 0):
+        return False
+    if len(source.scan_tables) != len(source.components):
+        return False  # 非交织扫描
+    mcu_h = source.mcu_size[1]
+    if source.height % mcu_h or source.height + band.height > 0xFFFF:
+        return False
+
+    # 原图没有重启间隔，就把整幅原图当作一个间隔；有的话原图必须正好是整数个间隔
+    source_mcus = source.mcu_count()
+    interval = source.restart_interval or source_mcus
+    band_mcus = source.mcu_count(band.height)
+    if interval > 0xFFFF or source_mcus % interval:
+        return False
+    if not source.restart_interval and band_mcus > interval:
+        return False
+    intervals = source_mcus // interval
+    if len(_RST.findall(source.data, source.scan_start, source.scan_end)) != intervals - 1:
+        return False
+
+    # 用原图的量化表和采样方式编码水印条
+    buffer = BytesIO()
+    options = {"qtables": image.quantization}
+    if source.restart_interval:
+        options["restart_marker_blocks"] = source.restart_interval
+    if image.layers != 1:
+        options["subsampling"] = subsampling
+    band.convert(image.mode).save(buffer, "JPEG", **options)
+    encoded = JpegSegments(buffer.getvalue())
+    # 同一个扫描里的数据必须用同一套表，逐项比较内容
+    if (encoded.mcu_size != source.mcu_size or encoded.used_qtables() != source.used_qtables()
+            or encoded.used_htables() != source.used_htables()):
+        return False
+
+    data = source.data
+    out = bytearray(data[:2])
+    for marker, start, end in source.segments:
+        segment = data[start:end]
+        if marker == source.sof_marker:
+            segment = segment[:5] + struct.pack(">H", source.height + band.height) + segment[7:]
+        elif marker == _APP2 and segment[4:8] == b"MPF\x00":
+            continue  # 多图信息指向原文件EOI后面的附图，追加后已经不存在了
+        elif marker == _SOS and not source.restart_interval:
+            out += b"\xff\xdd" + struct.pack(">HH", 4, interval)
+        out += segment
+    out += data[source.scan_start:source.scan_end]
+    out += bytes((0xFF, 0xD0 + (intervals - 1) % 8))
+    # 水印条自己的重启标记接着原图的序号往下编
+    out += renumber_rst(encoded.data[encoded.scan_start:encoded.scan_end], intervals)
+    out += b"\xff\xd9"
+    if hasattr(out_path, "write"):
+        out_path.write(out)  # 流水线模式下先写到内存里
+    else:
+        with open(out_path, "wb") as f:
+            f.write(out)
+    return True
+
+
+def _read_source(image):
+    """
+    :return: 原照片文件的全部字节；Image.open 打开的可能是路径，也可能是流水线预读到内存里的文件对象
+    """
+    if image.filename:
+        with open(image.filename, "rb") as f:
+            return f.read()
+    image.fp.seek(0)
+    return image.fp.read()
@@ -0,0 +1,293 @@
+
+# 文件名：版式模板
+# 三种水印都是"扩画布 + 在水印条上按比例摆文字、圆点、竖线、logo"，比例都写在模板里，
+# 按照片的宽高编译一次得到具体的像素位置、字号和缩放好的logo，同尺寸的照片共用
+# 连拍、包围曝光的尺寸和拍摄参数都一样，画好的水印条直接缓存，下一张不用再画文字和logo
+
+from functools import lru_cache
+import importlib.util
+import os
+
+from PIL import Image, ImageDraw
+
+from assets import cache, get_font, get_logo
+from instrument import stage
+
+# 字体逻辑名（见 fonts.py），按系统里装了的字体找文件，优先微软雅黑，没有就用苹方、思源黑体等能显示中文的字体：
+#     细体 "sans-light"，
+#     常规 "sans"
+#     机型和拍摄参数用粗体 "sans-bold"
+#     黑体 simhei.ttf 是小米默认的但是间距很宽
+MSYH = "sans"
+MSYH_BOLD = "sans-bold"
+
+# 版式名 -> 脚本文件
+LAYOUTS = {"hasselblad": "hasselblad.py", "two-line": "1.py", "square": "new.py"}
+
+# 颜色名 -> (白底时的颜色, 黑底时的颜色)；模板里也可以直接写 (r, g, b)
+PALETTE = {
+    "background": ((255, 255, 255), (0, 0, 0)),
+    "fill": ((0, 0, 0), (255, 255, 255)),
+    "small": ((134, 134, 134), (255, 255, 255)),
+    "line": ((211, 211, 211), (51, 51, 51)),
+}
+
+
+def load_layout(name):
+    """1.py 不能直接 import，统一按文件路径加载"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), LAYOUTS[name])
+    spec = importlib.util.spec_from_file_location("layout_" + name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _color(color, black):
+    return PALETTE[color][black] if isinstance(color, str) else color
+
+
+class BottomFrame:
+    """照片在上，画布往下加高到照片高的 ratio 倍，加出来的那一截就是水印条"""
+
+    def __init__(self, ratio):
+        self.ratio = ratio
+
+    def compile(self, width, height):
+        """
+        :return: (画布宽高, 照片左上角, 文字排版用的画布高, 水印条上边)
+        """
+        new_height = int(height * self.ratio)
+        return (width, new_height), (0, 0), new_height, height
+
+
+class SquareFrame:
+    """
+    正方形画布，边长是照片宽的 ratio 倍，照片四周各留 margin/2 倍照片宽
+    水印条从照片下边和画布高 band 倍处里靠上的那个开始（logo可能比照片下边高）
+    """
+
+    def __init__(self, ratio, margin, band):
+        self.ratio = ratio
+        self.margin = margin
+        self.band = band
+
+    def compile(self, width, height):
+        new_height = width * self.ratio
+        side = int(new_height)
+        interval = int(width * self.margin / 2)
+        return (side, side), (interval, interval), new_height, min(height, int(side * self.band))
+
+
+class Text:
+    """一行文字，text 里的 {名字} 渲染时换成对应的拍摄参数"""
+
+    def __init__(self, text, size, y, x=None, font=MSYH, fill="fill"):
+        """
+        :param text: 要添加的文字，可以带 {字段}
+        :param size: 文字大小：按图片高的比例1很小，10和图片水印一样大
+        :param x: 文字在水印的位置，0在最左边 10在最右边；None 表示和上一行文字左对齐
+        :param y: 文字在水印的位置，0在最上面 10在最下面
+        :param font: 字体逻辑名（fonts.LOGICAL），也可以直接写字体文件路径
+        :param fill: 文字颜色：PALETTE 里的颜色名，或者 (128, 128, 128) 这样的颜色
+        """
+        self.text = text
+        self.size = size
+        self.x = x
+        self.y = y
+        self.font = font
+        self.fill = fill
+
+    def format(self, fields):
+        return self.text.format(**fields)
+
+    def compile(self, plan):
+        base = plan.height if plan.text_scale == "photo" else plan.new_height
+        return get_font(self.font, int(base * 0.01 * self.size)), _color(self.fill, plan.black)
+
+    def draw(self, plan, band, resolved, x, text):
+        font, fill = resolved
+        draw = ImageDraw.Draw(band)
+        with stage("text"):
+            # textbbox() 方法返回一个包括文本四个顶点坐标的元组: (左侧x坐标,  顶部y坐标,  右侧x坐标,  底部y坐标)
+            _, _, text_width, text_height = draw.textbbox((x if self.x is None else self.x, self.y), text, font=font)
+            if self.x is not None:
+                x = (plan.width - text_width) * 0.1 * self.x
+            y = plan.height + ((plan.new_height - plan.height) - text_height) * 0.1 * self.y
+            draw.text((x, y - plan.band_top), text, fill=fill, font=font)
+            box = draw.textbbox((x, y - plan.band_top), text, font=font)
+        return x, box
+
+
+class Logo:
+    """缩放到画布高一定比例的logo，下边对齐 y 倍画布高"""
+
+    def __init__(self, height, y, x=None, dx=0.0, dy=0, name=None):
+        """
+        :param height: logo高 = 画布高 * height
+        :param y: logo下边 = 画布高 * y，再往下挪 dy 像素
+        :param x: logo左边 = 画布高 * x；None 表示跟着上一行文字，左边 = 文字x + dx * logo宽
+        :param name: watermark 文件夹下的logo文件名，None 就用 add_watermark 传进来的 logo
+        """
+        self.height = height
+        self.y = y
+        self.x = x
+        self.dx = dx
+        self.dy = dy
+        self.name = name
+
+    def format(self, fields):
+        return None
+
+    def compile(self, plan):
+        canvas_height = plan.canvas_size[1]
+        img, mask = get_logo(self.name or plan.logo, int(canvas_height * self.height))
+        left = None if self.x is None else int(canvas_height * self.x)
+        return img, mask, left, int(canvas_height * self.y - img.size[1]) + self.dy
+
+    def draw(self, plan, band, resolved, x, text):
+        img, mask, left, top = resolved
+        if left is None:
+            left = int(x + self.dx * img.size[0])
+        with stage("logo_paste", pixels=img.width * img.height):
+            band.paste(im=img, box=(left, top - plan.band_top), mask=mask)  # 参数“mask”来确保透明通道被正确应用,没有该参数透明就会变成黑色
+        return x, (left, top - plan.band_top, left + img.width, top - plan.band_top + img.height)
+
+
+class Dot:
+    """跟着上一行文字的圆点：半径 = 画布高 * radius，左边 = 文字x + dx * 半径，上边 = 画布高 * y + dy * 半径"""
+
+    def __init__(self, radius, y, dx=0.0, dy=0.0, color=(248, 140, 67)):
+        self.radius = radius
+        self.y = y
+        self.dx = dx
+        self.dy = dy
+        self.color = color
+
+    def format(self, fields):
+        return None
+
+    def compile(self, plan):
+        canvas_height = plan.canvas_size[1]
+        radius = int(canvas_height * self.radius)
+        return radius, int(canvas_height * self.y + self.dy * radius), _color(self.color, plan.black)
+
+    def draw(self, plan, band, resolved, x, text):
+        radius, top, color = resolved
+        left = int(x + self.dx * radius)
+        box = (left, top - plan.band_top, left + radius * 2, top - plan.band_top + radius * 2)
+        ImageDraw.Draw(band).ellipse(box, fill=color)
+        return x, (box[0], box[1], box[2] + 1, box[3] + 1)
+
+
+class Line:
+    """跟着上一行文字的分割竖线：宽、高按画布高的比例，左边 = 文字x + dx * 线宽，下边 = 画布高 * y"""
+
+    def __init__(self, width, height, y, dx=0.0, color="line"):
+        self.width = width
+        self.height = height
+        self.y = y
+        self.dx = dx
+        self.color = color
+
+    def format(self, fields):
+        return None
+
+    def compile(self, plan):
+        canvas_height = plan.canvas_size[1]
+        size = (int(canvas_height * self.width), int(canvas_height * self.height))
+        return Image.new("RGB", size, color=_color(self.color, plan.black)), int(canvas_height * self.y - size[1])
+
+    def draw(self, plan, band, resolved, x, text):
+        img, top = resolved
+        left = int(x + self.dx * img.size[0])
+        band.paste(im=img, box=(left, top - plan.band_top))
+        return x, (left, top - plan.band_top, left + img.width, top - plan.band_top + img.height)
+
+
+class Template:
+    """一种版式：画布怎么扩（frame），水印条上按顺序画哪些元素"""
+
+    def __init__(self, name, frame, elements, text_scale="canvas"):
+        """
+        :param name: 版式名
+        :param frame: BottomFrame 或 SquareFrame
+        :param elements: Text / Logo / Dot / Line 列表，按顺序画，后面的可以跟着前一行文字的x
+        :param text_scale: 字号按什么算："canvas" 画布高，"photo" 照片高
+        """
+        self.name = name
+        self.frame = frame
+        self.elements = tuple(elements)
+        self.text_scale = text_scale
+
+
+class LayoutPlan:
+    """模板按一种照片尺寸编译好的结果：画布大小、照片位置、水印条位置，以及每个元素的字体、logo和固定坐标"""
+
+    def __init__(self, template, size, black, logo):
+        self.key = (template.name, size, black, logo)
+        self.template = template
+        self.text_scale = template.text_scale
+        self.width, self.height = size
+        self.black = black
+        self.logo = logo
+        self.background_color = _color("background", black)
+        self.canvas_size, self.offset, self.new_height, self.band_top = template.frame.compile(*size)
+        # 照片在水印条里的范围，水印元素碰到照片的话水印条就不能缓存
+        x, y = self.offset
+        self.photo_box = (x, y - self.band_top, x + self.width, y + self.height - self.band_top)
+        self.resolved = [element.compile(self) for element in template.elements]
+        # 水印压在照片上、不能缓存的那些文字组合，下次不用再试
+        self.uncached = set()
+
+    def draw(self, band, texts):
+        """
+        按顺序把所有元素画到水印条上
+        :return: 每个元素占的范围（水印条坐标）
+        """
+        x, boxes = None, []
+        for element, resolved, text in zip(self.template.elements, self.resolved, texts):
+            x, box = element.draw(self, band, resolved, x, text)
+            boxes.append(box)
+        return boxes
+
+    def render(self, oriented, fields):
+        """
+        画水印条；同一尺寸、同样文字的水印条只画一次，之后直接贴缓存的
+        :param oriented: OrientedCanvas
+        :param fields: 填到文字里的拍摄参数
+        :return: 画好的水印条（不要再往上画东西，可能是缓存里的那一份）
+        """
+        texts = tuple(element.format(fields) for element in self.template.elements)
+        key = ("band", self.key, texts)
+        # 流式处理时水印条和照片重叠的话就不缓存，免得为了贴照片再复制一份
+        uncached = texts in self.uncached or (oriented.reader is not None and self.photo_box[3] > 0)
+        band = None if uncached else cache.lookup(key)
+        if band is None and not uncached:
+            band = Image.new("RGB", (self.canvas_size[0], self.canvas_size[1] - self.band_top), self.background_color)
+            if any(_overlaps(box, self.photo_box) for box in self.draw(band, texts)):
+                # 水印压在照片上（比如竖拍的方框版式），只能贴好照片再画
+                band = None
+                self.uncached.add(texts)
+            else:
+                cache.store(key, band, band.width * band.height * 3)
+        result = oriented.new_band(self.band_top, band)
+        if band is None:
+            self.draw(result, texts)
+        return result
+
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+@lru_cache(maxsize=64)
+def compile_layout(template, size, black=False, logo=None):
+    """
+    :param template: Template
+    :param size: 照片显示方向的宽高
+    :param black: 黑底
+    :param logo: 默认logo文件名
+    :return: LayoutPlan，同样的参数只编译一次
+    """
+    with stage("layout"):
+        return LayoutPlan(template, tuple(size), bool(black), logo)
@@ -0,0 +1,177 @@
+
+# 文件名：按EXIF方向直接排版
+# 照片按存储方向原样贴到画布上，只有水印那一条（显示方向下画好）做一次翻转，省掉整幅图的 exif_transpose 和旋转
+
+from PIL import Image
+
+from instrument import stage
+
+# EXIF方向 -> 把存储的像素转成显示方向要做的操作（和 ImageOps.exif_transpose 一样）
+TO_DISPLAY = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# 反过来，从显示方向转回存储方向
+TO_STORED = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_90,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_270,
+}
+# 这些操作会交换宽高
+_SWAP = {Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE,
+         Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270}
+
+
+def display_size(size, orientation):
+    """
+    :param size: 照片存储的宽高
+    :param orientation: EXIF方向，可以是None
+    :return: 显示时的宽高
+    """
+    method = TO_DISPLAY.get(orientation)
+    return (size[1], size[0]) if method in _SWAP else tuple(size)
+
+
+def transpose_box(box, size, method):
+    """
+    算出一个矩形在整幅图做 transpose(method) 之后的位置
+    :param box: (左, 上, 右, 下)
+    :param size: 整幅图原来的宽高
+    :param method: Image.Transpose 里的操作，None 表示不变
+    :return: 变换后的 (左, 上, 右, 下)
+    """
+    if method is None:
+        return tuple(box)
+    w, h = size
+    points = [_transpose_point(x, y, w, h, method) for x, y in ((box[0], box[1]), (box[2], box[3]))]
+    xs, ys = [p[0] for p in points], [p[1] for p in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _transpose_point(x, y, w, h, method):
+    if method == Image.Transpose.FLIP_LEFT_RIGHT:
+        return w - x, y
+    if method == Image.Transpose.FLIP_TOP_BOTTOM:
+        return x, h - y
+    if method == Image.Transpose.ROTATE_90:
+        return y, w - x
+    if method == Image.Transpose.ROTATE_180:
+        return w - x, h - y
+    if method == Image.Transpose.ROTATE_270:
+        return h - y, x
+    if method == Image.Transpose.TRANSPOSE:
+        return y, x
+    return h - y, w - x  # TRANSVERSE
+
+
+class OrientedCanvas:
+    """
+    以存储方向建的画布，排版坐标都按显示方向算
+    水印画在 band（显示方向下 band_top 以下的那一条）上，finish() 时转回存储方向贴回去
+    """
+
+    def __init__(self, image, orientation, size, offset, background_color, reader=None):
+        """
+        :param image: Image.open 打开的照片（还没解码、没转方向）
+        :param orientation: EXIF方向
+        :param size: 显示方向下画布的宽高
+        :param offset: 显示方向下照片左上角在画布上的位置
+        :param background_color: 背景颜色
+        :param reader: stream.StripReader，给了就按条读照片，不整张解码
+        """
+        self.image = image
+        self.reader = reader
+        self.orientation = orientation
+        self.size = tuple(int(v) for v in size)
+        self.offset = offset
+        self.background_color = background_color
+        self.to_display = TO_DISPLAY.get(orientation)
+        self.to_stored = TO_STORED.get(orientation)
+        self.photo_size = display_size(image.size, orientation)
+        self.band_top = self.size[1]
+        self.band = None
+
+    def new_band(self, band_top, background=None):
+        """
+        :param band_top: 显示方向下水印区域的上边，水印不会画到这条线以上
+        :param background: 已经画好水印的水印条（缓存的，不会被修改），None 就新建一条空白的
+        :return: 显示方向的水印条，宽=画布宽，高=画布高-band_top；和照片重叠的部分已经贴好照片
+        """
+        self.band_top = band_top
+        width, height = self.size
+        x, y = self.offset
+        photo_w, photo_h = self.photo_size
+        top, bottom = max(band_top - y, 0), min(photo_h, height - y)
+        with stage("band", pixels=width * (height - band_top)):
+            if background is None:
+                self.band = Image.new("RGB", (width, height - band_top), self.background_color)
+            else:
+                # 要贴照片就复制一份，不然直接用
+                self.band = background.copy() if top < bottom else background
+        # 照片伸进水印条的那几行，只把这一小块转成显示方向贴上去
+        if top < bottom:
+            piece = self.crop(transpose_box((0, top, photo_w, bottom), self.photo_size, self.to_stored))
+            with stage("band", pixels=photo_w * (bottom - top)):
+                if self.to_display is not None:
+                    piece = piece.transpose(self.to_display)
+                self.band.paste(piece, (x, y + top - band_top))
+        return self.band
+
+    def crop(self, box):
+        """
+        :param box: 存储方向照片上的范围
+        :return: 照片的这一块（存储方向）
+        """
+        if self.reader is not None:
+            return self.reader.crop(box)
+        self.load()
+        return self.image.crop(box)
+
+    def load(self):
+        """解码照片像素（只有第一次真正解码）"""
+        with stage("decode", pixels=self.image.width * self.image.height):
+            self.image.load()
+
+    def finish(self):
+        """
+        :return: 存储方向的成品画布，照片像素没有做过任何旋转
+        """
+        self.load()
+        size, photo_position = self.stored_geometry()
+        with stage("canvas", pixels=size[0] * size[1]):
+            canvas = Image.new("RGB", size, self.background_color)
+            canvas.paste(self.image, photo_position)
+        if self.band is not None:
+            band, position = self.stored_band()
+            with stage("canvas", pixels=band.width * band.height):
+                canvas.paste(band, position)
+        return canvas
+
+    def stored_geometry(self):
+        """
+        :return: (存储方向画布的宽高, 照片在上面的左上角)
+        """
+        size = (self.size[1], self.size[0]) if self.to_stored in _SWAP else self.size
+        photo_box = (self.offset[0], self.offset[1],
+                     self.offset[0] + self.photo_size[0], self.offset[1] + self.photo_size[1])
+        return size, transpose_box(photo_box, self.size, self.to_stored)[:2]
+
+    def stored_band(self):
+        """
+        :return: (转回存储方向的水印条, 它在存储方向画布上的左上角)
+        """
+        band = self.band
+        if self.to_stored is not None:
+            with stage("orientation", pixels=band.width * band.height):
+                band = band.transpose(self.to_stored)
+        band_box = (0, self.band_top, self.size[0], self.size[1])
+        return band, transpose_box(band_box, self.size, self.to_stored)[:2]
@@ -0,0 +1,112 @@
+
+# 文件名：流水线批处理
+# 单进程里用 asyncio 把"读文件 → 解码、排版、编码 → 写盘"接成流水线：后台预读后面几张原图，
+# 中间在线程池里处理（Pillow 解码、编码时会释放GIL），编码好的结果交给后台写盘，编码时磁盘不再闲着
+# 各阶段之间的队列都有长度上限，读得再快内存里也只有有限几张图
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+
+import batch
+import raw_preview
+
+# 队列里表示"没有了"
+_DONE = None
+
+
+def _read(path):
+    if raw_preview.is_raw(path):
+        # RAW只读出内嵌的JPEG预览，不把整个文件读进内存
+        return raw_preview.preview_jpeg(path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write(path, data):
+    with batch.atomic_write(path) as tmp:
+        with open(tmp, "wb") as f:
+            f.write(data)
+
+
+def _render(func, folder_path, file_name, data, kwargs, profile):
+    """
+    在线程池里处理一张图：原图从内存里读，结果编码到内存里，不碰磁盘
+    :return: (和 batch._process_one 一样的结果, [(保存路径, 编码好的字节)])
+    """
+    job = {"source": data, "outputs": []}
+    batch.current_job.set(job)
+    return batch._process_one(func, folder_path, file_name, kwargs, profile), job["outputs"]
+
+
+async def _run(func, folder_path, files, kwargs, threads, prefetch, profile, on_done):
+    loop = asyncio.get_running_loop()
+    read_queue = asyncio.Queue(prefetch)
+    write_queue = asyncio.Queue(prefetch)
+    # 读和写各占一个线程，互不等待
+    with ThreadPoolExecutor(threads) as workers, ThreadPoolExecutor(2) as io:
+        async def read_all():
+            for file_name in files:
+                try:
+                    data = await loop.run_in_executor(io, _read, os.path.join(folder_path, file_name))
+                except (OSError, raw_preview.NoPreviewError):
+                    data = None  # 读不了就让 add_watermark 自己打开，报出原来的错误
+                await read_queue.put((file_name, data))
+            for _ in range(threads):
+                await read_queue.put(_DONE)
+
+        async def process():
+            while True:
+                item = await read_queue.get()
+                if item is _DONE:
+                    return
+                file_name, data = item
+                # 每张图在自己的上下文里跑，计时记录和 current_job 互不干扰
+                context = contextvars.copy_context()
+                result = await loop.run_in_executor(workers, context.run, _render,
+                                                    func, folder_path, file_name, data, kwargs, profile)
+                await write_queue.put(result)
+
+        async def write_all():
+            while True:
+                item = await write_queue.get()
+                if item is _DONE:
+                    return
+                outcome, outputs = item
+                try:
+                    for path, data in outputs:
+                        await loop.run_in_executor(io, _write, path, data)
+                except OSError as e:
+                    outcome = (outcome[0], str(e)) + outcome[2:]
+                on_done(outcome)
+
+        writer = asyncio.create_task(write_all())
+        await asyncio.gather(read_all(), *(process() for _ in range(threads)))
+        await write_queue.put(_DONE)
+        await writer
+
+
+def run_pipeline(func, folder_path, files, kwargs, threads=None, prefetch=4, profile=False, on_done=None):
+    """
+    在当前进程里用流水线批量加水印，输出和逐张调用 add_watermark 完全一样
+    :param func: 各脚本里的 add_watermark
+    :param folder_path: 图片所在文件夹
+    :param files: 要处理的文件名列表
+    :param kwargs: 原样传给 func 的参数
+    :param threads: 同时解码、排版、编码几张，默认等于CPU核数
+    :param prefetch: 预读几张原图，也是等着写盘的最多几张
+    :param profile: True 就记录每张图每个阶段的耗时
+    :param on_done: 每张图写完后用 batch._process_one 格式的结果调用一次
+    :return: 所有结果，按写完的顺序
+    """
+    threads = threads or os.cpu_count() or 1
+    outcomes = []
+
+    def done(outcome):
+        outcomes.append(outcome)
+        if on_done is not None:
+            on_done(outcome)
+
+    asyncio.run(_run(func, folder_path, files, kwargs, threads, max(1, prefetch), profile, done))
+    return outcomes
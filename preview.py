@@ -0,0 +1,57 @@
+
+# 文件名：快速预览
+# 用JPEG的draft在DCT域直接按 1/2、1/4、1/8 缩小解码，排版的比例和原图完全一样，用来先看效果
+
+import math
+import os
+
+from PIL import Image, ImageOps
+
+from instrument import stage
+
+# 预览图放在 文件夹 + PREVIEW_SUFFIX 里
+PREVIEW_SUFFIX = "加水印预览"
+
+
+def draft_image(image, max_px):
+    """
+    :param image: Image.open 打开、还没解码的照片
+    :param max_px: 预览图长边最多多少像素
+    :return: 缩小后的照片，长边不超过 max_px
+    """
+    scale = max(image.size) / max_px
+    if scale <= 1:
+        return image
+    target = (math.ceil(image.width / scale), math.ceil(image.height / scale))
+    # draft 只能按2的幂缩小，解码出来的尺寸不小于target
+    image.draft(image.mode, target)
+    if max(image.size) > max_px:
+        with stage("decode", pixels=image.width * image.height):
+            image = image.resize(target, Image.Resampling.BILINEAR)
+    return image
+
+
+def proof_sheet(paths, out_path, columns=4, cell=480, background_color=(240, 240, 240)):
+    """
+    把预览图拼成一张样张，方便一次看完整个文件夹
+    :param paths: 预览图路径
+    :param out_path: 样张保存路径
+    :param columns: 每行几张
+    :param cell: 每格的边长（像素）
+    :return: 样张路径，没有图就返回None
+    """
+    if not paths:
+        return None
+    rows = math.ceil(len(paths) / columns)
+    gap = cell // 20
+    sheet = Image.new("RGB", (columns * (cell + gap) + gap, rows * (cell + gap) + gap), background_color)
+    for i, path in enumerate(paths):
+        with Image.open(path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((cell, cell))
+            left = gap + (i % columns) * (cell + gap) + (cell - img.width) // 2
+            top = gap + (i // columns) * (cell + gap) + (cell - img.height) // 2
+            sheet.paste(img, (left, top))
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    sheet.save(out_path, "JPEG", quality=85)
+    return out_path
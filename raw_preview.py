@@ -0,0 +1,204 @@
+
+# 文件名：RAW内嵌预览
+# DNG和大多数基于TIFF的RAW（NEF、ARW、CR2、PEF、哈苏3FR/FFF……）里都存着一张全尺寸的JPEG预览和完整的EXIF，
+# 不用解马赛克：在TIFF的各个IFD里找到最大的那张JPEG预览，把RAW的EXIF塞进去，当成普通jpg交给各版式处理
+
+import mmap
+import struct
+
+import piexif
+
+from exif_reader import JpegHeader, load as load_exif
+from jpeg_append import JpegSegments
+
+# 按扩展名认RAW文件（小写）
+RAW_EXTENSIONS = (".dng", ".tif", ".tiff", ".nef", ".arw", ".cr2", ".pef", ".3fr", ".fff")
+
+# 复制到输出照片里的标签，格式同 exif_reader.DEFAULT_TAGS
+COPY_TAGS = {
+    "0th": (piexif.ImageIFD.Make, piexif.ImageIFD.Model, piexif.ImageIFD.Orientation, piexif.ImageIFD.DateTime,
+            piexif.ImageIFD.Artist, piexif.ImageIFD.Copyright),
+    "Exif": (piexif.ExifIFD.ExposureTime, piexif.ExifIFD.FNumber, piexif.ExifIFD.ISOSpeedRatings,
+             piexif.ExifIFD.FocalLength, piexif.ExifIFD.FocalLengthIn35mmFilm, piexif.ExifIFD.ExposureBiasValue,
+             piexif.ExifIFD.ExposureProgram, piexif.ExifIFD.DateTimeOriginal, piexif.ExifIFD.LensModel),
+    "GPS": (piexif.GPSIFD.GPSLatitudeRef, piexif.GPSIFD.GPSLatitude, piexif.GPSIFD.GPSLongitudeRef,
+            piexif.GPSIFD.GPSLongitude, piexif.GPSIFD.GPSAltitudeRef, piexif.GPSIFD.GPSAltitude),
+}
+
+_SUB_IFDS = 0x014A
+_COMPRESSION, _STRIP_OFFSETS, _STRIP_BYTE_COUNTS = 0x0103, 0x0111, 0x0117
+_JPEG_OFFSET, _JPEG_LENGTH = 0x0201, 0x0202
+# 预览可能用的压缩方式：6 旧式JPEG，7 JPEG（DNG的原始数据也可能是7，但那是无损JPEG，SOF不一样）
+_JPEG_COMPRESSION = (6, 7)
+# 能当预览用的JPEG：基线、扩展、渐进（SOF3 是DNG原始数据用的无损JPEG）
+_PREVIEW_SOF = (0xC0, 0xC1, 0xC2)
+# 最多找多少个IFD，防止损坏的文件里IFD互相指向死循环
+_MAX_IFDS = 64
+
+
+class NoPreviewError(Exception):
+    """RAW文件里找不到能用的内嵌JPEG预览"""
+
+
+def is_raw(path):
+    """
+    :param path: 文件路径或文件名
+    """
+    return path.lower().endswith(RAW_EXTENSIONS)
+
+
+def _endian(tiff):
+    if tiff[:4] in (b"II*\x00", b"IIRO", b"IIU\x00"):
+        return "<"
+    if tiff[:4] == b"MM\x00*":
+        return ">"
+    raise NoPreviewError("不是TIFF结构的RAW文件")
+
+
+def _unpack(tiff, fmt, offset, size=None):
+    """
+    struct.unpack_from，越过文件结尾（文件被截断、偏移是乱的）就报 NoPreviewError
+    :param size: fmt 占的字节数，默认 struct.calcsize(fmt)
+    """
+    size = struct.calcsize(fmt) if size is None else size
+    if offset < 0 or offset + size > len(tiff):
+        raise NoPreviewError("RAW文件不完整或者已经损坏")
+    return struct.unpack_from(fmt, tiff, offset)
+
+
+def _values(tiff, entry, endian):
+    """:return: IFD里一项的所有整数值（只处理 SHORT、LONG、IFD 这几种类型）"""
+    value_type, count = _unpack(tiff, endian + "HI", entry + 2)
+    fmt = {3: "H", 4: "I", 13: "I"}.get(value_type)
+    if fmt is None:
+        return ()
+    size = count * struct.calcsize(fmt)
+    if size > 4:
+        pointer = _unpack(tiff, endian + "I", entry + 8)[0]
+    else:
+        pointer = entry + 8
+    # 先按字节数检查，损坏的个数可能有几十亿，不能先拼格式字符串
+    if pointer + size > len(tiff):
+        raise NoPreviewError("RAW文件不完整或者已经损坏")
+    return _unpack(tiff, endian + fmt * count, pointer, size)
+
+
+def _jpeg_candidates(tiff, endian):
+    """
+    把IFD0开始的链和各级SubIFD都走一遍
+    :return: [(JPEG在文件里的开始, 长度)]
+    """
+    found, seen = [], set()
+    pending = [_unpack(tiff, endian + "I", 4)[0]]
+    while pending and len(seen) < _MAX_IFDS:
+        offset = pending.pop()
+        if not offset or offset in seen or offset + 2 > len(tiff):
+            continue
+        seen.add(offset)
+        tags = {}
+        try:
+            count = _unpack(tiff, endian + "H", offset)[0]
+            for i in range(count):
+                entry = offset + 2 + i * 12
+                tags[_unpack(tiff, endian + "H", entry)[0]] = _values(tiff, entry, endian)
+            pending.append(_unpack(tiff, endian + "I", offset + 2 + count * 12)[0])
+        except NoPreviewError:
+            pass  # IFD被截断了，用已经读到的
+        pending.extend(tags.get(_SUB_IFDS, ()))
+        if tags.get(_JPEG_OFFSET) and tags.get(_JPEG_LENGTH):
+            found.append((tags[_JPEG_OFFSET][0], tags[_JPEG_LENGTH][0]))
+        elif (tags.get(_COMPRESSION, (0,))[0] in _JPEG_COMPRESSION and len(tags.get(_STRIP_OFFSETS, ())) == 1
+              and tags.get(_STRIP_BYTE_COUNTS)):
+            found.append((tags[_STRIP_OFFSETS][0], tags[_STRIP_BYTE_COUNTS][0]))
+    return found
+
+
+def _find_preview(tiff, endian):
+    """
+    :return: (最大的那张JPEG预览的开始, 长度, JpegSegments 解析出的文件头)
+    """
+    best = None
+    for start, length in _jpeg_candidates(tiff, endian):
+        data = tiff[start:start + length]
+        try:
+            jpeg = JpegSegments(data, header_only=True)
+        except (IndexError, struct.error, ValueError):
+            continue
+        if jpeg.sof_marker not in _PREVIEW_SOF or len(jpeg.components) not in (1, 3):
+            continue
+        if best is None or jpeg.width * jpeg.height > best[2].width * best[2].height:
+            best = (start, length, jpeg)
+    if best is None:
+        raise NoPreviewError("RAW文件里没有内嵌的JPEG预览")
+    return best
+
+
+def _exif(tiff):
+    """
+    :return: 从RAW里挑出 COPY_TAGS 重新打包的EXIF（以 b"Exif\\0\\0" 开头，和 Image.info["exif"] 一样）
+    """
+    data = load_exif(tiff, COPY_TAGS)
+    # 有的RAW里个别标签的类型和标准不一样，piexif 打包不了的就扔掉
+    for ifd in ("0th", "Exif", "GPS"):
+        for tag, value in list(data[ifd].items()):
+            try:
+                piexif.dump({ifd: {tag: value}})
+            except (ValueError, TypeError, struct.error):
+                del data[ifd][tag]
+    return piexif.dump(data)
+
+
+def _with_exif(data, exif):
+    """
+    :return: 把原来的EXIF段换成 exif 之后的JPEG
+    """
+    jpeg = JpegSegments(data, header_only=True)
+    out = bytearray(data[:2])
+    out += b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+    for marker, start, end in jpeg.segments:
+        if marker == 0xE1 and data[start + 4:start + 10] == b"Exif\x00\x00":
+            continue
+        out += data[start:end]
+    out += data[jpeg.scan_start:]
+    return bytes(out)
+
+
+def extract_preview(tiff):
+    """
+    :param tiff: RAW文件的全部内容（bytes 或 mmap）
+    :return: 带着RAW的EXIF的全尺寸JPEG预览
+    """
+    _, _, jpeg = _find_preview(tiff, _endian(tiff))
+    return _with_exif(jpeg.data, _exif(tiff))
+
+
+def _open(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def preview_jpeg(source):
+    """
+    :param source: RAW文件路径，或者已经读进内存的文件内容
+    :return: 带着RAW的EXIF的全尺寸JPEG预览（bytes）
+    """
+    if isinstance(source, str):
+        # 只映射不整个读进来，真正读到的只有各个IFD和预览那一段
+        with _open(source) as tiff:
+            return extract_preview(tiff)
+    return extract_preview(source)
+
+
+def read_header(path):
+    """
+    和 exif_reader.read_header 一样只读文件头，宽高、采样是内嵌预览的
+    :return: exif_reader.JpegHeader
+    """
+    with _open(path) as tiff:
+        _, _, jpeg = _find_preview(tiff, _endian(tiff))
+        header = JpegHeader()
+        header.width, header.height = jpeg.width, jpeg.height
+        header.components = len(jpeg.components)
+        header.sampling = [(c[1] >> 4, c[1] & 0x0F) for c in jpeg.components]
+        header.exif = _exif(tiff)
+    return header
@@ -0,0 +1,79 @@
+
+# 文件名：多尺寸输出
+# 交付时每张照片要原图、网页图、缩略图好几种尺寸：不再对加好水印的大图重新解码、缩小，
+# 原照片只解码一次，按尺寸从大到小用 reduce() 一级级缩下去（小图从上一级缩，不从原图缩），
+# 每种尺寸的水印条都按自己的尺寸重新排版、画字，文字不是从大图缩小来的，小图上也清楚
+
+import os
+
+from PIL import Image
+
+from batch import atomic_write, output_path
+from encoder import extension, save_canvas
+from instrument import stage
+from layout import compile_layout
+from orientation import OrientedCanvas, display_size
+
+# 先用 reduce() 按整数倍缩到目标的 REDUCING_GAP 倍左右，剩下的再用双三次精确缩放；和 Image.thumbnail 的默认做法一样
+REDUCING_GAP = 2.0
+
+
+def rendition_name(file_name, max_px):
+    """
+    :return: 这个尺寸的文件名，比如 a.jpg -> a-2048px.jpg
+    """
+    name, ext = os.path.splitext(file_name)
+    return f"{name}-{max_px}px{ext}"
+
+
+def reduce_to(image, max_px):
+    """
+    :param image: 已经解码的照片（存储方向）
+    :param max_px: 长边最多多少像素
+    :return: 缩小后的照片，本来就不超过 max_px 的原样返回
+    """
+    scale = max_px / max(image.size)
+    if scale >= 1:
+        return image
+    target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    with stage("resize", pixels=image.width * image.height):
+        factor = int(1 / (scale * REDUCING_GAP))
+        if factor > 1:
+            image = image.reduce(factor)
+        return image.resize(target, Image.Resampling.BICUBIC)
+
+
+def cascade(image, sizes):
+    """
+    :param image: 已经解码的照片
+    :param sizes: 各个尺寸的长边像素
+    :return: 从大到小 [(长边像素, 缩好的照片)]，每一级都从上一级缩
+    """
+    photo = image
+    for max_px in sorted(set(sizes), reverse=True):
+        photo = reduce_to(photo, max_px)
+        yield max_px, photo
+
+
+def save_renditions(template, image, orientation, fields, sizes, jpg_file, is_img=False, black=False, logo=None,
+                    exif=None, encoder=None):
+    """
+    按每个尺寸重新排版、画水印并保存
+    :param template: 各脚本的 TEMPLATE
+    :param image: Image.open 打开的原照片，只解码这一次
+    :param orientation: EXIF方向
+    :param fields: 水印文字的字段
+    :param sizes: 各个尺寸的长边像素
+    :param jpg_file: [文件夹, 文件名]，保存路径同 batch.output_path，文件名加上尺寸
+    :param exif: 原照片的EXIF，原样写进每个尺寸
+    :param encoder: 编码设置名
+    """
+    with stage("decode", pixels=image.width * image.height):
+        image.load()
+    for max_px, photo in cascade(image, sizes):
+        plan = compile_layout(template, display_size(photo.size, orientation), black, logo)
+        oriented = OrientedCanvas(photo, orientation, plan.canvas_size, plan.offset, plan.background_color)
+        plan.render(oriented, fields)
+        path = output_path([jpg_file[0], rendition_name(jpg_file[1], max_px)], is_img, extension=extension(encoder))
+        with atomic_write(path) as out_path:
+            save_canvas(oriented.finish(), out_path, exif, encoder, image, orientation)
@@ -0,0 +1,215 @@
+
+# 文件名：按内存排队
+# 1200万像素的手机照片和1亿像素的中画幅混在一个文件夹里：进程开多了大图一起来会把内存撑爆，开少了小图时核又闲着
+# 每张图的峰值内存基本和像素数成正比（解码的照片 + 画布 + 水印条，Pillow 的RGB每像素占4字节），JPEG文件头就有宽高
+# 这里先只读文件头估算每张图要多少内存，总数不超过给定的预算才放进进程池；从大到小排，
+# 大图占着内存时用放得下的小图把空闲的进程填满；单张就超预算的照片改用流式处理（--stream）
+# 结束时报告内存预算和进程的平均利用率
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import inspect
+import os
+import time
+
+import piexif
+
+from assets import cache
+import batch
+from encoder import can_stripe, encode_threads, file_format, save_options
+import exif_reader
+from orientation import TO_DISPLAY, display_size
+import raw_preview
+from raw_preview import NoPreviewError
+
+MB = 1024 * 1024
+# 解码后每个像素占的字节数（Pillow 的 RGB 按4字节存）
+PIXEL_BYTES = 4
+# 估算之外的零碎（编码缓冲、文字、logo、内存碎片）按20%算
+SLACK = 1.2
+# 每个工作进程不处理照片时也要占的内存：Python 和 Pillow 本身约40MB，再加上字体、logo、水印条缓存的上限
+PROCESS_BASE_MB = 40
+# 流式处理本身至少要留这么多内存给按条解码、编码
+MIN_STREAM_MB = 64
+
+
+def worker_reserve_mb():
+    """
+    :return: 每个工作进程固定要留的内存（MB）
+    """
+    return PROCESS_BASE_MB + cache.max_bytes / MB
+
+
+def _read_header(path):
+    return raw_preview.read_header(path) if raw_preview.is_raw(path) else exif_reader.read_header(path)
+
+
+def estimate_mb(header, template=None, options=None):
+    """
+    按文件头里的宽高估算处理这张图的峰值内存（不含进程本身）
+    :param header: exif_reader.JpegHeader
+    :param template: 各脚本的 TEMPLATE，用它的画布算法算画布和水印条的大小；None 就按画布比照片大25%算
+    :param options: 传给 add_watermark 的参数（preview、stream、encoder、renditions 会影响内存）
+    :return: MB
+    """
+    options = options or {}
+    if options.get("stream"):
+        # 流式处理整个进程都不超过给定的MB数
+        return max(0, options["stream"] - worker_reserve_mb())
+    orientation = exif_reader.load(header.exif, {"0th": (piexif.ImageIFD.Orientation,)})["0th"].get(
+        piexif.ImageIFD.Orientation)
+    width, height = display_size((header.width or 0, header.height or 0), orientation)
+    if options.get("preview") and max(width, height) > options["preview"]:
+        # 预览按 1/2、1/4、1/8 缩小解码，最多是目标的2倍
+        scale = min(1, 2 * options["preview"] / max(width, height))
+        width, height = int(width * scale), int(height * scale)
+    pixels = width * height
+    if template is not None:
+        (canvas_width, canvas_height), _, _, band_top = template.frame.compile(width, height)
+    else:
+        canvas_width, canvas_height, band_top = width, int(height * 1.25), height
+    canvas = canvas_width * canvas_height
+    band = canvas_width * max(0, canvas_height - int(band_top))
+    nbytes = pixels + canvas + band
+    fmt = file_format(options.get("encoder"))
+    if TO_DISPLAY.get(orientation) is not None:
+        nbytes += band  # 水印条转回存储方向
+        if fmt != "JPEG":
+            nbytes += canvas  # WebP、PNG 整张转成显示方向
+    if encode_threads() > 1 and can_stripe((canvas_width, canvas_height), fmt, save_options(options.get("encoder"))):
+        nbytes += canvas / 2  # 分条并行编码时几个线程各自拷一条，最多半张画布
+    for max_px in options.get("renditions") or ():
+        # 每个尺寸一张缩小的照片和画布，从大到小依次做，按最大的一张算
+        scale = min(1, max_px / max(width, height, 1))
+        nbytes += (pixels + canvas) * scale * scale
+        break
+    return nbytes * PIXEL_BYTES * SLACK / MB
+
+
+class Job:
+    """一张要处理的照片"""
+
+    def __init__(self, file_name, pixels, memory_mb, options, streamed=False):
+        self.file_name = file_name
+        self.pixels = pixels
+        self.memory_mb = memory_mb
+        self.options = options  # 传给 add_watermark 的参数
+        self.streamed = streamed  # 超预算，改用了流式处理
+
+
+def pool_size(workers, budget_mb, count):
+    """
+    工作进程本身的内存也算在预算里，预算太小就少开几个进程
+    :param workers: 最多开几个进程
+    :param count: 一共几张图
+    """
+    return max(1, min(workers, int(budget_mb // (worker_reserve_mb() + MIN_STREAM_MB)), count))
+
+
+def available_mb(budget_mb, workers):
+    """
+    :return: 扣掉各个进程本身的内存以后，留给照片的预算（MB）
+    """
+    return budget_mb - workers * worker_reserve_mb()
+
+
+def plan_jobs(func, folder_path, files, budget_mb, workers=1, template=None, options=None):
+    """
+    读文件头估算每张图的内存，按内存从大到小排好
+    单张就超过预算的照片：支持流式处理就改用流式处理，只占一半预算，另一半留给小图；不支持的只能单独运行
+    :param workers: pool_size 的结果
+    :return: [Job]
+    """
+    options = options or {}
+    accepted = inspect.signature(func).parameters
+    available = available_mb(budget_mb, workers)
+    can_stream = ("stream" in accepted and not options.get("preview") and not options.get("renditions")
+                  and file_format(options.get("encoder")) == "JPEG")
+    jobs = []
+    for file_name in files:
+        try:
+            header = _read_header(os.path.join(folder_path, file_name))
+        except (OSError, ValueError, NoPreviewError):
+            jobs.append(Job(file_name, 0, 0, options))  # 读不了文件头，交给 add_watermark 报错
+            continue
+        memory_mb = estimate_mb(header, template, options)
+        if memory_mb > available and can_stream and not options.get("stream"):
+            # stream 是整个进程的上限，要加上进程本身的内存
+            streamed = {**options, "stream": int(worker_reserve_mb() + max(MIN_STREAM_MB, available / 2))}
+            jobs.append(Job(file_name, header.pixels, estimate_mb(header, template, streamed), streamed, True))
+        else:
+            jobs.append(Job(file_name, header.pixels, memory_mb, options))
+    jobs.sort(key=lambda job: (-job.memory_mb, -job.pixels, job.file_name))
+    return jobs
+
+
+class Utilization:
+    """按时间加权统计：预估占用的内存占预算的比例、忙着的进程占总进程数的比例"""
+
+    def __init__(self, budget_mb, workers):
+        self.budget_mb = budget_mb
+        self.workers = workers
+        self.peak_mb = 0.0
+        self.over_budget = 0  # 超过预算、只能单独运行的照片
+        self.streamed = 0  # 超过预算、改用流式处理的照片
+        self._memory_seconds = 0.0
+        self._busy_seconds = 0.0
+        self._start = self._last = time.perf_counter()
+        self._memory_mb = 0.0
+        self._busy = 0
+
+    def update(self, memory_mb, busy):
+        now = time.perf_counter()
+        self._memory_seconds += self._memory_mb * (now - self._last)
+        self._busy_seconds += self._busy * (now - self._last)
+        self._last = now
+        self._memory_mb, self._busy = memory_mb, busy
+        self.peak_mb = max(self.peak_mb, memory_mb)
+
+    def summary(self):
+        elapsed = (self._last - self._start) or 1e-9
+        text = (f"内存预算 {self.budget_mb:.0f}MB：平均占用 {self._memory_seconds / elapsed / self.budget_mb:.0%}，"
+                f"峰值 {self.peak_mb / self.budget_mb:.0%}；{self.workers} 个进程平均忙 "
+                f"{self._busy_seconds / elapsed / self.workers:.0%}")
+        if self.streamed:
+            text += f"；{self.streamed} 张超预算改用流式处理"
+        if self.over_budget:
+            text += f"；{self.over_budget} 张超预算单独运行"
+        return text
+
+
+def run_scheduled(func, folder_path, jobs, workers, budget_mb, profile=False, on_done=None):
+    """
+    按内存预算把照片放进进程池：能放下的最大的一张先放，放不下就等有照片处理完
+    :param jobs: plan_jobs 的结果
+    :param workers: pool_size 的结果，最多同时处理几张
+    :param budget_mb: 整批（所有工作进程加起来）的内存预算
+    :param on_done: 每张图处理完用 batch._process_one 格式的结果调用一次
+    :return: Utilization
+    """
+    available = available_mb(budget_mb, workers)
+    usage = Utilization(budget_mb, workers)
+    usage.streamed = sum(job.streamed for job in jobs)
+    pending = list(jobs)
+    running = {}  # future -> Job
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            used = sum(job.memory_mb for job in running.values())
+            while pending and len(running) < workers:
+                job = next((job for job in pending if used + job.memory_mb <= available), None)
+                if job is None:
+                    if running:
+                        break
+                    job = pending[0]  # 一个进程都没在跑还是放不下：单独运行
+                    usage.over_budget += 1
+                pending.remove(job)
+                future = executor.submit(batch._process_one, func, folder_path, job.file_name, job.options, profile)
+                running[future] = job
+                used += job.memory_mb
+            usage.update(workers * worker_reserve_mb() + used, len(running))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                if on_done is not None:
+                    on_done(future.result())
+    usage.update(workers * worker_reserve_mb(), 0)
+    return usage
@@ -0,0 +1,245 @@
+
+# 文件名：内存接口和本地渲染服务
+# 网页上传的照片要现加水印：render_bytes 直接吃JPEG字节、吐出加好水印的字节，不落临时文件；
+# service 常驻一个进程，字体、logo、画好的水印条在请求之间一直缓存着，用线程池渲染并限制同时处理的请求数
+# 用法：python service.py --port 8000 -j 4
+#       curl --data-binary @a.jpg "http://127.0.0.1:8000/render/hasselblad?black=1" -o a-加水印.jpg
+#       curl http://127.0.0.1:8000/stats
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+
+from assets import cache, logo_names
+import batch
+from batch import IncompleteExifError
+from encoder import PROFILES, THREADS_ENV, file_format
+from instrument import percentiles
+from layout import LAYOUTS, load_layout
+import raw_preview
+from raw_preview import NoPreviewError
+
+# 格式 -> HTTP的 Content-Type
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+# 这些参数按整数解析，其他的按 add_watermark 默认值的类型（布尔）或者字符串
+_INT_OPTIONS = ("preview",)
+# 不能从请求里传的参数：路径由接口自己定，流式处理要直接写盘，一个请求只返回一张图
+_RESERVED_OPTIONS = ("jpg_file", "is_img", "stream", "renditions")
+
+
+def render_bytes(func, data, name="upload.jpg", **options):
+    """
+    在内存里加水印
+    :param func: 各脚本里的 add_watermark
+    :param data: JPEG（或者RAW）文件的内容
+    :param name: 文件名，只用来认RAW和报错
+    :param options: 原样传给 func 的参数（black、logo、encoder等）
+    :return: 加好水印的文件内容
+    """
+    if options.get("stream"):
+        raise ValueError("内存接口不支持流式处理")
+    if raw_preview.is_raw(name):
+        data = raw_preview.preview_jpeg(data)
+    # 借用流水线模式的读写：原图从 job 里读，结果编码到 job 里，不碰磁盘
+    job = {"source": data, "outputs": []}
+    contextvars.copy_context().run(_render, func, name, job, options)
+    return job["outputs"][-1][1]
+
+
+def _render(func, name, job, options):
+    batch.current_job.set(job)
+    func(["", name], **options)
+
+
+def parse_options(func, query):
+    """
+    :param func: 各脚本里的 add_watermark
+    :param query: URL里的查询字符串，比如 black=1&encoder=webp
+    :return: 传给 func 的参数
+    """
+    accepted = inspect.signature(func).parameters
+    options = {}
+    for key, values in parse_qs(query).items():
+        if key not in accepted or key in _RESERVED_OPTIONS:
+            raise ValueError("不支持的参数 " + key)
+        value = values[-1]
+        if key in _INT_OPTIONS:
+            value = int(value)
+        elif key == "encoder" and value not in PROFILES:
+            raise ValueError("编码设置只有 " + "、".join(sorted(PROFILES)))
+        elif key == "logo" and value not in logo_names():
+            # 只能选 watermark 文件夹里的logo，不能用 ../ 或者绝对路径读服务器上别的文件
+            raise ValueError("logo 只有 " + "、".join(logo_names()))
+        elif isinstance(accepted[key].default, bool):
+            value = value.lower() in ("1", "true", "yes", "on")
+        options[key] = value
+    return options
+
+
+class LatencyStats:
+    """最近一段时间请求的耗时，算分位数用"""
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += error
+            self.latencies.append(seconds)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            latencies = list(self.latencies)
+            return {"requests": self.requests, "errors": self.errors, "rejected": self.rejected,
+                    "latency_ms": percentiles(latencies)}
+
+
+class RenderServer(ThreadingHTTPServer):
+    """
+    POST /render/<版式名>?参数  请求体是JPEG，返回加好水印的图
+    GET  /stats                 请求数、延迟分位数、缓存命中
+    """
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, max_requests=None, max_bytes=200 * 1024 * 1024, wait=30.0, quiet=False):
+        """
+        :param address: (主机, 端口)
+        :param workers: 同时渲染几张，默认等于CPU核数
+        :param max_requests: 最多同时接几个请求（正在渲染的 + 排队的），默认 workers 的4倍
+        :param max_bytes: 请求体最大字节数
+        :param wait: 接满以后新请求最多等多少秒，还没空位就返回503
+        :param quiet: True 就不打印每个请求
+        """
+        super().__init__(address, RenderHandler)
+        workers = workers or os.cpu_count() or 1
+        # 各版式的 add_watermark 都在这个进程里加载好，字体、logo缓存一直留着
+        self.layouts = {name: load_layout(name).add_watermark for name in LAYOUTS}
+        self.executor = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(max_requests or workers * 4)
+        self.max_bytes = max_bytes
+        self.wait = wait
+        self.quiet = quiet
+        self.stats = LatencyStats()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    server_version = "HasselbladWatermark"
+
+    def do_GET(self):
+        if urlsplit(self.path).path.rstrip("/") != "/stats":
+            return self._reply(404, "找不到 " + self.path)
+        body = {**self.server.stats.snapshot(), "cache": cache.stats(), "layouts": sorted(self.server.layouts)}
+        self._reply(200, json.dumps(body, ensure_ascii=False).encode(), "application/json")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "render" or parts[1] not in self.server.layouts:
+            return self._reply(404, "版式只有 " + "、".join(sorted(self.server.layouts)))
+        func = self.server.layouts[parts[1]]
+        try:
+            options = parse_options(func, url.query)
+        except ValueError as e:
+            return self._reply(400, str(e))
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return self._reply(400, "请求体里没有照片")
+        if length > self.server.max_bytes:
+            return self._reply(413, f"照片超过 {self.server.max_bytes // 1024 // 1024}MB")
+        if not self.server.slots.acquire(timeout=self.server.wait):
+            self.server.stats.reject()
+            return self._reply(503, "请求太多，稍后再试")
+        try:
+            data = self.rfile.read(length)
+            name = self.headers.get("X-File-Name") or "upload.jpg"
+            start = time.perf_counter()
+            future = self.server.executor.submit(render_bytes, func, data, name, **options)
+            try:
+                result = future.result()
+            except (IncompleteExifError, NoPreviewError, ValueError, OSError) as e:
+                # 缺参数、不是图片、图片损坏都算请求的问题
+                self.server.stats.add(time.perf_counter() - start, error=True)
+                return self._reply(422, str(e))
+            except Exception as e:
+                self.server.stats.add(time.perf_counter() - start, error=True)
+                return self._reply(500, f"{type(e).__name__}: {e}")
+            seconds = time.perf_counter() - start
+            self.server.stats.add(seconds)
+            content_type = CONTENT_TYPES[file_format(options.get("encoder"))]
+            self._reply(200, result, content_type, {"X-Render-Ms": f"{seconds * 1000:.1f}"})
+        finally:
+            self.server.slots.release()
+
+    def _reply(self, status, body, content_type="text/plain; charset=utf-8", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地水印渲染服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("-j", "--workers", type=int, default=None, help="同时渲染几张，默认等于CPU核数")
+    parser.add_argument("--max-requests", type=int, default=None,
+                        help="最多同时接几个请求（渲染中 + 排队），默认是渲染线程数的4倍")
+    parser.add_argument("--wait", type=float, default=30.0, help="接满以后新请求最多等几秒，还没空位就返回503")
+    parser.add_argument("--max-mb", type=int, default=200, help="请求体最大MB")
+    parser.add_argument("--encode-threads", type=int, metavar="N",
+                        help="大画布切成横条用N个线程同时编码（0是CPU核数），降低单张大图的延迟")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不打印每个请求")
+    args = parser.parse_args(argv)
+    if args.encode_threads is not None:
+        if args.encode_threads < 0:
+            parser.error("--encode-threads 不能小于0")
+        os.environ[THREADS_ENV] = str(args.encode_threads)
+
+    server = RenderServer((args.host, args.port), args.workers, args.max_requests, args.max_mb * 1024 * 1024,
+                          args.wait, args.quiet)
+    print(f"水印服务：http://{args.host}:{server.server_port}/render/<{'|'.join(sorted(server.layouts))}>，"
+          f"统计 /stats，按 Ctrl+C 退出")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stats = server.stats.snapshot()
+        latency = stats["latency_ms"] or {}
+        print(f"共 {stats['requests']} 个请求，失败 {stats['errors']}，拒绝 {stats['rejected']}，"
+              f"p50 {latency.get('p50', 0):.1f}ms，p99 {latency.get('p99', 0):.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+
+# 文件名：分条流式处理
+# 几亿像素的全景图整张解码、再建一张更大的画布会把内存撑爆：原图按重启标记（RST）切成一条条单独解码，
+# 成品画布也一条条拼好、编码、直接写盘，内存里只有当前这一条和水印条
+# 原图没有能切开的重启标记时只能整张解码一次，但输出照样分条编码，不再建整张画布
+
+from io import BytesIO
+import math
+import re
+import struct
+import warnings
+
+from PIL import Image
+
+from assets import cache
+from instrument import current_rss_mb, stage
+from jpeg_append import JpegSegments, renumber_rst
+
+MB = 1024 * 1024
+_SOF_BASELINE = (0xC0, 0xC1)
+# 解码时用不到、每条都带上又占地方的段：EXIF/XMP、ICC、IPTC
+_SKIP_SEGMENTS = (0xE1, 0xE2, 0xED)
+# 扫描数据里的标记（FF00 是填充，FFFF 是标记前的填充字节）
+_MARKER = re.compile(rb"\xff[\x01-\xfe]")
+# 每次从文件里读多少字节找重启标记
+_CHUNK = 4 * MB
+
+
+class MemoryBudgetError(Exception):
+    """照片在给定的内存上限里处理不了"""
+
+
+def check_budget(nbytes, budget_mb, what):
+    """
+    :param nbytes: 接下来要占用的字节数
+    :param budget_mb: 内存上限（MB，整个进程）
+    :param what: 报错时说明是哪一步
+    """
+    rss = current_rss_mb() or 0
+    if rss + nbytes / MB > budget_mb and cache.bytes:
+        # 先把缓存的字体、logo、水印条清掉再算一次
+        cache.clear()
+        rss = current_rss_mb() or 0
+    if rss + nbytes / MB > budget_mb:
+        raise MemoryBudgetError(f"{what}需要约 {nbytes / MB:.0f}MB，进程已占用 {rss:.0f}MB，超过内存上限 {budget_mb}MB")
+
+
+def open_image(path):
+    """
+    几亿像素的全景图超过了 Pillow 防解压炸弹的像素上限，流式处理有自己的内存上限，打开时不用这个限制
+    :param path: 文件路径或者文件对象
+    :return: Image.open 打开、还没解码的照片
+    """
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            return Image.open(path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+class StripReader:
+    """
+    按存储方向的行读原照片
+    基线JPEG、重启间隔能对齐到MCU行的，按条单独解码（每次只有一条在内存里）；其他的整张解码一次
+    """
+
+    def __init__(self, image, budget_mb):
+        """
+        :param image: Image.open 打开、还没解码的照片
+        :param budget_mb: 内存上限（MB），每条的高度按它来定
+        """
+        self.image = image
+        self.budget_mb = budget_mb
+        self.pixel_bytes = len(image.getbands())
+        self.header = None
+        self.units = None  # 能单独切出来的最小单位在扫描数据里的 [(开始, 结束)]
+        self._stripes = None  # [(上边, 下边, 第一个单位, 最后一个单位+1)]
+        self._current = (None, None, 0)
+        self._loaded = False
+        if image.format == "JPEG" and getattr(image, "filename", None):
+            self._index(image.filename)
+
+    def _index(self, path):
+        with open(path, "rb") as f:
+            size = _CHUNK // 4
+            while True:
+                f.seek(0)
+                head = f.read(size)
+                try:
+                    jpeg = JpegSegments(head, header_only=True)
+                    break
+                except (IndexError, struct.error, ValueError):
+                    if len(head) < size:
+                        return
+                    size *= 4
+            if (jpeg.sof_marker not in _SOF_BASELINE or not jpeg.restart_interval
+                    or len(jpeg.scan_tables) != len(jpeg.components) or jpeg.spectral != (0, 63, 0)):
+                return
+
+            # 切的位置必须同时是重启间隔和MCU行的边界，能切的最小单位是 unit 行MCU
+            mcu_w, mcu_h = jpeg.mcu_size
+            per_row = -(-jpeg.width // mcu_w)
+            interval = jpeg.restart_interval
+            unit = math.lcm(interval, per_row) // per_row
+            unit_intervals = unit * per_row // interval  # 每个单位几个重启间隔
+            intervals = -(-jpeg.mcu_count() // interval)
+
+            # 每个单位在扫描数据里的起止位置
+            starts, ends, count, pos, carry = [jpeg.scan_start], [], 0, jpeg.scan_start, b""
+            f.seek(pos)
+            while True:
+                chunk = f.read(_CHUNK)
+                if not chunk:
+                    return  # 没找到扫描结束
+                data, base = carry + chunk, pos - len(carry)
+                scan_end = None
+                for match in _MARKER.finditer(data):
+                    if 0xD0 <= match.group()[1] <= 0xD7:
+                        count += 1
+                        if count % unit_intervals == 0:
+                            ends.append(base + match.start())
+                            starts.append(base + match.end())
+                    else:
+                        scan_end = base + match.start()
+                        break
+                if scan_end is not None:
+                    break
+                pos += len(chunk)
+                carry = data[-1:] if data.endswith(b"\xff") else b""
+            if count != intervals - 1:
+                return
+
+        self.header = [(marker, head[start:end]) for marker, start, end in jpeg.segments
+                       if marker not in _SKIP_SEGMENTS]
+        self.units = list(zip(starts, ends + [scan_end]))
+        self.unit_rows = unit * mcu_h
+        self.unit_intervals = unit_intervals
+
+    @property
+    def stripes(self):
+        """
+        :return: [(上边, 下边, 第一个单位, 最后一个单位+1)]；不能分条解码时是None
+        第一次用到时才按那时剩下的内存定每条多高（水印条这些已经占上了），每条最多占剩下的 1/8
+        """
+        if self._stripes is None and self.units is not None:
+            row_bytes = self.image.width * self.pixel_bytes
+            rows = int((self.budget_mb - (current_rss_mb() or 0)) * MB / 8 / row_bytes)
+            per_stripe = max(1, rows // self.unit_rows)
+            count, height = len(self.units), self.image.height
+            self._stripes = [(i * self.unit_rows, min(height, (i + per_stripe) * self.unit_rows), i,
+                              min(count, i + per_stripe)) for i in range(0, count, per_stripe)]
+        return self._stripes
+
+    def _stripe(self, index):
+        """
+        :return: (解码出来的图, 第 index 条的上边在这张图里的y)
+        上下各多解码一个单位：色度上采样要用到相邻的行，单独解码一条的话边上那几行会不一样
+        """
+        if self._current[0] == index:
+            return self._current[1:]
+        self._current = (None, None, 0)
+        top, _, first, last = self.stripes[index]
+        first, last = max(0, first - 1), min(len(self.units), last + 1)
+        rows = min(self.image.height, last * self.unit_rows) - first * self.unit_rows
+        check_budget(self.image.width * rows * self.pixel_bytes, self.budget_mb, "解码一条原图")
+        with open(self.image.filename, "rb") as f:
+            f.seek(self.units[first][0])
+            scan = f.read(self.units[last - 1][1] - self.units[first][0])
+        out = bytearray(b"\xff\xd8")
+        for marker, segment in self.header:
+            if 0xC0 <= marker <= 0xC3:
+                segment = segment[:5] + struct.pack(">H", rows) + segment[7:]
+            out += segment
+        out += renumber_rst(scan, -first * self.unit_intervals)
+        out += b"\xff\xd9"
+        del scan
+        with stage("decode", pixels=self.image.width * rows, nbytes=len(out)):
+            decoded = open_image(BytesIO(bytes(out)))
+            decoded.load()
+        self._current = (index, decoded, top - first * self.unit_rows)
+        return self._current[1:]
+
+    @property
+    def stripe_bytes(self):
+        """:return: 解码一条（整张解码时是整张）最多占多少内存"""
+        if self.stripes is None:
+            return 0 if self._loaded else self.image.width * self.image.height * self.pixel_bytes
+        rows = max(bottom - top for top, bottom, _, _ in self.stripes) + 2 * self.unit_rows
+        return self.image.width * min(rows, self.image.height) * self.pixel_bytes
+
+    def pieces(self, box):
+        """
+        :param box: 存储方向照片上的范围 (左, 上, 右, 下)
+        :return: 逐条产出 (落在 box 里的那一块照片, 它在 box 里的y)，每次只解码一条
+        """
+        left, top, right, bottom = box
+        if self.stripes is None:
+            if not self._loaded:
+                check_budget(self.image.width * self.image.height * self.pixel_bytes, self.budget_mb,
+                             "整张解码原图（没有能切开的重启标记）")
+                with stage("decode", pixels=self.image.width * self.image.height):
+                    self.image.load()
+                self._loaded = True
+            yield self.image.crop(box), 0
+            return
+        for index, (y0, y1, _, _) in enumerate(self.stripes):
+            if y1 <= top or y0 >= bottom:
+                continue
+            decoded, offset = self._stripe(index)
+            a, b = max(top, y0), min(bottom, y1)
+            yield decoded.crop((left, a - y0 + offset, right, b - y0 + offset)), a - top
+
+    def crop(self, box):
+        """
+        :param box: 存储方向照片上的范围 (左, 上, 右, 下)
+        :return: 这一块照片
+        """
+        piece = None
+        for part, y in self.pieces(box):
+            if part.height == box[3] - box[1]:
+                return part
+            if piece is None:
+                piece = Image.new(self.image.mode, (box[2] - box[0], box[3] - box[1]))
+            piece.paste(part, (0, y))
+        return piece
+
+
+def encode_strip(strip, options=None, exif=None):
+    """
+    单独编码一条画布，每行MCU后面都有重启标记；几条可以在不同线程里同时编码（Pillow 编码时不占GIL）
+    :param strip: 画布上的几行
+    :param options: 编码参数（encoder.stream_options）
+    :param exif: 第一条带上EXIF，文件头从它里面取
+    :return: JpegSegments
+    """
+    buffer = BytesIO()
+    options = {**(options or {}), "restart_marker_rows": 1}
+    if exif:
+        options["exif"] = exif
+    strip.save(buffer, "JPEG", **options)
+    return JpegSegments(buffer.getvalue())
+
+
+class StripWriter:
+    """
+    把一条条画布编码进同一个JPEG：每条单独编码（encode_strip），
+    条和条之间补上重启标记、序号接着往下编，拼起来就是一个完整的扫描
+    """
+
+    def __init__(self, f, size, exif=None, options=None):
+        """
+        :param f: 以二进制写打开的输出文件
+        :param size: 整张画布的宽高
+        :param exif: 写进文件头的EXIF
+        :param options: 编码参数（encoder.stream_options），每条都一样
+        """
+        self.f = f
+        self.size = size
+        self.exif = exif
+        self.options = options or {}
+        self.tables = None
+        self.intervals = 0
+        self.bytes = 0
+
+    def write(self, strip):
+        """:param strip: 画布上接下来的几行，除了最后一条，高度都必须是MCU高的整数倍"""
+        self.append(encode_strip(strip, self.options, self.exif if self.tables is None else None))
+
+    def append(self, encoded):
+        """:param encoded: encode_strip 编码好的下一条，第一条要带着EXIF"""
+        tables = (encoded.mcu_size, encoded.used_qtables(), encoded.used_htables())
+        out = bytearray()
+        if self.tables is None:
+            self.tables = tables
+            out += encoded.data[:2]
+            for marker, start, end in encoded.segments:
+                segment = encoded.data[start:end]
+                if marker == encoded.sof_marker:
+                    segment = segment[:5] + struct.pack(">H", self.size[1]) + segment[7:]
+                out += segment
+        else:
+            if tables != self.tables:
+                raise ValueError("分条编码出来的量化表或哈夫曼表不一样，拼不到一起")
+            out += bytes((0xFF, 0xD0 + (self.intervals - 1) % 8))
+        out += renumber_rst(encoded.data[encoded.scan_start:encoded.scan_end], self.intervals)
+        self.intervals += -(-encoded.height // encoded.mcu_size[1])
+        self.f.write(out)
+        self.bytes += len(out)
+
+    def close(self):
+        self.f.write(b"\xff\xd9")
+
+
+def save_streamed(oriented, reader, out_path, exif=None, options=None):
+    """
+    不建整张画布，一条条拼好、编码、写盘
+    :param oriented: OrientedCanvas（水印条已经画好）
+    :param reader: StripReader
+    :param out_path: 保存路径
+    :param exif: 写进文件头的EXIF
+    :param options: 编码参数（encoder.stream_options）
+    """
+    size, (photo_x, photo_y) = oriented.stored_geometry()
+    photo_w, photo_h = reader.image.size
+    band, (band_x, band_y) = oriented.stored_band()
+    # 每一行：画布一行、编码器的输入和输出，再加原图一行
+    per_row = size[0] * 3 * 3 + photo_w * reader.pixel_bytes
+    available = (reader.budget_mb - (current_rss_mb() or 0)) * MB - reader.stripe_bytes
+    # 释放掉的条不一定马上还给系统，只用剩下的一半
+    rows = int(available / 2 / per_row) // 16 * 16
+    if rows < 16:
+        check_budget(per_row * 16 + reader.stripe_bytes, reader.budget_mb, "分条编码")
+    # 一条太高也没有好处，libjpeg 本来就是按行处理的
+    rows = max(16, min(rows, 1024))
+    with open(out_path, "wb") as f:
+        writer = StripWriter(f, size, exif, options)
+        for y0 in range(0, size[1], rows):
+            y1 = min(size[1], y0 + rows)
+            with stage("canvas", pixels=size[0] * (y1 - y0)):
+                strip = Image.new("RGB", (size[0], y1 - y0), oriented.background_color)
+            top, bottom = max(y0, photo_y), min(y1, photo_y + photo_h)
+            if top < bottom:
+                for piece, y in reader.pieces((0, top - photo_y, photo_w, bottom - photo_y)):
+                    with stage("canvas", pixels=piece.width * piece.height):
+                        strip.paste(piece, (photo_x, top - y0 + y))
+            top, bottom = max(y0, band_y), min(y1, band_y + band.height)
+            if top < bottom:
+                with stage("canvas", pixels=band.width * (bottom - top)):
+                    strip.paste(band.crop((0, top - band_y, band.width, bottom - band_y)), (band_x, top - y0))
+            with stage("encode", pixels=strip.width * strip.height):
+                writer.write(strip)
+        writer.close()
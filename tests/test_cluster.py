@@ -0,0 +1,191 @@
+# 多机模式：几个进程当作几台机器，在临时文件夹里一起处理；其中一个领到照片后被 SIGKILL，
+# 看它的租约能不能被别的节点收回，每张照片是不是只输出一次
+
+import json
+import multiprocessing
+import os
+import random
+import signal
+import threading
+import time
+
+from PIL import Image
+import pytest
+
+from batch import output_dir
+from benchmark import make_exif
+import cluster
+import hasselblad
+
+COUNT = 6
+LEASE = 0.5
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="用 fork 起节点进程")
+
+
+@pytest.fixture
+def folder(tmp_path):
+    path = tmp_path / "card"
+    path.mkdir()
+    for i in range(COUNT):
+        Image.new("RGB", (320, 240), (40 * i, 80, 160)).save(path / f"{i}.jpg", exif=make_exif(random.Random(i), 1))
+    return str(path)
+
+
+def _doomed_node(folder_path, claimed_path):
+    # 领到第一张就记下来然后卡住，心跳照常，直到被杀
+    def render(func, folder_path, file_name, options):
+        with open(claimed_path, "w", encoding="utf-8") as f:
+            f.write(file_name)
+        time.sleep(3600)
+
+    cluster._render = render
+    cluster.drain(hasselblad.add_watermark, folder_path, lease=LEASE, quiet=True, node="doomed")
+
+
+def _node(folder_path, name, report_path):
+    outcomes = cluster.drain(hasselblad.add_watermark, folder_path, lease=LEASE, quiet=True, node=name)
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump([(outcome[0], outcome[1]) for outcome in outcomes], f)
+
+
+def _wait_for(path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        assert time.monotonic() < deadline, "等不到 " + path
+        time.sleep(0.05)
+
+
+def test_killed_node_is_reclaimed_and_every_photo_is_written_once(folder, tmp_path):
+    context = multiprocessing.get_context("fork")
+    claimed_path = str(tmp_path / "claimed")
+    doomed = context.Process(target=_doomed_node, args=(folder, claimed_path))
+    doomed.start()
+    _wait_for(claimed_path)
+    with open(claimed_path, encoding="utf-8") as f:
+        victim = f.read()
+    lease_dir = os.path.join(output_dir(folder), cluster.LEASE_DIR)
+    assert os.path.exists(os.path.join(lease_dir, victim + ".lease"))
+    os.kill(doomed.pid, signal.SIGKILL)
+    doomed.join()
+
+    reports = [str(tmp_path / f"node{i}.json") for i in range(2)]
+    nodes = [context.Process(target=_node, args=(folder, f"node{i}", report)) for i, report in enumerate(reports)]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join(120)
+        assert node.exitcode == 0
+
+    committed = []
+    for report in reports:
+        with open(report, encoding="utf-8") as f:
+            committed += [name for name, error in json.load(f) if error is None]
+    names = sorted(f"{i}.jpg" for i in range(COUNT))
+    # 每张照片只被一个节点提交过一次，输出文件夹里只有成品，没有写了一半的临时文件
+    assert sorted(committed) == names
+    out_dir = output_dir(folder)
+    assert sorted(name for name in os.listdir(out_dir) if name != cluster.LEASE_DIR) == names
+    for name in names:
+        with Image.open(os.path.join(out_dir, name)) as image:
+            image.verify()
+    # 被杀的节点的租约收回来了，没有留下租约或者收回用的临时文件
+    leftovers = os.listdir(lease_dir)
+    assert sorted(leftovers) == sorted(name + ".done" for name in names)
+    with open(os.path.join(lease_dir, victim + ".done"), encoding="utf-8") as f:
+        done = json.load(f)
+    assert done["node"] in ("node0", "node1") and done["error"] is None
+
+
+def test_heartbeat_notices_reclaimed_lease(tmp_path):
+    path = str(tmp_path / "a.jpg.lease")
+    token = cluster.claim(path, "slow")
+    assert token and cluster.claim(path, "other") is None
+    heartbeat = cluster.Heartbeat(path, token, 0.05)
+    heartbeat.start()
+    try:
+        time.sleep(0.2)
+        assert not heartbeat.lost
+        # 别的节点认为它过期了：收回、重新领
+        cluster.reclaim(path)
+        assert cluster.claim(path, "other")
+        deadline = time.monotonic() + 5
+        while not heartbeat.lost and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        heartbeat.stop()
+    assert heartbeat.lost
+    assert cluster.lease_token(path) != token
+
+
+def test_expiry_needs_a_silent_lease(tmp_path):
+    path = str(tmp_path / "a.jpg.lease")
+    cluster.claim(path, "node")
+    watch = cluster.ExpiryWatch(0.2)
+    assert not watch.expired(path)
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(0.05):
+            os.utime(path, ns=(time.time_ns(), time.time_ns()))
+
+    beating = threading.Thread(target=beat)
+    beating.start()
+    try:
+        deadline = time.monotonic() + 0.6
+        while time.monotonic() < deadline:
+            assert not watch.expired(path)  # 一直有心跳就不算过期
+            time.sleep(0.02)
+    finally:
+        stop.set()
+        beating.join()
+    time.sleep(0.1)
+    watch.expired(path)
+    time.sleep(0.3)
+    assert watch.expired(path)
+
+
+def test_release_keeps_someone_elses_lease(tmp_path):
+    path = str(tmp_path / "a.jpg.lease")
+    mine = cluster.claim(path, "slow")
+    cluster.reclaim(path)
+    theirs = cluster.claim(path, "other")
+    cluster.release(path, mine)
+    assert cluster.lease_token(path) == theirs
+    cluster.release(path, theirs)
+    assert not os.path.exists(path) and os.listdir(tmp_path) == []
+
+
+def test_lease_lost_while_writing_is_not_committed(folder, monkeypatch):
+    # 写盘的时候别的节点把租约收回去重新领了：这个节点不能标记完成，也不能删掉别人的租约
+    lease_dir = os.path.join(output_dir(folder), cluster.LEASE_DIR)
+    stolen = {}
+    write = cluster.pipeline._write
+
+    def slow_write(path, data):
+        name = os.path.basename(path)
+        if not stolen:
+            lease_path = os.path.join(lease_dir, name + ".lease")
+            cluster.reclaim(lease_path)
+            stolen[name] = cluster.claim(lease_path, "other")
+        write(path, data)
+
+    def mark_done(lease_dir, file_name, stat, settings, node, error):
+        # 收回租约的节点一直没有心跳，要等它过期、重新收回以后才能标记完成
+        lease_path = os.path.join(lease_dir, file_name + ".lease")
+        assert file_name not in stolen or cluster.lease_token(lease_path) != stolen[file_name]
+        done(lease_dir, file_name, stat, settings, node, error)
+
+    done = cluster._mark_done
+    monkeypatch.setattr(cluster.pipeline, "_write", slow_write)
+    monkeypatch.setattr(cluster, "_mark_done", mark_done)
+    outcomes = cluster.drain(hasselblad.add_watermark, folder, lease=LEASE, quiet=True, node="slow")
+    (name, token), = stolen.items()
+    assert [outcome[1] is None for outcome in outcomes if outcome[0] == name] == [False, True]
+    assert sorted(outcome[0] for outcome in outcomes if outcome[1] is None) == sorted(f"{i}.jpg" for i in range(COUNT))
+    assert sorted(os.listdir(lease_dir)) == sorted(f"{i}.jpg.done" for i in range(COUNT))
+
+
+def test_cluster_rejects_stream(folder):
+    with pytest.raises(ValueError):
+        cluster.drain(hasselblad.add_watermark, folder, options={"stream": 256})
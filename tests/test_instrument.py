@@ -0,0 +1,46 @@
+# 分阶段计时：阶段套阶段时不能重复计时，各阶段的占比加起来不超过100%
+
+import os
+import random
+import time
+
+from PIL import Image
+
+from assets import cache
+import batch
+from benchmark import make_exif
+import hasselblad
+import instrument
+from instrument import stage
+from layout import compile_layout
+
+
+def test_nested_stage_counts_only_its_own_time():
+    instrument.begin("a.jpg")
+    with stage("outer"):
+        time.sleep(0.02)
+        with stage("inner"):
+            time.sleep(0.05)
+    record = instrument.end()
+    outer, inner = record["stages"]["outer"]["seconds"], record["stages"]["inner"]["seconds"]
+    assert inner >= 0.05
+    assert 0.02 <= outer < 0.05
+    assert outer + inner <= record["seconds"]
+
+
+def test_profile_shares_add_up_to_at_most_100_percent(tmp_path):
+    for i in range(3):
+        Image.new("RGB", (640, 480), (60 * i, 90, 120)).save(tmp_path / f"{i}.jpg", exif=make_exif(random.Random(i), 1))
+    os.makedirs(batch.output_dir(str(tmp_path)))
+    # 清掉缓存，让排版阶段里真的去加载字体、缩放logo
+    cache.clear()
+    compile_layout.cache_clear()
+    report = instrument.Report()
+    for i in range(3):
+        outcome = batch._process_one(hasselblad.add_watermark, str(tmp_path), f"{i}.jpg", {}, profile=True)
+        assert outcome[1] is None
+        report.add(outcome[3])
+    stages = report.stages()
+    assert {"layout", "font", "logo_resize"} <= set(stages)
+    total = sum(record["seconds"] for record in report.records)
+    assert sum(sum(values) for values in stages.values()) <= total
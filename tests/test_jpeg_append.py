@@ -0,0 +1,43 @@
+# 无损追加：拆不开的JPEG要退回整张编码，不能让这张照片失败
+
+from io import BytesIO
+import random
+
+from PIL import Image
+
+from benchmark import make_exif
+import hasselblad
+from jpeg_append import save_appended
+from service import render_bytes
+
+
+def _jpeg(**options):
+    buffer = BytesIO()
+    Image.new("RGB", (320, 240), (90, 120, 150)).save(buffer, "JPEG", exif=make_exif(random.Random(0), 1), **options)
+    return buffer.getvalue()
+
+
+def _append(data):
+    band = Image.new("RGB", (320, 32), "white")
+    with Image.open(BytesIO(data)) as image:
+        return save_appended(image, band, (0, 240), BytesIO())
+
+
+def test_appends_to_a_clean_jpeg():
+    assert _append(_jpeg())
+
+
+def test_missing_eoi_is_not_appended():
+    assert _append(_jpeg()[:-2]) is False
+
+
+def test_unparseable_jpeg_falls_back_to_full_encode():
+    data = _jpeg()
+    # 第一个段后面塞几个不是0xFF的填充字节
+    length = int.from_bytes(data[4:6], "big")
+    data = data[:4 + length] + b"\x00\x00\x00" + data[4 + length:]
+    with Image.open(BytesIO(data)) as image:
+        image.load()  # Pillow 能正常解码
+    assert _append(data) is False
+    with Image.open(BytesIO(render_bytes(hasselblad.add_watermark, data, lossless=True))) as image:
+        assert image.size[0] == 320 and image.size[1] > 240
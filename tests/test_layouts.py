@@ -0,0 +1,41 @@
+# 三种版式用各自的默认参数都能跑：benchmark 的默认对比、service 的 /render/<版式> 都不传 logo
+
+from io import BytesIO
+import inspect
+import random
+
+from PIL import Image
+import pytest
+
+from assets import logo_names
+from benchmark import make_exif, run_case
+from layout import LAYOUTS, load_layout
+from service import render_bytes
+
+
+@pytest.fixture(scope="module")
+def photo():
+    buffer = BytesIO()
+    Image.new("RGB", (480, 320), (90, 120, 150)).save(buffer, "JPEG", exif=make_exif(random.Random(0), 1))
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("name", sorted(LAYOUTS))
+def test_default_logo_is_shipped(name):
+    default = inspect.signature(load_layout(name).add_watermark).parameters["logo"].default
+    assert default in logo_names()
+
+
+@pytest.mark.parametrize("name", sorted(LAYOUTS))
+def test_render_with_defaults(name, photo):
+    with Image.open(BytesIO(render_bytes(load_layout(name).add_watermark, photo))) as image:
+        assert image.width >= 480 and image.height > 320
+
+
+@pytest.mark.parametrize("name", sorted(LAYOUTS))
+def test_benchmark_case_has_no_failures(name, photo, tmp_path):
+    folder = tmp_path / "bench"
+    folder.mkdir()
+    (folder / "a.jpg").write_bytes(photo)
+    result = run_case(name, str(folder), 1, {})
+    assert result["failures"] == {} and result["images"] == 1
@@ -0,0 +1,104 @@
+# raw_preview 的IFD遍历：用手拼的TIFF/DNG结构做测试数据，不需要真的RAW文件
+
+from io import BytesIO
+import struct
+
+from PIL import Image
+import piexif
+import pytest
+
+import raw_preview
+from raw_preview import NoPreviewError
+
+MODEL = b"X2D 100C\x00"
+_SHORT, _LONG, _ASCII = 3, 4, 2
+_COMPRESSION, _MODEL, _STRIP_OFFSETS, _STRIP_BYTE_COUNTS, _SUB_IFDS = 0x0103, 0x0110, 0x0111, 0x0117, 0x014A
+_JPEG_OFFSET, _JPEG_LENGTH = 0x0201, 0x0202
+
+
+def _jpeg(size):
+    buffer = BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def _ifd(entries, next_offset, endian):
+    out = struct.pack(endian + "H", len(entries))
+    for tag, value_type, count, value in sorted(entries):
+        out += struct.pack(endian + "HHI", tag, value_type, count)
+        out += struct.pack(endian + "HH", value, 0) if value_type == _SHORT else struct.pack(endian + "I", value)
+    return out + struct.pack(endian + "I", next_offset)
+
+
+def make_raw(endian="<", loop=False, sub_ifd_count=1):
+    """
+    DNG结构：IFD0 里是小预览和EXIF，SubIFD 里是大预览（用 JPEGInterchangeFormat 标，像NEF那样）
+    :param loop: True 就让 IFD0 的下一个IFD指回自己、SubIFD 再指回 IFD0，模拟损坏的文件
+    :param sub_ifd_count: SubIFDs 那一项的个数，给一个很大的数模拟乱掉的个数
+    """
+    small, big = _jpeg((64, 48)), _jpeg((320, 240))
+    ifd0, sub = 8, 8 + 2 + 5 * 12 + 4
+    model = sub + 2 + 4 * 12 + 4
+    small_offset = model + len(MODEL)
+    big_offset = small_offset + len(small)
+    head = (b"II*\x00" if endian == "<" else b"MM\x00*") + struct.pack(endian + "I", ifd0)
+    head += _ifd([(_COMPRESSION, _SHORT, 1, 7), (_MODEL, _ASCII, len(MODEL), model),
+                  (_STRIP_OFFSETS, _LONG, 1, small_offset), (_STRIP_BYTE_COUNTS, _LONG, 1, len(small)),
+                  (_SUB_IFDS, _LONG, sub_ifd_count, sub)], ifd0 if loop else 0, endian)
+    head += _ifd([(_COMPRESSION, _SHORT, 1, 6), (_JPEG_OFFSET, _LONG, 1, big_offset),
+                  (_JPEG_LENGTH, _LONG, 1, len(big)), (_SUB_IFDS, _LONG, 1, ifd0 if loop else 0)],
+                 sub if loop else 0, endian)
+    assert len(head) == model
+    return head + MODEL + small + big
+
+
+def _size_and_model(jpeg):
+    with Image.open(BytesIO(jpeg)) as image:
+        return image.size, piexif.load(image.info["exif"])["0th"].get(piexif.ImageIFD.Model)
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_largest_preview_with_exif(endian):
+    assert _size_and_model(raw_preview.preview_jpeg(make_raw(endian))) == ((320, 240), b"X2D 100C")
+
+
+def test_read_header_from_file(tmp_path):
+    path = tmp_path / "a.dng"
+    path.write_bytes(make_raw())
+    header = raw_preview.read_header(str(path))
+    assert (header.width, header.height, header.components) == (320, 240, 3)
+    assert raw_preview.is_raw(str(path))
+
+
+def test_ifd_loop_terminates():
+    assert _size_and_model(raw_preview.preview_jpeg(make_raw(loop=True)))[0] == (320, 240)
+
+
+def test_garbage_count_falls_back_to_what_was_read():
+    # SubIFDs 的个数乱了：这一项读不出来，IFD0 里已经读到的小预览照样能用
+    assert _size_and_model(raw_preview.preview_jpeg(make_raw(sub_ifd_count=0xFFFFFFFF)))[0] == (64, 48)
+
+
+@pytest.mark.parametrize("data", [b"", b"II*\x00", b"II*\x00\xff\xff\xff\xff", b"not a raw file at all"])
+def test_garbage_raises_no_preview(data):
+    with pytest.raises(NoPreviewError):
+        raw_preview.preview_jpeg(data)
+
+
+def test_truncated_file(tmp_path):
+    data = make_raw()
+    path = tmp_path / "cut.dng"
+    # 在IFD、预览的各个位置截断：要么还能取到预览，要么报 NoPreviewError，不能是 struct.error 之类
+    for cut in list(range(0, 200)) + list(range(200, len(data), 97)):
+        try:
+            raw_preview.preview_jpeg(data[:cut])
+        except NoPreviewError:
+            pass
+        if cut:
+            path.write_bytes(data[:cut])
+            try:
+                raw_preview.read_header(str(path))
+            except NoPreviewError:
+                pass
+    with pytest.raises(NoPreviewError):
+        raw_preview.preview_jpeg(data[:60])  # IFD0 读到一半，还没有预览
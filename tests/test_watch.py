@@ -0,0 +1,71 @@
+# 监视模式的清单：临时出错的照片文件不变也会重试，缺拍摄参数的照片不重复处理
+
+import os
+import random
+
+from PIL import Image
+import pytest
+
+from batch import output_dir
+from benchmark import make_exif
+import hasselblad
+import watch
+
+calls = []
+
+
+def flaky(jpg_file, **options):
+    # 第一次调用模拟临时出错（比如网络盘断了一下），之后正常
+    calls.append(jpg_file[1])
+    if len(calls) == 1:
+        raise OSError("磁盘暂时不可用")
+    hasselblad.add_watermark(jpg_file, **options)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    calls.clear()
+    Image.new("RGB", (320, 240), (90, 120, 150)).save(tmp_path / "a.jpg", exif=make_exif(random.Random(0), 1))
+    Image.new("RGB", (320, 240), (90, 120, 150)).save(tmp_path / "b.jpg",
+                                                      exif=make_exif(random.Random(1), 1, complete=False))
+    return str(tmp_path)
+
+
+def _incremental(folder_path):
+    watch.watch_folder(flaky, folder_path, once=True, workers=1, required_tags=hasselblad.REQUIRED_TAGS, quiet=True)
+    return watch.Manifest(os.path.join(output_dir(folder_path), watch.MANIFEST_NAME)).entries
+
+
+def test_transient_error_is_retried_and_incomplete_exif_is_not(folder):
+    entries = _incremental(folder)
+    assert entries["a.jpg"]["error"] and not entries["a.jpg"]["permanent"]
+    assert entries["b.jpg"]["error"] and entries["b.jpg"]["permanent"]
+    assert not os.path.exists(os.path.join(output_dir(folder), "a.jpg"))
+
+    entries = _incremental(folder)
+    assert entries["a.jpg"]["error"] is None
+    assert os.path.exists(os.path.join(output_dir(folder), "a.jpg"))
+    # 缺参数的照片只在预检时跳过，从来没有交给 add_watermark
+    assert calls == ["a.jpg", "a.jpg"]
+
+    _incremental(folder)
+    assert calls == ["a.jpg", "a.jpg"]
+
+
+def test_watch_waits_before_retrying(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"x")
+    stat = os.stat(path)
+    manifest = watch.Manifest(str(tmp_path / "manifest.json"))
+    manifest.record("a.jpg", stat, "hash", "settings", "内存不够")
+    assert manifest.is_current("a.jpg", stat, "settings")  # 还没到重试时间
+    first = manifest.entries["a.jpg"]
+    manifest.record("a.jpg", stat, "hash", "settings", "内存不够")
+    second = manifest.entries["a.jpg"]
+    assert second["attempts"] == 2
+    assert second["retry_at"] - first["retry_at"] >= watch.RETRY_DELAY * 0.9  # 每次翻倍
+    second["retry_at"] = 0
+    assert not manifest.is_current("a.jpg", stat, "settings")
+    assert not manifest.same_content("a.jpg", "hash", "settings")
+    manifest.record("a.jpg", stat, "hash", "settings")
+    assert manifest.is_current("a.jpg", stat, "settings") and manifest.entries["a.jpg"]["attempts"] == 0
@@ -0,0 +1,180 @@
+
+# 文件名：监视文件夹
+# 联机拍摄时相机不停往文件夹里写照片：轮询新出现/改动过的jpg，等文件写完再加水印
+# 清单里记着每张图的大小、修改时间、内容哈希和水印参数，重启后没变的照片直接跳过
+
+import hashlib
+import json
+import os
+import time
+
+import batch
+
+# 清单文件放在结果文件夹里
+MANIFEST_NAME = ".watermark-manifest.json"
+# 临时出错的照片（内存不够、读写出错、拷了一半……）文件不变也会重试：第一次等 RETRY_DELAY 秒，之后每次翻倍，最多 RETRY_MAX 秒
+RETRY_DELAY = 10.0
+RETRY_MAX = 600.0
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """
+    :return: 文件内容的 blake2b 哈希（十六进制）
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def layout_settings(func, options):
+    """
+    :param func: 各脚本里的 add_watermark
+    :param options: 传给 add_watermark 的参数
+    :return: 代表这套水印设置的字符串，设置变了所有照片都要重做
+    """
+    return json.dumps({"layout": os.path.basename(func.__code__.co_filename), **options}, sort_keys=True)
+
+
+class Manifest:
+    """
+    已经处理过的照片清单：{文件名: {"size", "mtime", "hash", "settings", "error", "permanent", "attempts", "retry_at"}}
+    """
+
+    def __init__(self, path, retry_delay=True):
+        """
+        :param retry_delay: False 就不等重试时间，上次临时出错的照片这次都重做（增量重跑时）
+        """
+        self.path = path
+        self.retry_delay = retry_delay
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def is_current(self, name, stat, settings):
+        """
+        只比大小和修改时间，不读文件
+        """
+        entry = self.entries.get(name)
+        return (entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+                and entry["settings"] == settings and not self._retry_due(entry))
+
+    def same_content(self, name, digest, settings):
+        """
+        修改时间变了但内容没变（比如重新拷贝了一遍）也不用重做；上次临时出错的要重做
+        """
+        entry = self.entries.get(name)
+        return (entry is not None and entry["hash"] == digest and entry["settings"] == settings
+                and (entry["error"] is None or entry.get("permanent", False)))
+
+    def _retry_due(self, entry):
+        """
+        :return: 上次临时出错，已经到了重试的时间
+        """
+        return (entry["error"] is not None and not entry.get("permanent", False)
+                and (not self.retry_delay or time.time() >= entry.get("retry_at", 0)))
+
+    def record(self, name, stat, digest, settings, error=None, permanent=False):
+        """
+        :param error: 出错的原因，成功是None
+        :param permanent: 错误是照片本身的（缺拍摄参数），文件不变重试也没用
+        """
+        attempts = 0
+        old = self.entries.get(name)
+        if error is not None and old is not None and old["error"] is not None and old["hash"] == digest:
+            attempts = old.get("attempts", 0)
+        attempts += error is not None
+        self.entries[name] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest,
+                              "settings": settings, "error": error, "permanent": permanent, "attempts": attempts,
+                              "retry_at": time.time() + min(RETRY_MAX, RETRY_DELAY * 2 ** max(attempts - 1, 0))}
+
+    def save(self):
+        with batch.atomic_write(self.path) as tmp:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=0)
+
+
+def watch_folder(func, folder_path, interval=2.0, settle=1.0, once=False, workers=None, required_tags=None,
+                 quiet=False, raw=False, **options):
+    """
+    监视文件夹，新来的或改过的jpg写完以后自动加水印
+    :param func: 各脚本里的 add_watermark
+    :param folder_path: 监视的文件夹
+    :param interval: 轮询间隔（秒）
+    :param settle: 文件大小和修改时间多久不变才算写完（秒）
+    :param once: True 只扫一遍就退出（增量重跑）
+    :param workers: 进程数，同 batch.run_batch
+    :param required_tags: 版式必须有的EXIF标签，同 batch.run_batch
+    :param raw: True 就监视RAW文件，同 batch.run_batch
+    :param options: 原样传给 func 的参数
+    """
+    out_dir = batch.output_dir(folder_path, options.get("preview"))
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(out_dir, MANIFEST_NAME), retry_delay=not once)
+    settings = layout_settings(func, options)
+    pending = {}  # 文件名 -> ((大小, 修改时间), 上次看到变化的时间)
+    if not quiet and not once:
+        print(f"正在监视 {folder_path}，按 Ctrl+C 退出")
+    try:
+        while True:
+            ready = _ready_files(folder_path, manifest, settings, pending, 0 if once else settle, raw)
+            if ready:
+                _process(func, folder_path, ready, manifest, settings, workers, required_tags, quiet, options)
+            if once:
+                return
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        if not quiet:
+            print("已停止监视")
+
+
+def _ready_files(folder_path, manifest, settings, pending, settle, raw=False):
+    """
+    :return: [(文件名, stat)] 已经写完、需要处理的照片
+    """
+    now = time.monotonic()
+    ready = []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if not batch.is_source(entry.name, raw) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            if manifest.is_current(entry.name, stat, settings):
+                pending.pop(entry.name, None)
+                continue
+            key = (stat.st_size, stat.st_mtime_ns)
+            seen = pending.get(entry.name)
+            if seen is None or seen[0] != key:
+                pending[entry.name] = (key, now)  # 还在写，等它稳定
+                if settle:
+                    continue
+            elif now - seen[1] < settle:
+                continue
+            ready.append((entry.name, stat))
+    for name, _ in ready:
+        pending.pop(name, None)
+    return sorted(ready)
+
+
+def _process(func, folder_path, ready, manifest, settings, workers, required_tags, quiet, options):
+    todo, digests = [], {}
+    for name, stat in ready:
+        digest = file_hash(os.path.join(folder_path, name))
+        digests[name] = digest
+        if manifest.same_content(name, digest, settings):
+            entry = manifest.entries[name]
+            manifest.record(name, stat, digest, settings, entry["error"], entry.get("permanent", False))
+        else:
+            todo.append(name)
+    if todo:
+        result = batch.run_batch(func, folder_path, files=todo, workers=workers, quiet=quiet,
+                                 required_tags=required_tags, **options)
+        errors = {**result.skipped, **result.failed}
+        for name, stat in ready:
+            if name in todo:
+                manifest.record(name, stat, digests[name], settings, errors.get(name), name in result.incomplete)
+        if not quiet:
+            print(result.summary())
+    manifest.save()